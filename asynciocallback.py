@@ -0,0 +1,122 @@
+"""
+A Callback that runs its tasks on an asyncio event loop.
+"""
+
+from thread import get_ident
+from time import time
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from .callback import Callback, set_name
+from .decorator import attach_profiler
+from .logger import get_logger
+logger = get_logger(__name__)
+
+
+class AsyncioCallback(Callback):
+
+    """
+    AsyncioCallback handles the registered tasks on an asyncio event loop, running on its own thread.
+
+    It offers the same register, persistent_register, replace_register, unregister, and call methods
+    as Callback, and generators are rescheduled by yielding float delays in the same way.  Other
+    code, such as AsyncioEndpoint, can add its own callbacks to event_loop, these will run on the
+    same thread as the registered tasks.
+
+    Requires asyncio or, on Python 2, trollius.
+    """
+
+    def __init__(self, name="Generic-Callback", **kargs):
+        assert isinstance(name, str), type(name)
+        if asyncio is None:
+            raise RuntimeError("AsyncioCallback requires either asyncio or trollius")
+        super(AsyncioCallback, self).__init__(name, **kargs)
+
+        # _event_loop runs on the thread started by start()
+        self._event_loop = asyncio.new_event_loop()
+
+        # _tick_handle contains the asyncio handle of the next scheduled _tick.  it is protected by
+        # _lock
+        self._tick_handle = None
+
+    @property
+    def event_loop(self):
+        """
+        The asyncio event loop that handles the registered tasks.
+        """
+        return self._event_loop
+
+    def _wake_up_if(self, new_task_deadline):
+        # Callback.call waits on _event when called on this thread
+        super(AsyncioCallback, self)._wake_up_if(new_task_deadline)
+
+        # reschedule the next _tick when the new task is due before it, note that this is always
+        # called while holding _lock
+        if new_task_deadline <= self._sleep_deadline and not self._tick_handle is None:
+            self._sleep_deadline = 0.0
+            self._event_loop.call_soon_threadsafe(self._tick)
+
+    def _wake_up(self):
+        # Callback.stop calls this after changing the state, hence _tick will notice the new state
+        # and stop the event loop instead of waiting for the next task deadline
+        super(AsyncioCallback, self)._wake_up()
+        if not self._tick_handle is None:
+            self._sleep_deadline = 0.0
+            self._event_loop.call_soon_threadsafe(self._tick)
+
+    def _tick(self):
+        """
+        Handle one set of expired tasks and schedule the next _tick.
+        """
+        actual_time = time()
+        result = self._take_tasks(actual_time)
+        if result is False:
+            self._event_loop.stop()
+            return
+
+        tasks, wait, _ = result
+        if tasks:
+            self._handle_tasks(tasks, actual_time)
+
+        with self._lock:
+            if not self._tick_handle is None:
+                self._tick_handle.cancel()
+            if wait:
+                # _take_tasks has set _sleep_deadline, _wake_up_if will call _tick sooner when needed
+                self._tick_handle = self._event_loop.call_later(wait, self._tick)
+            else:
+                # allow the event loop to handle I/O in between the tasks
+                self._tick_handle = self._event_loop.call_soon(self._tick)
+
+    def _shutdown(self):
+        super(AsyncioCallback, self)._shutdown()
+        self._event_loop.stop()
+
+    @attach_profiler
+    def loop(self):
+        # set thread name (visible from ps and top)
+        set_name(self._name[:16])
+
+        # from now on we will assume GET_IDENT() is the running thread
+        self._thread_ident = get_ident()
+        asyncio.set_event_loop(self._event_loop)
+
+        with self._lock:
+            if self._state == "STATE_PLEASE_RUN":
+                self._state = "STATE_RUNNING"
+                logger.debug("STATE_RUNNING")
+            self._tick_handle = self._event_loop.call_soon(self._tick)
+
+        try:
+            self._event_loop.run_forever()
+        finally:
+            # stop() called on this thread has already performed the shutdown
+            if not self.is_finished:
+                self._shutdown()
+            self._event_loop.close()
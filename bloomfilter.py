@@ -25,11 +25,18 @@ Ippolito <bob@redivi.com>.  Simplified, and optimized to use just python code.
 from hashlib import sha1, sha256, sha384, sha512, md5
 from math import ceil, log
 from struct import Struct
-from binascii import hexlify, unhexlify
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from .logger import get_logger
 logger = get_logger(__name__)
 
+# number of bits set for every possible byte value, used to count the bits set in the filter
+_BITS_IN_BYTE = tuple(bin(byte).count("1") for byte in xrange(256))
+
 
 class BloomFilter(object):
 
@@ -84,7 +91,7 @@ class BloomFilter(object):
             prefix = kargs.get("prefix", args[2] if len(args) >= 3 else "")
             assert 0 < len(bytes_), len(bytes_)
             logger.debug("bloom filter based on %d bytes and k_functions %d", len(bytes_), k_functions)
-            filter_ = long(hexlify(bytes_[::-1]), 16)
+            filter_ = bytearray(bytes_)
 
         # matches: BloomFilter(int:m_size, float:f_error_rate, str:prefix="")
         elif len(args) >= 2 and isinstance(args[0], int) and isinstance(args[1], float):
@@ -96,7 +103,7 @@ class BloomFilter(object):
             assert 0.0 < f_error_rate < 1.0, f_error_rate
             logger.debug("constructing bloom filter based on m_size %d bits and f_error_rate %f", m_size, f_error_rate)
             k_functions = cls._get_k_functions(m_size, cls._get_n_capacity(m_size, f_error_rate))
-            filter_ = 0
+            filter_ = bytearray(m_size / 8)
 
         # matches: BloomFilter(float:f_error_rate, int:n_capacity, str:prefix="")
         elif len(args) >= 2 and isinstance(args[0], float) and isinstance(args[1], int):
@@ -109,7 +116,7 @@ class BloomFilter(object):
                          n_capacity)
             m_size = int(ceil(abs((n_capacity * log(f_error_rate)) / (log(2) ** 2)) / 8.0) * 8)
             k_functions = cls._get_k_functions(m_size, n_capacity)
-            filter_ = 0
+            filter_ = bytearray(m_size / 8)
 
         else:
             raise RuntimeError("Unknown combination of argument types %s" % str([type(arg) for arg in args]))
@@ -127,14 +134,15 @@ class BloomFilter(object):
         assert 0 < self._k_functions <= self._m_size, [self._k_functions, self._m_size]
         assert isinstance(self._prefix, str), type(self._prefix)
         assert 0 <= len(self._prefix) < 256, len(self._prefix)
-        assert isinstance(self._filter, (int, long)), type(self._filter)
+        assert isinstance(self._filter, bytearray), type(self._filter)
+        assert len(self._filter) * 8 == self._m_size, [len(self._filter), self._m_size]
 
         if __debug__:
             hypothetical_error_rates = [0.4, 0.3, 0.2, 0.1, 0.01, 0.001, 0.0001]
             logger.debug("m size:      %d    ~%d bytes", self._m_size, self._m_size / 8)
             logger.debug("k functions: %d", self._k_functions)
             logger.debug("prefix:      %s", self._prefix.encode("HEX"))
-            logger.debug("filter:      %s", self._filter)
+            logger.debug("filter:      %s", str(self._filter).encode("HEX"))
             logger.debug("hypothetical error rate: %s", " | ".join("%.4f" % hypothetical_error_rate
                                                                    for hypothetical_error_rate
                                                                    in hypothetical_error_rates))
@@ -171,16 +179,21 @@ class BloomFilter(object):
                                            "x" * (hashfn().digest_size - bits_required / 8)))).unpack
         self._salt = hashfn(self._prefix)
 
+        # used by not_filter_indexes to interpret all digests at once
+        self._chunk_size = chunk_size
+        self._digest_size = hashfn().digest_size
+
     def add(self, key):
         """
         Add KEY to the BloomFilter.
         """
         filter_ = self._filter
+        m_size = self._m_size
         hash_ = self._salt.copy()
         hash_.update(key)
         for pos in self._fmt_unpack(hash_.digest()):
-            filter_ |= 1 << (pos % self._m_size)
-        self._filter = filter_
+            pos %= m_size
+            filter_[pos >> 3] |= 1 << (pos & 7)
 
     def add_keys(self, keys):
         """
@@ -200,25 +213,25 @@ class BloomFilter(object):
             # while generators are more memory efficient, this list will be relatively short.
             # 07/05/12 Niels: using no list at all is even more efficient/faster
             for pos in fmt_unpack(hash_.digest()):
-                filter_ |= 1 << (pos % m_size)
-
-        self._filter = filter_
+                pos %= m_size
+                filter_[pos >> 3] |= 1 << (pos & 7)
 
     def clear(self):
         """
         Set all bits in the filter to zero.
         """
-        self._filter = 0
+        self._filter[:] = bytearray(self._m_size / 8)
 
     def __contains__(self, key):
         filter_ = self._filter
-        m_size_ = self._m_size
+        m_size = self._m_size
 
         hash_ = self._salt.copy()
         hash_.update(key)
 
         for pos in self._fmt_unpack(hash_.digest()):
-            if not filter_ & (1 << (pos % m_size_)):
+            pos %= m_size
+            if not filter_[pos >> 3] & (1 << (pos & 7)):
                 return False
         return True
 
@@ -243,10 +256,64 @@ class BloomFilter(object):
             # while generators are more memory efficient, this list will be relatively short.
             # 07/05/12 Niels: using no list at all is even more efficient/faster
             for pos in fmt_unpack(hash_.digest()):
-                if not filter_ & (1 << (pos % m_size)):
+                pos %= m_size
+                if not filter_[pos >> 3] & (1 << (pos & 7)):
                     yield tup
                     break
 
+    def not_filter_indexes(self, keys):
+        """
+        Returns a list with the indexes of all KEYS that are NOT in the bloom filter.
+
+        The digests for all KEYS are computed in one pass.  When numpy is available the k bit
+        positions of every key are gathered and tested vectorized, otherwise the bits are tested
+        one key at a time.
+        @rtype: [int]
+        """
+        assert isinstance(keys, (list, tuple)), type(keys)
+        assert all(isinstance(key, str) for key in keys)
+        if not keys:
+            return []
+
+        digests = self._get_digests(keys)
+        if numpy is None:
+            return self._not_filter_indexes_python(digests)
+        return self._not_filter_indexes_numpy(digests)
+
+    def _get_digests(self, keys):
+        salt_copy = self._salt.copy
+        digests = []
+        for key in keys:
+            hash_ = salt_copy()
+            hash_.update(key)
+            digests.append(hash_.digest())
+        return digests
+
+    def _not_filter_indexes_python(self, digests):
+        filter_ = self._filter
+        m_size = self._m_size
+        fmt_unpack = self._fmt_unpack
+
+        indexes = []
+        for index, digest in enumerate(digests):
+            for pos in fmt_unpack(digest):
+                pos %= m_size
+                if not filter_[pos >> 3] & (1 << (pos & 7)):
+                    indexes.append(index)
+                    break
+        return indexes
+
+    def _not_filter_indexes_numpy(self, digests):
+        # one row per digest, only the first k * chunk_size bytes are used, see _fmt_unpack
+        rows = numpy.frombuffer("".join(digests), dtype=numpy.uint8).reshape(len(digests), self._digest_size)
+        positions = numpy.ascontiguousarray(rows[:, :self._chunk_size * self._k_functions]).view(">u%d" % self._chunk_size)
+        # use the numpy type for the modulo, otherwise uint64 positions are promoted to float64
+        positions = positions % positions.dtype.type(self._m_size)
+
+        filter_ = numpy.frombuffer(self._filter, dtype=numpy.uint8)
+        bits = (filter_[positions >> 3] >> (positions & 7)) & 1
+        return numpy.flatnonzero(bits.min(axis=1) == 0).tolist()
+
     def get_capacity(self, f_error_rate):
         """
         Returns the capacity given a certain error rate.
@@ -271,7 +338,7 @@ class BloomFilter(object):
         The number of bits in the bloom filter that are set.
         @rtype: int
         """
-        return sum(1 if self._filter & (1 << i) else 0 for i in range(self._m_size))
+        return sum(_BITS_IN_BYTE[byte] for byte in self._filter)
 
     @property
     def size(self):
@@ -303,7 +370,109 @@ class BloomFilter(object):
         bytes as well as the number of functions are required.
         @rtype: string
         """
-        # hex should be m_size/4, hex is 16 instead of 8 -> hence half the number of "hexes" in m_size
-        hex_ = '%x' % self._filter
-        padding = '0' * (self._m_size /4 - len(hex_))
-        return unhexlify(padding + hex_)[::-1]
+        # bit POS is stored in byte POS / 8, least significant bit first, which is exactly the wire format
+        return str(self._filter)
+
+
+class CountingBloomFilter(BloomFilter):
+
+    """
+    A BloomFilter that keeps a counter for every bit, allowing keys to be removed.
+
+    The constructor takes the same arguments as BloomFilter and the bytes property still returns the
+    plain bits, i.e. a bit is set while its counter is non-zero.  Hence a CountingBloomFilter can be
+    transmitted and will be received as an ordinary BloomFilter.
+
+    Each counter is one byte.  A counter that reaches 255 is never decremented again, removing keys
+    can therefore never cause false negatives for keys that are still in the filter.  Note that only
+    keys that were added may be removed.  When the filter is constructed from bytes every set bit
+    starts with a counter of one.
+    """
+
+    def __init__(self, *args, **kargs):
+        super(CountingBloomFilter, self).__init__(*args, **kargs)
+        filter_ = self._filter
+        self._counters = bytearray(1 if filter_[pos >> 3] & (1 << (pos & 7)) else 0 for pos in xrange(self._m_size))
+
+    def add(self, key):
+        """
+        Add KEY to the CountingBloomFilter.
+        """
+        self.add_keys((key,))
+
+    def add_keys(self, keys):
+        """
+        Add a sequence of KEYS to the CountingBloomFilter.
+        """
+        filter_ = self._filter
+        counters = self._counters
+        salt_copy = self._salt.copy
+        m_size = self._m_size
+        fmt_unpack = self._fmt_unpack
+
+        for key in keys:
+            assert isinstance(key, str)
+            hash_ = salt_copy()
+            hash_.update(key)
+
+            for pos in fmt_unpack(hash_.digest()):
+                pos %= m_size
+                if counters[pos] < 255:
+                    counters[pos] += 1
+                filter_[pos >> 3] |= 1 << (pos & 7)
+
+    def remove(self, key):
+        """
+        Remove KEY from the CountingBloomFilter.
+        """
+        self.remove_keys((key,))
+
+    def remove_keys(self, keys):
+        """
+        Remove a sequence of KEYS from the CountingBloomFilter.  Each key must have been added before.
+
+        Raises ValueError when a key has a zero counter, i.e. it was certainly not added.  The keys
+        before it are removed while that key, and the keys after it, are left untouched.
+        """
+        filter_ = self._filter
+        counters = self._counters
+        salt_copy = self._salt.copy
+        m_size = self._m_size
+        fmt_unpack = self._fmt_unpack
+
+        for key in keys:
+            assert isinstance(key, str)
+            hash_ = salt_copy()
+            hash_.update(key)
+
+            positions = [pos % m_size for pos in fmt_unpack(hash_.digest())]
+            if not all(counters[pos] for pos in positions):
+                raise ValueError("removing a key that was not added")
+
+            for pos in positions:
+                count = counters[pos]
+                # saturated counters are never decremented, we no longer know the actual count.  a
+                # key can hash to the same position twice, it then also incremented it twice
+                if count < 255:
+                    counters[pos] = count - 1
+                    if count == 1:
+                        filter_[pos >> 3] &= 255 ^ (1 << (pos & 7))
+
+    def clear(self):
+        """
+        Set all bits and counters in the filter to zero.
+        """
+        super(CountingBloomFilter, self).clear()
+        self._counters[:] = bytearray(self._m_size)
+
+
+def not_filter_indexes_task(task):
+    """
+    Returns BloomFilter(BYTES, FUNCTIONS, PREFIX).not_filter_indexes(KEYS) for a (BYTES, FUNCTIONS,
+    PREFIX, KEYS) TASK tuple.
+
+    This is a module level function, hence it can be given to a multiprocessing.Pool.
+    @rtype: [int]
+    """
+    bytes_, functions, prefix, keys = task
+    return BloomFilter(bytes_, functions, prefix).not_filter_indexes(keys)
@@ -2,7 +2,9 @@
 A callback thread running Dispersy.
 """
 
-from heapq import heappush, heappop
+from bisect import bisect
+from collections import defaultdict
+from heapq import heappush, heappop, heapify
 from thread import get_ident
 from threading import Thread, Lock, Event
 from time import sleep, time
@@ -25,6 +27,247 @@ if __debug__:
     from inspect import getsourcefile, getsourcelines
 
 
+class HeapTimers(object):
+
+    """
+    Keeps the scheduled [deadline, priority, root_id, call, callback] entries of a Callback in a heap
+    ordered by deadline.
+
+    Insert and expire are O(log n).
+    """
+
+    def __init__(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, entry):
+        heappush(self._heap, entry)
+
+    def pop_expired(self, now):
+        """
+        Removes and returns all entries with a deadline at or before NOW, ordered by deadline.
+        """
+        heap = self._heap
+        expired = []
+        while heap and heap[0][0] <= now:
+            expired.append(heappop(heap))
+        return expired
+
+    def next_deadline(self):
+        """
+        Returns the earliest deadline or None when there are no entries.
+        """
+        return self._heap[0][0] if self._heap else None
+
+    def pop_all(self):
+        """
+        Removes and returns all entries, ordered by deadline.
+        """
+        entries = sorted(self._heap)
+        self._heap = []
+        return entries
+
+    def compact(self):
+        """
+        Removes all unregistered entries, i.e. entries whose call is None.
+        """
+        self._heap[:] = [entry for entry in self._heap if not entry[3] is None]
+        heapify(self._heap)
+
+
+class TimingWheelTimers(object):
+
+    """
+    Keeps the scheduled [deadline, priority, root_id, call, callback] entries of a Callback in a
+    hashed timing wheel.
+
+    The wheel has SLOTS buckets that each cover TICK seconds.  An entry is appended to the bucket
+    that covers its deadline, hence insert is O(1).  Expiring visits only the buckets that were
+    passed since the previous call, skipping the entries that are due in a later revolution.  This
+    suits the many timers that share the same few durations, such as request cache timeouts and
+    batch windows.
+
+    The earliest deadline is found through a min-heap of the ticks that have entries.  A tick is
+    only pushed when it receives its first entry and it is popped once its entries have expired,
+    hence next_deadline only looks at the bucket of the earliest tick.
+
+    The expired entries are given to the Callback, which orders them by priority, exactly as with
+    HeapTimers.
+    """
+
+    def __init__(self, tick=0.05, slots=1024):
+        assert isinstance(tick, float), type(tick)
+        assert tick > 0.0, tick
+        assert isinstance(slots, int), type(slots)
+        assert slots > 0, slots
+        self._tick = tick
+        self._slots = slots
+        self._buckets = [[] for _ in xrange(slots)]
+        self._length = 0
+        # the tick that was visited last, buckets before it have been emptied
+        self._cursor = int(time() / tick)
+        # min-heap and set of the ticks that had entries pushed, ticks whose entries have expired
+        # are removed by next_deadline
+        self._ticks = []
+        self._tick_set = set()
+
+    def __len__(self):
+        return self._length
+
+    def push(self, entry):
+        # entries that are already due are added to the bucket that will be visited next
+        tick = max(int(entry[0] / self._tick), self._cursor)
+        self._buckets[tick % self._slots].append(entry)
+        self._length += 1
+        if not tick in self._tick_set:
+            self._tick_set.add(tick)
+            heappush(self._ticks, tick)
+
+    def pop_expired(self, now):
+        """
+        Removes and returns all entries with a deadline at or before NOW, ordered by deadline.
+        """
+        if not self._length:
+            self._cursor = max(self._cursor, int(now / self._tick))
+            if self._ticks:
+                self._ticks = []
+                self._tick_set.clear()
+            return []
+
+        expired = []
+        now_tick = int(now / self._tick)
+        # after a full revolution every bucket has been visited
+        for tick in xrange(self._cursor, min(now_tick, self._cursor + self._slots - 1) + 1):
+            bucket = self._buckets[tick % self._slots]
+            if bucket:
+                remaining = []
+                for entry in bucket:
+                    if entry[0] <= now:
+                        expired.append(entry)
+                    else:
+                        remaining.append(entry)
+                if len(remaining) < len(bucket):
+                    self._buckets[tick % self._slots] = remaining
+        # the bucket of NOW_TICK may still contain entries later in this tick, hence it is visited again
+        self._cursor = max(self._cursor, now_tick)
+
+        self._length -= len(expired)
+        if not self._length:
+            self._ticks = []
+            self._tick_set.clear()
+        expired.sort()
+        return expired
+
+    def next_deadline(self):
+        """
+        Returns the earliest deadline or None when there are no entries.
+        """
+        if not self._length:
+            return None
+
+        # the earliest tick that still has entries contains the earliest deadline.  its bucket may
+        # also contain entries of later revolutions, these have a later tick, see push
+        ticks = self._ticks
+        while ticks:
+            tick = ticks[0]
+            deadlines = [entry[0] for entry in self._buckets[tick % self._slots] if int(entry[0] / self._tick) <= tick]
+            if deadlines:
+                return min(deadlines)
+            self._tick_set.remove(heappop(ticks))
+
+        assert False, "every entry belongs to a tick in _ticks"
+        return None
+
+    def pop_all(self):
+        """
+        Removes and returns all entries, ordered by deadline.
+        """
+        entries = sorted(entry for bucket in self._buckets for entry in bucket)
+        self._buckets = [[] for _ in xrange(self._slots)]
+        self._length = 0
+        self._ticks = []
+        self._tick_set.clear()
+        return entries
+
+    def compact(self):
+        """
+        Removes all unregistered entries, i.e. entries whose call is None.
+        """
+        self._buckets = [[entry for entry in bucket if not entry[3] is None] for bucket in self._buckets]
+        self._length = sum(len(bucket) for bucket in self._buckets)
+
+
+class TaskStatistic(object):
+
+    """
+    Histograms of the run time and the scheduling lag, i.e. the actual start minus the deadline, of
+    the calls made to one task.
+    """
+
+    # upper bounds, in seconds, of all but the last histogram bucket
+    BUCKETS = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self):
+        self._count = 0
+        self._duration = 0.0
+        self._lag = 0.0
+        self._duration_histogram = [0] * (len(self.BUCKETS) + 1)
+        self._lag_histogram = [0] * (len(self.BUCKETS) + 1)
+
+    def increment(self, duration, lag):
+        " Add one call that took DURATION seconds and started LAG seconds after its deadline. "
+        self._count += 1
+        self._duration += duration
+        self._lag += lag
+        self._duration_histogram[bisect(self.BUCKETS, duration)] += 1
+        self._lag_histogram[bisect(self.BUCKETS, lag)] += 1
+
+    def get_dict(self, **kargs):
+        " Returns a dictionary with the statistics. "
+        return dict(count=self._count,
+                    duration=self._duration,
+                    average=self._duration / self._count if self._count else 0.0,
+                    lag=self._lag,
+                    average_lag=self._lag / self._count if self._count else 0.0,
+                    duration_histogram=list(self._duration_histogram),
+                    lag_histogram=list(self._lag_histogram),
+                    **kargs)
+
+
+class CallWaiter(object):
+
+    """
+    Receives the result of a Callback.call.
+
+    Callback reuses its waiters, avoiding the creation of a new Event and result container for every
+    call.
+    """
+
+    __slots__ = ("event", "result", "exception", "exc_info")
+
+    def __init__(self):
+        self.event = Event()
+        self.reset()
+
+    def reset(self):
+        self.event.clear()
+        self.result = None
+        self.exception = None
+        self.exc_info = None
+
+    def set_result(self, result):
+        if isinstance(result, Exception):
+            self.exception = result
+            self.exc_info = exc_info()
+
+        else:
+            self.result = result
+
+        self.event.set()
+
+
 class Callback(object):
     if __debug__:
         @staticmethod
@@ -54,12 +297,35 @@ class Callback(object):
             else:
                 return "%s@%s:%d" % (call.__name__, source_file, line_number)
 
-    def __init__(self, name="Generic-Callback"):
+    def __init__(self, name="Generic-Callback", timers=HeapTimers, drain_size=1, drain_duration=0.05):
+        """
+        Create a new, not yet started, Callback thread.
+
+        TIMERS is called to create the container for the delayed calls, either HeapTimers or
+        TimingWheelTimers (or a partial of the latter to choose its tick and number of slots).
+
+        DRAIN_SIZE is the maximum number of expired calls that are taken at once and handled back to
+        back, i.e. without acquiring the lock or checking for newly expired calls in between.  This
+        reduces the overhead of many small calls, for instance during a packet storm.  A drain stops
+        early once it takes longer than DRAIN_DURATION seconds, after which the remaining calls are
+        handled in priority order with any calls that expired in the meantime.  Note that calls
+        registered during a drain, regardless of their priority, wait until the drain ends.  The
+        default DRAIN_SIZE of one handles every call in strict priority order.
+        """
         assert isinstance(name, str), type(name)
+        assert callable(timers), type(timers)
+        assert isinstance(drain_size, int), type(drain_size)
+        assert drain_size > 0, drain_size
+        assert isinstance(drain_duration, float), type(drain_duration)
+        assert drain_duration >= 0.0, drain_duration
 
         # _name will be given to the thread when it is started
         self._name = name
 
+        # _drain_size and _drain_duration limit the expired calls that are handled at once
+        self._drain_size = drain_size
+        self._drain_duration = drain_duration
+
         # _event is used to wakeup the thread when new actions arrive
         self._event = Event()
         self._event_set = self._event.set
@@ -104,13 +370,43 @@ class Callback(object):
         self._id = 0
 
         # _requests are ordered by deadline and moved to -expired- when they need to be handled
-        # (deadline, priority, root_id, (call, args, kargs), callback)
-        self._requests = []
+        # [deadline, priority, root_id, (call, args, kargs), callback]
+        self._timers = timers
+        self._requests = timers()
 
         # expired requests are ordered and handled by priority
-        # (priority, deadline, root_id, (call, args, kargs), callback)
+        # [priority, deadline, root_id, (call, args, kargs), callback]
         self._expired = []
 
+        # _index contains, for every root_id, the entries in _requests and _expired that have not
+        # been handled yet.  the entries are lists, hence unregister can replace the call and
+        # callback of an entry with None without locating it in the heap.  it is protected by _lock
+        self._index = {}
+
+        # _tombstones contains the number of unregistered entries that are still in _requests and
+        # _expired.  the heaps are compacted when these make up the majority of all entries.  it is
+        # protected by _lock
+        self._tombstones = 0
+
+        # _draining contains the entries taken from _expired by _take_tasks that _handle_tasks did
+        # not finish yet.  these are in neither heap, hence unregistering them does not make
+        # tombstones.  it is protected by _lock
+        self._draining = []
+
+        # _sleep_deadline is the time until which the thread waits for new tasks.  it is protected
+        # by _lock
+        self._sleep_deadline = 0.0
+
+        # _task_statistics contains a TaskStatistic per function name, while _max_requests and
+        # _max_expired contain the largest number of entries seen in _requests and _expired.  these
+        # are only written to on the callback thread
+        self._task_statistics = defaultdict(TaskStatistic)
+        self._max_requests = 0
+        self._max_expired = 0
+
+        # _waiters contains the CallWaiter instances that are available for reuse by call(...)
+        self._waiters = []
+
         # _requests_mirror and _expired_mirror contains the same list as _requests and _expired,
         # respectively.  when the callback closes _requests is set to a new empty list while
         # _requests_mirror continues to point to the existing one.  because all task 'deletes' are
@@ -197,6 +493,19 @@ class Callback(object):
             assert func in self._exception_handlers, "handler is not attached"
             self._exception_handlers.remove(func)
 
+    def handle_exception(self, exception, fatal=False):
+        """
+        Give EXCEPTION, raised by code that the Callback runs on behalf of others, to the attached
+        exception handlers.
+
+        This is what happens when a registered call raises EXCEPTION.  When FATAL is True, or when
+        any of the exception handlers returns True, the Callback thread will exit.  This method is
+        thread safe.
+        """
+        assert isinstance(exception, BaseException), type(exception)
+        assert isinstance(fatal, bool), type(fatal)
+        self._call_exception_handlers(exception, fatal)
+
     def _call_exception_handlers(self, exception, fatal):
         with self._lock:
             exception_handlers = self._exception_handlers[:]
@@ -218,6 +527,8 @@ class Callback(object):
                 if self._state == "STATE_RUNNING":
                     self._state = "STATE_PLEASE_STOP"
                     logger.debug("STATE_PLEASE_STOP")
+                    # handle_exception may be called from another thread
+                    self._wake_up()
 
                     if fatal:
                         logger.warning("attempting proper shutdown [%s]", exception)
@@ -294,23 +605,9 @@ class Callback(object):
                 self._id += 1
                 id_ = u"dispersy-#%d" % self._id
 
-            new_task_deadline = time() + delay
-            if delay <= 0.0:
-                heappush(self._expired,
-                         (-priority,
-                          new_task_deadline,
-                          id_,
-                          (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                          None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-            else:
-                heappush(self._requests,
-                         (new_task_deadline,
-                          - priority,
-                          id_,
-                          (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                          None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-
-            self._wake_up_if(new_task_deadline)
+            self._push(delay, priority, id_,
+                       (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
+                       None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs))
             return id_
 
     def persistent_register(self, id_, call, args=(), kargs=None, delay=0.0, priority=0, callback=None, callback_args=(), callback_kargs=None, include_id=False):
@@ -343,36 +640,10 @@ class Callback(object):
         logger.debug("persistent register %s after %.2f seconds", call, delay)
 
         with self._lock:
-            for tup in self._requests:
-                if tup[2] == id_:
-                    break
-
-            else:
-                # not found in requests
-                for tup in self._expired:
-                    if tup[2] == id_:
-                        break
-
-                else:
-                    # not found in expired
-                    new_task_deadline = time() + delay
-                    if delay <= 0.0:
-                        heappush(self._expired,
-                                 (-priority,
-                                  new_task_deadline,
-                                  id_,
-                                  (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                                  None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-
-                    else:
-                        heappush(self._requests,
-                                 (new_task_deadline,
-                                  - priority,
-                                  id_,
-                                  (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                                  None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-
-                    self._wake_up_if(new_task_deadline)
+            if not any(not entry[3] is None for entry in self._index.get(id_, ())):
+                self._push(delay, priority, id_,
+                           (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
+                           None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs))
 
             return id_
 
@@ -398,41 +669,88 @@ class Callback(object):
 
         with self._lock:
             # un-register
-            for index, tup in enumerate(self._requests_mirror):
-                if tup[2] == id_:
-                    self._requests_mirror[index] = (tup[0], tup[1], id_, None, None)
-                    logger.debug("unregistered %s from _requests", id_)
-
-            for index, tup in enumerate(self._expired_mirror):
-                if tup[2] == id_:
-                    self._expired_mirror[index] = (tup[0], tup[1], id_, None, None)
-                    logger.debug("unregistered %s from _expired", id_)
+            self._remove(id_)
 
             # register
-            new_task_deadline = time() + delay
-            if delay <= 0.0:
-                heappush(self._expired,
-                         (-priority,
-                          new_task_deadline,
-                          id_,
-                          (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                          None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
+            self._push(delay, priority, id_,
+                       (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
+                       None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs))
+            return id_
+
+    def _push(self, delay, priority, id_, call, callback):
+        """
+        Schedule CALL after DELAY seconds.  Must be called while holding _lock.
+        """
+        new_task_deadline = time() + delay
+        if delay <= 0.0:
+            entry = [-priority, new_task_deadline, id_, call, callback]
+            heappush(self._expired, entry)
+        else:
+            entry = [new_task_deadline, -priority, id_, call, callback]
+            self._requests.push(entry)
+        self._index.setdefault(id_, []).append(entry)
+        self._wake_up_if(new_task_deadline)
+
+    def _push_entry(self, heap, entry):
+        """
+        Push ENTRY, that is either handled or moved from _requests to _expired, onto HEAP.  Must be
+        called while holding _lock.
+        """
+        if isinstance(heap, list):
+            heappush(heap, entry)
+        else:
+            heap.push(entry)
+        self._index.setdefault(entry[2], []).append(entry)
 
+    def _unindex_entry(self, entry):
+        """
+        Remove ENTRY, that was removed from _requests or _expired, from _index.  Must be called while
+        holding _lock.
+        """
+        if entry[3] is None:
+            if self._tombstones:
+                self._tombstones -= 1
+        else:
+            entries = self._index[entry[2]]
+            if len(entries) == 1:
+                del self._index[entry[2]]
             else:
-                heappush(self._requests,
-                         (new_task_deadline,
-                          - priority,
-                          id_,
-                          (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                          None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-                
-            self._wake_up_if(new_task_deadline)
-            return id_
-        
+                # remove by identity, entries with equal values may exist
+                for index, other in enumerate(entries):
+                    if other is entry:
+                        del entries[index]
+                        break
+        return entry
+
+    def _remove(self, id_):
+        """
+        Replace the call and callback of all entries registered with ID_ with None.  Must be called
+        while holding _lock.
+        """
+        entries = self._index.pop(id_, None)
+        if entries:
+            for entry in entries:
+                entry[3] = entry[4] = None
+            # entries that are being drained are no longer in the heaps, see _handle_tasks
+            draining = self._draining
+            self._tombstones += sum(1 for entry in entries if not any(other is entry for other in draining))
+            logger.debug("unregistered %d entries for %s", len(entries), id_)
+
+            # compact the heaps once most entries are unregistered, the mirrors are modified in
+            # place because they may be different lists than _requests and _expired after shutdown
+            if self._tombstones > 64 and 2 * self._tombstones > len(self._requests_mirror) + len(self._expired_mirror):
+                self._requests_mirror.compact()
+                self._expired_mirror[:] = [entry for entry in self._expired_mirror if not entry[3] is None]
+                heapify(self._expired_mirror)
+                self._tombstones = 0
+
+    def _wake_up(self):
+        # wakeup the thread regardless of its deadline, always called while holding _lock
+        self._event.set()
+
     def _wake_up_if(self, new_task_deadline):
-        # wakeup if sleeping, if prev_deadline is larger -> if no requests then we scheduled an expired task 
-        first_request_deadline = self._requests[0][0] if self._requests else new_task_deadline + 1
-        if new_task_deadline <= first_request_deadline: 
+        # wakeup if the thread is sleeping past the new deadline
+        if new_task_deadline <= self._sleep_deadline:
             if not self._event_is_set():
                 self._event_set()
 
@@ -445,18 +763,9 @@ class Callback(object):
         logger.debug("unregister %s", id_)
 
         with self._lock:
-            # un-register
-            for index, tup in enumerate(self._requests_mirror):
-                if tup[2] == id_:
-                    self._requests_mirror[index] = (tup[0], tup[1], id_, None, None)
-                    logger.debug("unregistered %s from _requests", id_)
-
-            for index, tup in enumerate(self._expired_mirror):
-                if tup[2] == id_:
-                    self._expired_mirror[index] = (tup[0], tup[1], id_, None, None)
-                    logger.debug("unregistered %s from _expired", id_)
+            self._remove(id_)
 
-    def call(self, call, args=(), kargs=None, priority=0, id_=u"", include_id=False, timeout=0.0, default=None):
+    def call(self, call, args=(), kargs=None, priority=0, id_=u"", include_id=False, timeout=0.0, default=None, direct=False):
         """
         Register a blocking CALL to be made, waits for the call to finish, and returns or raises the
         result.
@@ -468,34 +777,47 @@ class Callback(object):
         DEFAULT can be anything.  The DEFAULT value is returned when a TIMEOUT occurs.  Note: as of 24/05/13 when
         DEFAULT is an Exception instance it will no longer be raised.
 
+        When DIRECT is True and call is made from the callback thread, CALL is made immediately
+        instead of being registered and handled in priority order with the other expired calls.
+        When CALL returns a generator, the generator is registered and handled as usual.
+
         For the arguments CALL, ARGS, KARGS, PRIORITY, ID_, and INCLUDE_ID: see the register(...) method.
         """
         assert isinstance(timeout, float)
         assert 0.0 <= timeout
+        assert isinstance(direct, bool), type(direct)
         assert self._thread_ident
 
-        def callback(result):
-            if isinstance(result, Exception):
-                container[1] = result
-                container[2] = exc_info()
-
-            else:
-                container[0] = result
-
-            event.set()
-
-        # result container with [RETURN-VALUE, EXCEPTION-INSTANCE, EXC_INFO-TUPLE]
-        container = [default, None, None]
-        event = Event()
+        if direct and self._thread_ident == get_ident():
+            if include_id:
+                if not id_:
+                    with self._lock:
+                        self._id += 1
+                        id_ = u"dispersy-#%d" % self._id
+                args = args + (id_,)
+            result = call(*args, **({} if kargs is None else kargs))
+            if not isinstance(result, GeneratorType):
+                return result
+
+            # the generator has not started yet, register it as if CALL returned it on the callback
+            # thread
+            call, args, kargs, include_id = (lambda: result), (), None, False
+
+        # obtain a waiter, these are reused to avoid creating an Event for every call
+        try:
+            waiter = self._waiters.pop()
+        except IndexError:
+            waiter = CallWaiter()
+        waiter.result = default
 
         # register the call
-        self.register(call, args, kargs, 0.0, priority, id_, callback, include_id=include_id)
+        self.register(call, args, kargs, 0.0, priority, id_, waiter.set_result, include_id=include_id)
 
         if self._thread_ident == get_ident():
             begin = time()
             while self._one_task():
                 # detect if call has finished
-                if event.is_set():
+                if waiter.event.is_set():
                     break
 
                 # detect timeout
@@ -506,23 +828,45 @@ class Callback(object):
 
         else:
             # wait for call to finish
-            event.wait(None if timeout == 0.0 else timeout)
-            if not event.is_set():
-                # starting Python 2.7 event.wait returns False on timeout while older versions
-                # always return None.  Once Dispersy requires Python 2.7 we should use the return
-                # value of event.wait instead of calling event.is_set.
+            if not waiter.event.wait(None if timeout == 0.0 else timeout):
                 logger.warning("timeout %.2fs occurred during call to %s", timeout, call)
 
-        if container[1]:
-            if container[2][0] is None:
-                raise container[1]
+        result, exception, exception_info = waiter.result, waiter.exception, waiter.exc_info
+        if waiter.event.is_set():
+            # the call is finished, hence the waiter will no longer be used by the registered task
+            waiter.reset()
+            self._waiters.append(waiter)
+
+        if exception:
+            if exception_info[0] is None:
+                raise exception
 
             else:
-                type_, value, traceback = container[2]
+                type_, value, traceback = exception_info
                 raise type_, value, traceback
 
         else:
-            return container[0]
+            return result
+
+    def call_many(self, calls, priority=0, timeout=0.0, default=None):
+        """
+        Make all CALLS, a list containing (call, args, kargs) tuples, one after the other in a single
+        blocking call, and return a list with their results.
+
+        Handing over several calls at once avoids waiting for the callback thread for each call
+        individually.  When a call raises an exception the remaining calls are not made and the
+        exception is raised.  Generators are not resumed, the generator object is returned instead.
+
+        For the arguments PRIORITY, TIMEOUT, and DEFAULT: see the call(...) method.
+        """
+        assert isinstance(calls, (tuple, list)), type(calls)
+        assert all(isinstance(tup, tuple) and len(tup) == 3 for tup in calls), calls
+        assert all(callable(call) for call, _, _ in calls), calls
+        return self.call(self._call_many, (calls,), priority=priority, timeout=timeout, default=default)
+
+    @staticmethod
+    def _call_many(calls):
+        return [call(*args, **({} if kargs is None else kargs)) for call, args, kargs in calls]
 
     def start(self, wait=True):
         """
@@ -567,7 +911,7 @@ class Callback(object):
                 logger.debug("STATE_PLEASE_STOP")
 
                 # wakeup if sleeping
-                self._event.set()
+                self._wake_up()
 
             else:
                 do_stop = False
@@ -602,115 +946,219 @@ class Callback(object):
         self._thread.join(None if timeout == 0.0 else timeout)
         return self.is_finished
 
-    @attach_runtime_statistics(u"{0.__class__.__name__}.{function_name} {return_value}")    
+    def get_statistics(self):
+        """
+        Returns a dictionary with the current and the largest number of delayed (requests) and
+        expired calls, and TASKS: a list (in no particular order) containing the
+        TaskStatistic.get_dict() dictionary of each function name, given as ENTRY.
+        """
+        return dict(requests=len(self._requests),
+                    expired=len(self._expired),
+                    max_requests=self._max_requests,
+                    max_expired=self._max_expired,
+                    tasks=[statistic.get_dict(entry=entry) for entry, statistic in self._task_statistics.items()])
+
+    def reset_statistics(self):
+        self._task_statistics = defaultdict(TaskStatistic)
+        self._max_requests = 0
+        self._max_expired = 0
+
+    @attach_runtime_statistics(u"{0.__class__.__name__}.{function_name} {return_value}")
     def _one_task(self):
         actual_time = time()
+        result = self._take_tasks(actual_time)
+        if result is False:
+            # break
+            return False
 
+        tasks, wait, debug_call_name = result
+        if wait:
+            logger.debug("wait at most %.3fs before next call, still have %d calls in queue", wait, len(self._requests))
+            self._event.wait(wait)
+
+        elif tasks:
+            self._handle_tasks(tasks, actual_time)
+
+        return debug_call_name or True
+
+    def _take_tasks(self, actual_time):
+        """
+        Returns the (tasks, wait, debug_call_name) tuple, where TASKS are the expired entries that
+        must be handled and WAIT is the time until the next deadline when there are none, or False
+        when the thread must stop.
+        """
         with self._lock:
             # check if we should continue to run
             if self._state != "STATE_RUNNING":
-                # break
                 return False
 
             # move expired requests from self._REQUESTS to self._EXPIRED
-            while self._requests and self._requests[0][0] <= actual_time:
+            for entry in self._requests.pop_expired(actual_time):
                 # notice that the deadline and priority entries are switched, hence, the entries in
                 # the self._EXPIRED list are ordered by priority instead of deadline
-                deadline, priority, root_id, call, callback = heappop(self._requests)
-                heappush(self._expired, (priority, deadline, root_id, call, callback))
+                self._unindex_entry(entry)
+                if not entry[3] is None:
+                    deadline, priority, root_id, call, callback = entry
+                    self._push_entry(self._expired, [priority, deadline, root_id, call, callback])
+
+            # queue depth gauges
+            if len(self._requests) > self._max_requests:
+                self._max_requests = len(self._requests)
+            if len(self._expired) > self._max_expired:
+                self._max_expired = len(self._expired)
 
             if self._expired:
-                # we need to handle the next call in line
-                priority, deadline, root_id, call, callback = heappop(self._expired)
+                # we need to handle the next calls in line, up to _drain_size at once.  these remain
+                # in _index until they are handled, allowing them to be unregistered by the calls
+                # that are handled before them
+                tasks = []
+                while self._expired and len(tasks) < self._drain_size:
+                    entry = heappop(self._expired)
+                    # ignore removed tasks
+                    if entry[3] is None:
+                        if self._tombstones:
+                            self._tombstones -= 1
+                    else:
+                        tasks.append(entry)
+                self._draining = tasks
                 wait = 0.0
 
-                if __debug__:
-                    debug_call_name = self._debug_call_to_string(call)
+                if __debug__ and tasks:
+                    debug_call_name = self._debug_call_to_string(tasks[0][3])
                 else:
                     debug_call_name = None
 
-                # ignore removed tasks
-                if call is None:
-                    # continue
-                    return True
-
             else:
+                tasks = []
                 debug_call_name = 'Nothing to handle'
-                
+
                 # there is nothing to handle
-                wait = self._requests[0][0] - actual_time if self._requests else 300.0
+                next_deadline = self._requests.next_deadline()
+                wait = 300.0 if next_deadline is None else max(next_deadline - actual_time, 0.001)
                 if __debug__:
                     logger.debug("nothing to handle, wait %.2f seconds", wait)
 
+            # until _sleep_deadline new tasks will wake up the thread
+            self._sleep_deadline = actual_time + wait if wait else 0.0
+
             if self._event.is_set():
                 self._event.clear()
 
-        if wait:
-            logger.debug("wait at most %.3fs before next call, still have %d calls in queue", wait, len(self._requests))
-            self._event.wait(wait)
+        return tasks, wait, debug_call_name
+
+    def _handle_tasks(self, tasks, actual_time):
+        """
+        Handle the expired TASKS, obtained from _take_tasks, back to back.
+        """
+        # give newly expired and higher priority tasks a chance once the drain takes longer than
+        # _drain_duration
+        drain_deadline = actual_time + self._drain_duration
+        handled = []
+        for index, entry in enumerate(tasks):
+            if index and (self._state != "STATE_RUNNING" or time() > drain_deadline):
+                break
+
+            priority, deadline, root_id, call, callback = entry
+            if call is None:
+                # unregistered by a previous task
+                continue
+
+            # the entry is no longer pending, hence it can no longer be unregistered and a
+            # persistent_register for ROOT_ID will succeed
+            entry[3] = entry[4] = None
+            handled.append(entry)
+            self._run_task(priority, deadline, root_id, call, callback, actual_time)
 
         else:
-            if __debug__:
-                logger.debug("---- call %s (priority:%d, id:%s)", debug_call_name, priority, root_id)
-                debug_call_start = time()
+            index = len(tasks)
 
-            # call can be either:
-            # 1. a generator
-            # 2. a (callable, args, kargs) tuple
+        with self._lock:
+            # _remove did not count the drained entries as tombstones, hence neither the skipped nor
+            # the HANDLED entries change the count.  the HANDLED entries may still be in _index
+            self._draining = []
+            for entry in handled:
+                entries = self._index.get(entry[2])
+                if entries and any(other is entry for other in entries):
+                    if len(entries) == 1:
+                        del self._index[entry[2]]
+                    else:
+                        entries[:] = [other for other in entries if not other is entry]
 
-            try:
-                if isinstance(call, TupleType):
-                    # callback
-                    result = call[0](*call[1], **call[2])
-                    if isinstance(result, GeneratorType):
-                        # we only received the generator, no actual call has been made to the
-                        # function yet, therefore we call it again immediately
-                        call = result
+            # the remaining tasks are still indexed, unless they were unregistered during the drain
+            # in which case they are tombstones once they are back in _expired
+            for entry in tasks[index:]:
+                if entry[3] is None:
+                    self._tombstones += 1
+                heappush(self._expired, entry)
 
-                    elif callback:
-                        with self._lock:
-                            heappush(self._expired, (priority, actual_time, root_id, (callback[0], (result,) + callback[1], callback[2]), None))
-
-                if isinstance(call, GeneratorType):
-                    # start next generator iteration
-                    result = call.next()
-                    assert isinstance(result, float), [type(result), call]
-                    assert result >= 0.0, [result, call]
-                    with self._lock:
-                        heappush(self._requests, (time() + result, priority, root_id, call, callback))
+    def _run_task(self, priority, deadline, root_id, call, callback, actual_time):
+        """
+        Handle one expired CALL that was due at DEADLINE.
+        """
+        if __debug__:
+            debug_call_name = self._debug_call_to_string(call)
+            logger.debug("---- call %s (priority:%d, id:%s)", debug_call_name, priority, root_id)
 
-            except StopIteration:
-                if callback:
+        statistic = self._task_statistics[getattr(call[0] if isinstance(call, TupleType) else call, "__name__", "<unknown>")]
+        call_start = time()
+
+        # call can be either:
+        # 1. a generator
+        # 2. a (callable, args, kargs) tuple
+
+        try:
+            if isinstance(call, TupleType):
+                # callback
+                result = call[0](*call[1], **call[2])
+                if isinstance(result, GeneratorType):
+                    # we only received the generator, no actual call has been made to the
+                    # function yet, therefore we call it again immediately
+                    call = result
+
+                elif callback:
                     with self._lock:
-                        heappush(self._expired, (priority, actual_time, root_id, (callback[0], (None,) + callback[1], callback[2]), None))
+                        self._push_entry(self._expired, [priority, actual_time, root_id, (callback[0], (result,) + callback[1], callback[2]), None])
 
-            except (SystemExit, KeyboardInterrupt, GeneratorExit) as exception:
-                logger.exception("fatal exception occurred [%s]", exception)
-                self._call_exception_handlers(exception, True)
+            if isinstance(call, GeneratorType):
+                # start next generator iteration
+                result = call.next()
+                assert isinstance(result, float), [type(result), call]
+                assert result >= 0.0, [result, call]
+                with self._lock:
+                    self._push_entry(self._requests, [time() + result, priority, root_id, call, callback])
+
+        except StopIteration:
+            if callback:
+                with self._lock:
+                    self._push_entry(self._expired, [priority, actual_time, root_id, (callback[0], (None,) + callback[1], callback[2]), None])
 
-            except Exception as exception:
-                logger.exception("non-fatal exception occurred [%s]", exception)
+        except (SystemExit, KeyboardInterrupt, GeneratorExit) as exception:
+            logger.exception("fatal exception occurred [%s]", exception)
+            self._call_exception_handlers(exception, True)
 
-                if callback:
-                    with self._lock:
-                        heappush(self._expired_mirror, (priority, actual_time, root_id, (callback[0], (exception,) + callback[1], callback[2]), None))
+        except Exception as exception:
+            logger.exception("non-fatal exception occurred [%s]", exception)
 
-                self._call_exception_handlers(exception, False)
+            if callback:
+                with self._lock:
+                    self._push_entry(self._expired_mirror, [priority, actual_time, root_id, (callback[0], (exception,) + callback[1], callback[2]), None])
 
-            if __debug__:
-                debug_call_duration = time() - debug_call_start
-                if debug_call_duration > 1.0:
-                    logger.warning("%.2f call %s (priority:%d, id:%s)", debug_call_duration, debug_call_name, priority, root_id)
-                else:
-                    logger.debug("%.2f call %s (priority:%d, id:%s)", debug_call_duration, debug_call_name, priority, root_id)
+            self._call_exception_handlers(exception, False)
 
-        return debug_call_name or True
+        call_duration = time() - call_start
+        statistic.increment(call_duration, call_start - deadline)
+
+        if __debug__:
+            if call_duration > 1.0:
+                logger.warning("%.2f call %s (priority:%d, id:%s)", call_duration, debug_call_name, priority, root_id)
+            else:
+                logger.debug("%.2f call %s (priority:%d, id:%s)", call_duration, debug_call_name, priority, root_id)
 
     def _shutdown(self):
         with self._lock:
             # allowing us to refuse any new tasks.  _requests_mirror and _expired_mirror will still
             # allow tasks to be removed
-            self._requests = []
+            self._requests = self._timers()
             self._expired = []
 
         # call all expired tasks and send GeneratorExit exceptions to expired generators, note that
@@ -751,8 +1199,7 @@ class Callback(object):
 
         # send GeneratorExit exceptions to scheduled generators
         logger.debug("there are %d scheduled tasks at shutdown", len(self._requests_mirror))
-        while self._requests_mirror:
-            _, _, _, call, callback = heappop(self._requests_mirror)
+        for _, _, _, call, callback in self._requests_mirror.pop_all():
             if isinstance(call, GeneratorType):
                 logger.debug("raise Shutdown in %s", call)
                 try:
@@ -9,13 +9,14 @@ Community instance.
 """
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
+from hashlib import sha1
 from itertools import islice, groupby
 from math import ceil
 from random import random, Random, randint, shuffle
 from time import time
 
 from .authentication import NoAuthentication, MemberAuthentication, DoubleMemberAuthentication
-from .bloomfilter import BloomFilter
+from .bloomfilter import BloomFilter, CountingBloomFilter, not_filter_indexes_task
 from .candidate import Candidate, WalkCandidate, BootstrapCandidate, LoopbackCandidate
 from .conversion import BinaryConversion, DefaultConversion, Conversion
 from .decorator import runtime_duration_warning, attach_runtime_statistics
@@ -23,7 +24,7 @@ from .destination import CommunityDestination, CandidateDestination
 from .distribution import SyncDistribution, GlobalTimePruning, LastSyncDistribution, DirectDistribution, FullSyncDistribution
 from .exception import ConversionNotFoundException, MetaNotFoundException
 from .logger import get_logger, deprecated
-from .member import DummyMember, Member
+from .member import DummyMember, Member, verify_packet_task
 from .message import (BatchConfiguration, Message, Packet, DropMessage, DelayMessageByProof,
                       DelayMessageByMissingMessage, DropPacket, DelayPacket, DelayMessage)
 from .payload import (AuthorizePayload, RevokePayload, UndoPayload, DestroyCommunityPayload, DynamicSettingsPayload,
@@ -54,6 +55,280 @@ class SyncCache(object):
         self.responses_received = 0
         self.candidate = None
 
+
+class SyncBloomFilterManager(object):
+
+    """
+    Keeps the sync bloom filters for the most recently claimed global time ranges (all using modulo 1).
+
+    Stored messages are added to every filter whose range they fall in, hence a filter can be claimed
+    again without selecting and hashing its packets.  Undone and pruned messages are removed from
+    every CountingBloomFilter whose range they fall in, see
+    Community.dispersy_sync_bloom_filter_counting_enable.  Any other filter is discarded when an undo
+    or pruning event invalidates its range, as is a filter that exceeds its capacity.  A discarded
+    range will be selected from the database again when it is claimed next.
+    """
+
+    def __init__(self, max_filters, capacity):
+        assert isinstance(max_filters, int), type(max_filters)
+        assert 0 <= max_filters, max_filters
+        assert isinstance(capacity, int), type(capacity)
+        self._max_filters = max_filters
+        self._capacity = capacity
+        # list with [time_low, time_high, bloom_filter, size] entries, oldest first
+        self._entries = []
+
+    def __contains__(self, bloom_filter):
+        return any(entry[2] is bloom_filter for entry in self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, global_time):
+        """
+        Returns the (time_low, time_high, bloom_filter) whose range contains GLOBAL_TIME or None.
+        """
+        for time_low, time_high, bloom_filter, _ in self._entries:
+            if time_low <= global_time <= time_high:
+                return time_low, time_high, bloom_filter
+        return None
+
+    def add(self, time_low, time_high, bloom_filter, size):
+        """
+        Add BLOOM_FILTER, containing SIZE keys for the range [TIME_LOW:TIME_HIGH].
+
+        Previously added filters that overlap this range are discarded.
+        """
+        assert time_low <= time_high, [time_low, time_high]
+        if self._max_filters and size <= self._capacity:
+            self.invalidate(time_low, time_high)
+            self._entries.append([time_low, time_high, bloom_filter, size])
+            if len(self._entries) > self._max_filters:
+                del self._entries[0]
+
+    def store(self, global_time, key):
+        """
+        Add KEY, belonging to a message with GLOBAL_TIME, to every filter whose range contains it.
+        """
+        for entry in self._entries:
+            if entry[0] <= global_time <= entry[1]:
+                entry[2].add(key)
+                entry[3] += 1
+
+        # a filter that contains more keys than its capacity has an unacceptable error rate
+        self._entries = [entry for entry in self._entries if entry[3] <= self._capacity]
+
+    def remove(self, global_time, key):
+        """
+        Remove KEY, belonging to a message with GLOBAL_TIME, from every filter whose range contains it.
+
+        Filters that do not support removing keys, or that do not contain KEY, are discarded
+        instead.
+        """
+        entries = []
+        for entry in self._entries:
+            if entry[0] <= global_time <= entry[1]:
+                if not isinstance(entry[2], CountingBloomFilter):
+                    continue
+                try:
+                    entry[2].remove(key)
+                except ValueError:
+                    # the filter does not match the database, select its range again when claimed
+                    logger.warning("discarding sync bloom filter [%d:%d] that is missing a removed key", entry[0], entry[1])
+                    continue
+                entry[3] -= 1
+            entries.append(entry)
+        self._entries = entries
+
+    def overlaps(self, time_low, time_high):
+        """
+        Returns True when any filter range overlaps [TIME_LOW:TIME_HIGH].
+        """
+        return any(not (entry[1] < time_low or time_high < entry[0]) for entry in self._entries)
+
+    def invalidate(self, time_low, time_high):
+        """
+        Discard every filter whose range overlaps [TIME_LOW:TIME_HIGH].
+        """
+        self._entries = [entry for entry in self._entries if entry[1] < time_low or time_high < entry[0]]
+
+    def clear(self):
+        """
+        Discard all filters.
+        """
+        self._entries = []
+
+
+class SyncKeyIndex(object):
+
+    """
+    Keeps the global times of the packets in the sync table for the most recently used members.
+
+    The sync table has a UNIQUE(community, member, global_time) constraint.  The global times of a
+    member are selected once, when it is first looked up, after which a (member, global_time) pair
+    that is not in the index is definitely new.  Stored packets are added by Dispersy._store.
+    Packets that are removed, e.g. by pruning or by the LastSyncDistribution, may remain in the
+    index, hence a hit must be confirmed by the database.
+    """
+
+    def __init__(self, max_members, select):
+        """
+        @param max_members: the number of members whose global times are kept, zero disables the index
+        @type max_members: int
+
+        @param select: called with a member database id, returns the global times of its packets
+        @type select: callable
+        """
+        assert isinstance(max_members, int), type(max_members)
+        assert 0 <= max_members, max_members
+        assert callable(select), select
+        self._max_members = max_members
+        self._select = select
+        # member:set(global_time) pairs, least recently used first
+        self._members = OrderedDict()
+
+    def __len__(self):
+        return len(self._members)
+
+    def may_contain(self, member_database_id, global_time):
+        """
+        Returns False when there is definitely no packet for MEMBER_DATABASE_ID at GLOBAL_TIME.
+        """
+        if not self._max_members:
+            return True
+
+        global_times = self._members.pop(member_database_id, None)
+        if global_times is None:
+            global_times = set(self._select(member_database_id))
+            if len(self._members) >= self._max_members:
+                self._members.popitem(last=False)
+        self._members[member_database_id] = global_times
+        return global_time in global_times
+
+    def store(self, member_database_id, global_time):
+        """
+        Add a packet for MEMBER_DATABASE_ID at GLOBAL_TIME.
+
+        Members that are not in the index are selected, including this packet, when they are looked
+        up next.
+        """
+        global_times = self._members.get(member_database_id)
+        if global_times is not None:
+            global_times.add(global_time)
+
+    def clear(self):
+        """
+        Discard all members.
+        """
+        self._members.clear()
+
+
+class SyncResponseCache(object):
+
+    """
+    Keeps the (packet, key) tuples that were recently selected to respond to a sync range.
+
+    Introduction requests for the same range often arrive within a few seconds of each other.  Only
+    the tuples that a previous response actually consumed are cached, the remainder is selected from
+    the database when a later response continues past them.  Every entry is discarded after
+    LIFETIME seconds and all entries are discarded when the sync table changes, see clear().
+
+    Entries are keyed by (time_low, time_high, offset, modulo) only.  A hit requires a request for
+    exactly the same range within LIFETIME seconds, without any message being stored in between.
+    With the default sync strategy peers choose a random pivot, hence mostly the requests for the
+    full range of a small community, or for the same modulo slice, repeat.  Expect hits for a
+    minority of the requests in a busy community.
+
+    Each entry caches at most MAX_BYTES of packets.  Past that limit the tuples are passed through
+    without being cached and the entry is not reused.
+    """
+
+    class Packets(object):
+
+        """
+        A replayable iterator over (packet, key) tuples, continuing from SOURCE once the cached
+        tuples are exhausted.
+
+        At most MAX_BYTES of packets are cached.  Afterwards every iterator continues from the
+        current position of SOURCE, an iterator that was behind skips the tuples that were not
+        cached.  These are offered again in a later sync round.
+        """
+
+        def __init__(self, source, max_bytes):
+            self._source = source
+            self._max_bytes = max_bytes
+            self._bytes = 0
+            self._cache = []
+            # True once more than MAX_BYTES were read from SOURCE, no more tuples are cached
+            self.overflow = False
+
+        def __iter__(self):
+            index = 0
+            while True:
+                if index < len(self._cache):
+                    yield self._cache[index]
+                    index += 1
+
+                else:
+                    try:
+                        item = self._source.next()
+                    except StopIteration:
+                        return
+
+                    if not self.overflow:
+                        self._bytes += len(item[0])
+                        if self._bytes > self._max_bytes:
+                            self.overflow = True
+                        else:
+                            self._cache.append(item)
+                            index += 1
+                    yield item
+
+    def __init__(self, max_entries, lifetime, max_bytes):
+        assert isinstance(max_entries, int), type(max_entries)
+        assert 0 <= max_entries, max_entries
+        assert isinstance(lifetime, float), type(lifetime)
+        assert isinstance(max_bytes, int), type(max_bytes)
+        assert 0 < max_bytes, max_bytes
+        self._max_entries = max_entries
+        self._lifetime = lifetime
+        self._max_bytes = max_bytes
+        # range: (expire, generation, Packets) tuples, oldest first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, range_, source, generation=0):
+        """
+        Returns an iterator over the (packet, key) tuples in RANGE_.
+
+        When RANGE_ is cached for the same GENERATION the tuples are replayed from the cache,
+        otherwise they are taken from SOURCE, a generator that is only used when more tuples are
+        required than are cached.  An entry for a different GENERATION is replaced.
+        """
+        if not self._max_entries:
+            return source
+
+        now = time()
+        entry = self._entries.get(range_)
+        if entry and entry[0] > now and entry[1] == generation and not entry[2].overflow:
+            return iter(entry[2])
+
+        packets = self.Packets(source, self._max_bytes)
+        self._entries.pop(range_, None)
+        self._entries[range_] = (now + self._lifetime, generation, packets)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return iter(packets)
+
+    def clear(self):
+        """
+        Discard all entries.
+        """
+        self._entries.clear()
+
+
 class DispersyInternalMessage(object):
     pass
 
@@ -206,7 +481,11 @@ class Community(object):
         self._delayed_key = defaultdict(list)
         self._delayed_value = defaultdict(list)
 
-        self._dispersy.callback.register(self._periodically_clean_delayed)
+        if type(self)._periodically_clean_delayed.im_func is not Community._periodically_clean_delayed.im_func:
+            # a subclass overrides the generator that was used before Dispersy.periodic
+            self._pending_callbacks.append(self._dispersy.callback.register(self._periodically_clean_delayed))
+        elif self.dispersy_clean_delayed_interval:
+            self._dispersy.periodic.attach(u"clean-delayed", self.dispersy_clean_delayed_interval, self, self._clean_delayed)
 
         create_identity = True
         try:
@@ -301,8 +580,11 @@ class Community(object):
         # sync range bloom filters
         self._sync_cache = None
         self._sync_cache_skip_count = 0
+        b = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate)
+        self._sync_bloom_filters = SyncBloomFilterManager(self.dispersy_sync_bloom_filter_cache_size, b.get_capacity(self.dispersy_sync_bloom_filter_error_rate))
+        self._sync_responses = SyncResponseCache(self.dispersy_sync_response_cache_size, self.dispersy_sync_response_cache_lifetime, self.dispersy_sync_response_cache_bytes)
+        self._sync_keys = SyncKeyIndex(self.dispersy_sync_key_index_size, self._select_sync_global_times)
         if __debug__:
-            b = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate)
             logger.debug("sync bloom:    size: %d;  capacity: %d;  error-rate: %f", int(ceil(b.size // 8)), b.get_capacity(self.dispersy_sync_bloom_filter_error_rate), self.dispersy_sync_bloom_filter_error_rate)
 
         # assigns temporary cache objects to unique identifiers
@@ -333,7 +615,7 @@ class Community(object):
 
         # start walker, if needed
         if self.dispersy_enable_candidate_walker:
-            self._dispersy.callback.register(self.take_step)
+            self._pending_callbacks.append(self._dispersy.callback.register(self.take_step))
 
         # turn on/off pruning
         self._do_pruning = any(isinstance(meta.distribution, SyncDistribution) and isinstance(meta.distribution.pruning, GlobalTimePruning) for meta in self._meta_messages.itervalues())
@@ -482,6 +764,28 @@ class Community(object):
         """
         return False
 
+    @property
+    def dispersy_take_step_interval(self):
+        """
+        The number of seconds between two steps of the candidate walker.
+
+        All communities using the same interval take their steps from a single task, see
+        Dispersy.periodic.
+        @rtype: float
+        """
+        return 5.0
+
+    @property
+    def dispersy_clean_delayed_interval(self):
+        """
+        The number of seconds between two checks for delayed packets and messages that timed out.
+
+        All communities using the same interval are checked from a single task, see
+        Dispersy.periodic.  When None is returned delayed packets and messages will never time out.
+        @rtype: float or None
+        """
+        return 5.0
+
     @property
     def dispersy_enable_candidate_walker_responses(self):
         """
@@ -577,6 +881,134 @@ class Community(object):
     def dispersy_sync_cache_enable(self):
         return True  # _cache_enable_
 
+    @property
+    def dispersy_sync_bloom_filter_cache_size(self):
+        """
+        The number of sync bloom filters, each covering a different global time range, that are
+        kept and updated while new messages are stored.
+
+        A claimed range that is still cached is not selected from the database again.  Zero
+        disables this cache.
+        @rtype: int
+        """
+        return 10
+
+    @property
+    def dispersy_sync_bloom_filter_counting_enable(self):
+        """
+        When True the cached sync bloom filters are CountingBloomFilter instances.
+
+        A counting bloom filter can remove the keys of undone and pruned messages, hence its range
+        does not have to be selected from the database again after such an event.  However, it takes
+        about eight times the memory of a normal bloom filter, for every one of the
+        dispersy_sync_bloom_filter_cache_size filters.
+        @rtype: bool
+        """
+        return False
+
+    @property
+    def dispersy_verify_threads(self):
+        """
+        The number of worker threads that verify the signatures of batched incoming messages, see
+        Dispersy.get_verify_pool.
+
+        Messages using MemberAuthentication are decoded on the callback thread without verifying
+        their signature, the signatures of a batch are then verified in parallel.  This is only
+        useful when the crypto library releases the GIL, as M2Crypto does.  Zero verifies all
+        signatures while decoding.
+        @rtype: int
+        """
+        return 0
+
+    @property
+    def dispersy_sync_key_index_size(self):
+        """
+        The number of members whose stored global times are kept in memory to detect duplicate
+        messages without querying the database, see SyncKeyIndex.
+
+        Zero disables this index.
+        @rtype: int
+        """
+        return 1024
+
+    @property
+    def dispersy_sync_response_cache_size(self):
+        """
+        The number of sync ranges whose selected packets are kept to respond to identical sync
+        requests, see dispersy_sync_response_cache_lifetime.
+
+        Zero disables this cache.
+        @rtype: int
+        """
+        return 16
+
+    @property
+    def dispersy_sync_response_cache_lifetime(self):
+        """
+        The number of seconds that the packets selected for a sync range are reused.
+        @rtype: float
+        """
+        return 5.0
+
+    @property
+    def dispersy_sync_response_cache_bytes(self):
+        """
+        The maximum number of packet bytes that are kept for one cached sync range.
+
+        A response consumes more packets than it sends, namely also those that are in the bloom
+        filter of the requester, hence this is a multiple of dispersy_sync_response_limit.
+        @rtype: int
+        """
+        return 8 * self.dispersy_sync_response_limit
+
+    @property
+    def dispersy_sync_bloom_filter_digest_enable(self):
+        """
+        When True the sync bloom filters contain the sha1 digest of each packet instead of the packet itself.
+
+        The digest is stored alongside the packet in the sync table, hence neither claiming a sync
+        bloom filter nor responding to one requires hashing the full packets again.  Note that the
+        bloom filter is interpreted by the receiving peer, i.e. this must be enabled for all peers in
+        the community.
+        @rtype: bool
+        """
+        return False
+
+    @property
+    def _sync_bloom_filter_key(self):
+        """
+        The sync table column that is used as bloom filter key.
+        @rtype: unicode
+        """
+        return u"digest" if self.dispersy_sync_bloom_filter_digest_enable else u"packet"
+
+    @property
+    def sync_keys(self):
+        """
+        The SyncKeyIndex with the (member, global_time) pairs of the packets stored for this community.
+        @rtype: SyncKeyIndex
+        """
+        return self._sync_keys
+
+    def _select_sync_global_times(self, member_database_id):
+        return [global_time for global_time, in self._dispersy.database.execute_query(u"sync-global-times", (self.database_id, member_database_id))]
+
+    def _get_syncable_message_ids(self):
+        """
+        Returns the database ids of the meta messages that are included in the sync bloom filters.
+        @rtype: tuple
+        """
+        return tuple(meta.database_id for meta in self._meta_messages.itervalues() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
+
+    def _get_sync_bloom_filter_keys(self, packets):
+        """
+        Returns the bloom filter keys for PACKETS, see dispersy_sync_bloom_filter_digest_enable.
+        @rtype: [str]
+        """
+        if self.dispersy_sync_bloom_filter_digest_enable:
+            return [sha1(packet).digest() for packet in packets]
+        return list(packets)
+
     def dispersy_store(self, messages):
         """
         Called after new MESSAGES have been stored in the database.
@@ -584,27 +1016,57 @@ class Community(object):
         if __debug__:
             cached = 0
 
-        if self._sync_cache:
-            cache = self._sync_cache
-            for message in messages:
-                if (message.distribution.priority > 32 and
-                    cache.time_low <= message.distribution.global_time <= cache.time_high and
-                        (message.distribution.global_time + cache.offset) % cache.modulo == 0):
+        # all MESSAGES share the same meta message, hence the same priority
+        if messages[0].distribution.priority > 32:
+            self._sync_responses.clear()
+
+        if messages[0].distribution.priority > 32 and (self._sync_cache or self._sync_bloom_filters):
+            keys = self._get_sync_bloom_filter_keys(message.packet for message in messages)
+
+            # update the managed bloomfilters, these may be claimed again later
+            for message, key in zip(messages, keys):
+                self._sync_bloom_filters.store(message.distribution.global_time, key)
+
+            if self._sync_cache:
+                cache = self._sync_cache
+                # a managed bloomfilter has already been updated
+                update_bloom_filter = not cache.bloom_filter in self._sync_bloom_filters
+                for message, key in zip(messages, keys):
+                    if (cache.time_low <= message.distribution.global_time <= cache.time_high and
+                            (message.distribution.global_time + cache.offset) % cache.modulo == 0):
 
-                    if __debug__:
-                        cached += 1
+                        if __debug__:
+                            cached += 1
 
-                    # update cached bloomfilter to avoid duplicates
-                    cache.bloom_filter.add(message.packet)
+                        # update cached bloomfilter to avoid duplicates
+                        if update_bloom_filter:
+                            cache.bloom_filter.add(key)
 
-                    # if this message was received from the candidate we send the bloomfilter too, increment responses
-                    if (cache.candidate and message.candidate and cache.candidate.sock_addr == message.candidate.sock_addr):
-                        cache.responses_received += 1
+                        # if this message was received from the candidate we send the bloomfilter too, increment responses
+                        if (cache.candidate and message.candidate and cache.candidate.sock_addr == message.candidate.sock_addr):
+                            cache.responses_received += 1
 
         if __debug__:
             if cached:
                 logger.debug("%s] %d out of %d were part of the cached bloomfilter", self._cid.encode("HEX"), cached, len(messages))
 
+    def update_sync_packet(self, meta, global_time, old_packet, new_packet, undone=False):
+        """
+        Called after OLD_PACKET, a META message at GLOBAL_TIME, was replaced by NEW_PACKET in the
+        database.  Both packets have the same payload, see Dispersy._is_duplicate_sync_message.
+
+        The managed bloom filters exchange the key of OLD_PACKET for the key of NEW_PACKET, unless
+        the packet is UNDONE in which case neither key is in the filters.  Filters that can not
+        remove keys are discarded instead.  The cached responses are discarded as they may contain
+        OLD_PACKET.
+        """
+        if meta.distribution.priority > 32:
+            self._sync_responses.clear()
+            if not undone:
+                old_key, new_key = self._get_sync_bloom_filter_keys((old_packet, new_packet))
+                self._sync_bloom_filters.remove(global_time, old_key)
+                self._sync_bloom_filters.store(global_time, new_key)
+
     def dispersy_claim_sync_bloom_filter(self, request_cache):
         """
         Returns a (time_low, time_high, modulo, offset, bloom_filter) or None.
@@ -623,7 +1085,7 @@ class Community(object):
                     cache.responses_received = 0
                     cache.candidate = request_cache.helper_candidate
 
-                    logger.debug("%s reuse #%d (packets received: %d; %s)", self._cid.encode("HEX"), cache.times_used, cache.responses_received, hex(cache.bloom_filter._filter))
+                    logger.debug("%s reuse #%d (packets received: %d; %s)", self._cid.encode("HEX"), cache.times_used, cache.responses_received, cache.bloom_filter.bytes.encode("HEX"))
                     return cache.time_low, cache.time_high, cache.modulo, cache.offset, cache.bloom_filter
 
             elif self._sync_cache.times_used == 0:
@@ -657,13 +1119,18 @@ class Community(object):
         if __debug__:
             t1 = time()
 
-        syncable_messages = u", ".join(unicode(meta.database_id) for meta in self._meta_messages.itervalues() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
+        syncable_messages = self._get_syncable_message_ids()
         if syncable_messages:
             if __debug__:
                 t2 = time()
 
             acceptable_global_time = self.acceptable_global_time
-            bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+            # a counting bloom filter absorbs undo and pruning events, at the cost of memory
+            if self.dispersy_sync_bloom_filter_cache_size and self.dispersy_sync_bloom_filter_counting_enable:
+                bloom_class = CountingBloomFilter
+            else:
+                bloom_class = BloomFilter
+            bloom = bloom_class(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
             capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
             desired_mean = self.global_time / 2.0
@@ -672,6 +1139,13 @@ class Community(object):
             if from_gbtime < 1:
                 from_gbtime = int(self._random.random() * self.global_time)
 
+            # reuse a managed bloomfilter when its range contains the pivot, it is up to date
+            managed = self._sync_bloom_filters.get(from_gbtime)
+            if managed:
+                time_low, time_high, managed_bloom = managed
+                logger.debug("%s syncing %d-%d, reusing managed bloomfilter, pivot = %d", self.cid.encode("HEX"), time_low, time_high, from_gbtime)
+                return (time_low, time_high, 1, 0, managed_bloom)
+
             if from_gbtime > 1 and self._nrsyncpackets >= capacity:
                 # use from_gbtime -1/+1 to include from_gbtime
                 right, rightdata = self._select_bloomfilter_range(request_cache, syncable_messages, from_gbtime - 1, capacity, True)
@@ -719,7 +1193,9 @@ class Community(object):
                     logger.debug("%s took %f (fakejoin %f, rangeselect %f, dataselect %f, bloomfill, %f",
                                  self.cid.encode("HEX"), time() - t1, t2 - t1, t3 - t2, t4 - t3, time() - t4)
 
-                return (min(bloomfilter_range[0], acceptable_global_time), min(bloomfilter_range[1], acceptable_global_time), 1, 0, bloom)
+                time_low, time_high = min(bloomfilter_range[0], acceptable_global_time), min(bloomfilter_range[1], acceptable_global_time)
+                self._sync_bloom_filters.add(time_low, time_high, bloom, len(data))
+                return (time_low, time_high, 1, 0, bloom)
 
             if __debug__:
                 logger.debug("%s no messages to sync", self.cid.encode("HEX"))
@@ -771,13 +1247,16 @@ class Community(object):
         return bloomfilter_range, data
 
     def _select_and_fix(self, request_cache, syncable_messages, global_time, to_select, higher=True):
-        assert isinstance(syncable_messages, unicode)
+        assert isinstance(syncable_messages, tuple)
+        # the sync_community_undone_global_time_index provides the global_time order and, when
+        # using digests, covers the entire query
+        placeholders = u", ".join(u"?" for _ in syncable_messages)
         if higher:
-            data = list(self._dispersy.database.execute(u"SELECT global_time, packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time > ? ORDER BY global_time ASC LIMIT ?" % (syncable_messages),
-                       (global_time, to_select + 1)))
+            data = list(self._dispersy.database.execute(u"SELECT global_time, %s FROM sync WHERE community = ? AND undone = 0 AND meta_message IN (%s) AND global_time > ? ORDER BY global_time ASC LIMIT ?" % (self._sync_bloom_filter_key, placeholders),
+                       (self.database_id,) + syncable_messages + (global_time, to_select + 1)))
         else:
-            data = list(self._dispersy.database.execute(u"SELECT global_time, packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time < ? ORDER BY global_time DESC LIMIT ?" % (syncable_messages),
-                       (global_time, to_select + 1)))
+            data = list(self._dispersy.database.execute(u"SELECT global_time, %s FROM sync WHERE community = ? AND undone = 0 AND meta_message IN (%s) AND global_time < ? ORDER BY global_time DESC LIMIT ?" % (self._sync_bloom_filter_key, placeholders),
+                       (self.database_id,) + syncable_messages + (global_time, to_select + 1)))
 
         fixed = False
         if len(data) > to_select:
@@ -798,20 +1277,26 @@ class Community(object):
     @runtime_duration_warning(0.5)
     @attach_runtime_statistics(u"{0.__class__.__name__}.{function_name}")
     def _dispersy_claim_sync_bloom_filter_modulo(self, request_cache):
-        syncable_messages = u", ".join(unicode(meta.database_id) for meta in self._meta_messages.itervalues() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
+        syncable_messages = self._get_syncable_message_ids()
         if syncable_messages:
             bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
             capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
-            self._nrsyncpackets = list(self._dispersy.database.execute(u"SELECT count(*) FROM sync WHERE meta_message IN (%s) AND undone = 0 LIMIT 1" % (syncable_messages)))[0][0]
+            # the modulo condition is evaluated on the sync_community_undone_global_time_index, only
+            # the matching rows are read from the sync table (none when using digests)
+            placeholders = u", ".join(u"?" for _ in syncable_messages)
+            self._nrsyncpackets = list(self._dispersy.database.execute(u"SELECT count(*) FROM sync WHERE community = ? AND undone = 0 AND meta_message IN (%s) LIMIT 1" % placeholders,
+                                                                       (self.database_id,) + syncable_messages))[0][0]
             modulo = int(ceil(self._nrsyncpackets / float(capacity)))
             if modulo > 1:
                 offset = randint(0, modulo - 1)
-                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync WHERE meta_message IN (%s) AND sync.undone = 0 AND (sync.global_time + ?) %% ? = 0" % syncable_messages, (offset, modulo)))
+                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.%s FROM sync WHERE community = ? AND undone = 0 AND meta_message IN (%s) AND (global_time + ?) %% ? = 0" % (self._sync_bloom_filter_key, placeholders),
+                                                                                          (self.database_id,) + syncable_messages + (offset, modulo)))
             else:
                 offset = 0
                 modulo = 1
-                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync WHERE meta_message IN (%s) AND sync.undone = 0" % syncable_messages))
+                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.%s FROM sync WHERE community = ? AND undone = 0 AND meta_message IN (%s)" % (self._sync_bloom_filter_key, placeholders),
+                                                                                          (self.database_id,) + syncable_messages))
 
             bloom.add_keys(packets)
 
@@ -958,6 +1443,9 @@ class Community(object):
             self._dispersy.callback.unregister(id_)
         self._pending_callbacks = []
 
+        # stop all periodic jobs
+        self._dispersy.periodic.detach(self)
+
         self._dispersy.detach_community(self)
 
     def claim_global_time(self):
@@ -995,8 +1483,20 @@ class Community(object):
                 #                                               (meta.database_id, self._global_time - meta.distribution.pruning.prune_threshold))]
                 # if packets:
 
-                self._dispersy.database.execute(u"DELETE FROM sync WHERE meta_message = ? AND global_time <= ?",
-                                                (meta.database_id, self._global_time - meta.distribution.pruning.prune_threshold))
+                prune_global_time = self._global_time - meta.distribution.pruning.prune_threshold
+
+                # remove the pruned messages from the managed bloomfilters
+                if meta.distribution.priority > 32 and self._sync_bloom_filters.overlaps(1, prune_global_time):
+                    for global_time, key in list(self._dispersy.database.execute_query(u"sync-prune-%s" % self._sync_bloom_filter_key,
+                                                                                       (meta.database_id, prune_global_time))):
+                        self._sync_bloom_filters.remove(global_time, str(key))
+
+                rowcount = self._dispersy.database.execute_query(u"sync-prune", (meta.database_id, prune_global_time)).rowcount
+                if rowcount:
+                    # committed by a later group commit, see Database.add_uncommitted_rows
+                    self._dispersy.database.add_uncommitted_rows(rowcount)
+                    if meta.distribution.priority > 32:
+                        self._sync_responses.clear()
 
     def dispersy_check_database(self):
         """
@@ -1073,8 +1573,6 @@ class Community(object):
         self._conversions.append(conversion)
 
     def take_step(self):
-        most_recent_sync = None
-
         if self.dispersy_enable_fast_candidate_walker:
             for _ in xrange(10):
                 now = time()
@@ -1107,21 +1605,27 @@ class Community(object):
                 # wait for NAT hole punching
                 yield 1.0
 
-        while True:
-            # if cid not in self._dispersy._communities it is detached, but not unloaded
-            if self.cid in self._dispersy._communities:
-                now = time()
-                logger.debug("previous sync was %.1f seconds ago", now - most_recent_sync if most_recent_sync else -1)
+        # the remaining steps are taken by the periodic candidate walker, shared by all communities.
+        # dispersy_take_step checks whether the community can walk, and a random phase keeps the
+        # steps of the communities spread out over the interval
+        self.dispersy_take_step()
+        interval = self.dispersy_take_step_interval
+        self._dispersy.periodic.attach(u"take-step", interval, self, self.dispersy_take_step, random() * interval)
 
-                candidate = self.dispersy_get_walk_candidate()
-                if candidate:
-                    logger.debug("%s %s taking step towards %s", self.cid.encode("HEX"), self.get_classification(), candidate)
-                    self.create_introduction_request(candidate, self.dispersy_enable_bloom_filter_sync)
-                else:
-                    logger.debug("%s %s no candidate to take step", self.cid.encode("HEX"), self.get_classification())
-                most_recent_sync = time()
+    def dispersy_take_step(self):
+        """
+        Take a single step of the candidate walker.
 
-            yield 5.0
+        Called every dispersy_take_step_interval seconds once the take_step generator has finished.
+        """
+        # if cid not in self._dispersy._communities it is detached, but not unloaded
+        if self.cid in self._dispersy._communities:
+            candidate = self.dispersy_get_walk_candidate()
+            if candidate:
+                logger.debug("%s %s taking step towards %s", self.cid.encode("HEX"), self.get_classification(), candidate)
+                self.create_introduction_request(candidate, self.dispersy_enable_bloom_filter_sync)
+            else:
+                logger.debug("%s %s no candidate to take step", self.cid.encode("HEX"), self.get_classification())
 
     def _iter_category(self, category, strict=True):
         # strict=True will ensure both candidate.lan_address and candidate.wan_address are not
@@ -1870,21 +2374,30 @@ class Community(object):
 
         del self._delayed_value[delayed]
 
+    @deprecated("Use _clean_delayed, see dispersy_clean_delayed_interval, instead")
     def _periodically_clean_delayed(self):
+        """
+        Calls _clean_delayed every dispersy_clean_delayed_interval seconds.
+
+        Kept for compatibility, a subclass that overrides this generator has it registered instead
+        of attaching _clean_delayed to Dispersy.periodic.
+        """
         while True:
-            now = time()
-            for delayed in self._delayed_value.keys():
-                if now > delayed.timestamp + 10:
-                    self._remove_delayed(delayed)
-                    delayed.on_timeout()
+            self._clean_delayed()
+            yield self.dispersy_clean_delayed_interval or 5.0
 
-                    self.dispersy.statistics.delay_timeout += 1
+    def _clean_delayed(self):
+        now = time()
+        for delayed in self._delayed_value.keys():
+            if now > delayed.timestamp + 10:
+                self._remove_delayed(delayed)
+                delayed.on_timeout()
 
-                    self._dispersy._statistics.drop_count += 1
-                    self._dispersy._statistics.dict_inc(self._dispersy._statistics.drop,
-                                                        "delay_timeout:%s" % delayed)
+                self.dispersy.statistics.delay_timeout += 1
 
-            yield 5.0
+                self._dispersy._statistics.drop_count += 1
+                self._dispersy._statistics.dict_inc(self._dispersy._statistics.drop,
+                                                    "delay_timeout:%s" % delayed)
 
     def on_incoming_packets(self, packets, cache=True, timestamp=0.0):
         """
@@ -1957,7 +2470,10 @@ class Community(object):
          2. All binary packets are converted into Message.Implementation instances.  Some packets
             are dropped or delayed at this stage.
 
-         3. All remaining messages are passed to on_message_batch.
+         3. When dispersy_verify_threads is enabled, the signatures of the converted messages are
+            verified in parallel.  Messages with an invalid signature are dropped.
+
+         4. All remaining messages are passed to on_message_batch.
         """
         # convert binary packets into Message.Implementation instances
         messages = []
@@ -1967,13 +2483,17 @@ class Community(object):
         assert all(isinstance(x, tuple) for x in batch)
         assert all(len(x) == 3 for x in batch)
 
+        # verify the signatures on the thread pool after converting all packets
+        verify_threads = self.dispersy_verify_threads
+        parallel_verify = verify_threads > 0 and len(batch) > 1 and isinstance(meta.authentication, MemberAuthentication)
+
         for candidate, packet, conversion in batch:
             assert isinstance(candidate, Candidate)
             assert isinstance(packet, str)
             assert isinstance(conversion, Conversion)
             try:
                 # convert binary data to internal Message
-                messages.append(conversion.decode_message(candidate, packet))
+                messages.append(conversion.decode_message(candidate, packet, verify=not parallel_verify))
 
             except DropPacket as drop:
                 self._drop(drop, packet, candidate)
@@ -1985,6 +2505,14 @@ class Community(object):
         assert all(message.meta == meta for message in messages), "All Message.Implementation instances must be in the same batch"
         logger.debug("%d %s messages after conversion", len(messages), meta.name)
 
+        if parallel_verify and messages:
+            pool = self._dispersy.get_verify_pool(verify_threads)
+            verified = pool.map(verify_packet_task, [(message.authentication.member, message.packet) for message in messages])
+            for message in [message for message, is_valid in zip(messages, verified) if not is_valid]:
+                self._drop(DropPacket("Verification failed (_on_batch_cache)"), message.packet, message.candidate)
+            messages = [message for message, is_valid in zip(messages, verified) if is_valid]
+            logger.debug("%d %s messages after verification", len(messages), meta.name)
+
         # handle the incoming messages
         if messages:
             self.on_messages(messages)
@@ -2381,23 +2909,81 @@ class Community(object):
                 messages_with_sync.append((message, time_low, time_high, offset, modulo))
 
         if messages_with_sync:
-            for message, generator in self._get_packets_for_bloomfilters(messages_with_sync, include_inactive=False):
-                payload = message.payload
+            # only the 20 byte digests are worth sending to the worker processes, see
+            # Dispersy.bloom_filter_pool
+            pool = self._dispersy.bloom_filter_pool if self.dispersy_sync_bloom_filter_digest_enable and len(messages_with_sync) > 1 else None
+
+            # the global time determines which messages are inactive, this only matters for messages
+            # using GlobalTimePruning
+            generation = self.global_time if any(isinstance(meta.distribution, SyncDistribution) and isinstance(meta.distribution.pruning, GlobalTimePruning)
+                                                 for meta in self._meta_messages.itervalues()) else 0
+
+            # every response is a [message, generator, byte_limit, packets] list
+            responses = []
+            for (message, time_low, time_high, offset, modulo), (_, generator) in zip(messages_with_sync, self._get_packets_for_bloomfilters(messages_with_sync, include_inactive=False)):
+                # identical ranges share the packets selected from the database
+                generator = self._sync_responses.get((time_low, time_high, offset, modulo), generator, generation)
                 # we limit the response by byte_limit bytes
-                byte_limit = self.dispersy_sync_response_limit
+                responses.append([message, generator, self.dispersy_sync_response_limit, []])
+
+            if pool:
+                # the callback thread continues with other tasks while the workers are busy
+                self._dispersy.callback.register(self._send_sync_responses, (responses, pool))
+            else:
+                for _ in self._send_sync_responses(responses, None):
+                    pass
 
-                packets = []
-                for packet, in payload.bloom_filter.not_filter(generator):
-                    packets.append(packet)
-                    byte_limit -= len(packet)
-                    if byte_limit <= 0:
+    def _send_sync_responses(self, responses, pool):
+        """
+        Sends the packets that are missing from the bloom filters of RESPONSES, a list of [message,
+        generator, byte_limit, packets] lists.
+
+        When POOL is given the bloom filters are evaluated by its worker processes and this
+        generator yields until their results are available, otherwise it never yields.
+        """
+        # test the packets against the bloom filters in batches, the batch size bounds the
+        # number of packets that are read from the database but never send.  every round
+        # tests one batch for each response that did not reach its byte limit yet
+        pending = responses
+        while pending:
+            batches = [list(islice(response[1], 256)) for response in pending]
+            pending, batches = [response for response, batch in zip(pending, batches) if batch], [batch for batch in batches if batch]
+            if not pending:
+                break
+
+            if pool:
+                tasks = []
+                for response, batch in zip(pending, batches):
+                    bloom_filter = response[0].payload.bloom_filter
+                    tasks.append((bloom_filter.bytes, bloom_filter.functions, bloom_filter.prefix, [key for _, key in batch]))
+                result = pool.map_async(not_filter_indexes_task, tasks)
+                while not result.ready():
+                    yield 0.01
+                    # the pool is terminated when dispersy stops, after unloading the communities
+                    if not self.cid in self._dispersy._communities:
+                        logger.debug("community unloaded while evaluating bloom filters")
+                        return
+                results = result.get()
+
+            else:
+                results = [response[0].payload.bloom_filter.not_filter_indexes([key for _, key in batch]) for response, batch in zip(pending, batches)]
+
+            for response, batch, indexes in zip(pending, batches, results):
+                for index in indexes:
+                    packet = batch[index][0]
+                    response[3].append(packet)
+                    response[2] -= len(packet)
+                    if response[2] <= 0:
                         logger.debug("bandwidth throttle")
                         break
 
-                if packets:
-                    logger.debug("syncing %d packets (%d bytes) to %s", len(packets), sum(len(packet) for packet in packets), message.candidate)
-                    self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-sync-", len(packets))
-                    self._dispersy._endpoint.send([message.candidate], packets)
+            pending = [response for response in pending if response[2] > 0]
+
+        for message, _, _, packets in responses:
+            if packets:
+                logger.debug("syncing %d packets (%d bytes) to %s", len(packets), sum(len(packet) for packet in packets), message.candidate)
+                self._dispersy._statistics.dict_inc(self._dispersy._statistics.outgoing, u"-sync-", len(packets))
+                self._dispersy._endpoint.send([message.candidate], packets)
 
     def check_undo(self, messages):
         # Note: previously all MESSAGES have been checked to ensure that the sequence numbers are
@@ -2519,8 +3105,19 @@ class Community(object):
                 parameters.append((message.packet_id, self.database_id, message.payload.member.database_id, message.payload.global_time))
                 real_messages.append(message)
 
-        self._dispersy._database.executemany(u"UPDATE sync SET undone = ? "
-                                             u"WHERE community = ? AND member = ? AND global_time = ?", parameters)
+        # remove the messages that are about to be undone from the managed bloomfilters
+        if self._sync_bloom_filters:
+            syncable_messages = set(self._get_syncable_message_ids())
+            for member_database_id, global_time in set((member_database_id, global_time) for _, _, member_database_id, global_time in parameters):
+                if self._sync_bloom_filters.get(global_time):
+                    for key, meta_message_id in list(self._dispersy._database.execute_query(u"sync-undo-%s" % self._sync_bloom_filter_key,
+                                                                                            (self.database_id, member_database_id, global_time))):
+                        if meta_message_id in syncable_messages:
+                            self._sync_bloom_filters.remove(global_time, str(key))
+
+        self._dispersy._database.executemany_query(u"sync-undo", parameters)
+        self._dispersy._database.add_uncommitted_rows(len(parameters))
+        self._sync_responses.clear()
 
         for meta, sub_messages in groupby(real_messages, key=lambda x: x.payload.packet.meta):
             meta.undo_callback([(message.payload.member, message.payload.global_time, message.payload.packet) for message in sub_messages])
@@ -2680,7 +3277,7 @@ class Community(object):
                     # verify that the bloom filter is correct
                     try:
                         _, packets = self._get_packets_for_bloomfilters([[None, time_low, self.global_time if time_high == 0 else time_high, offset, modulo]], include_inactive=True).next()
-                        packets = [packet for packet, in packets]
+                        packets = [key for _, key in packets]
 
                     except OverflowError:
                         logger.error("time_low:  %d", time_low)
@@ -2728,10 +3325,16 @@ class Community(object):
 
         return request
 
-    def _get_packets_for_bloomfilters(self, requests, include_inactive=True):
+    def _get_packets_for_bloomfilters(self, requests, include_inactive=True, page_size=128):
         """
         Return all packets matching a Bloomfilter request
 
+        The meta messages are visited in priority order and each one is read from the database in
+        pages of at most PAGE_SIZE rows.  Hence, the caller can stop iterating once it has enough
+        packets without the database having to select, or sort, the remainder of the range.  The
+        pages are read with Database.execute_read, hence the generators may also be consumed on a
+        worker thread when Dispersy uses read-only database connections.
+
         @param requests: A list of requests, each of them being a tuple consisting of the request,
          time_low, time_high, offset, and modulo
         @type requests: list
@@ -2739,37 +3342,89 @@ class Community(object):
         @param include_inactive: When False only active packets (due to pruning) are returned
         @type include_inactive: bool
 
-        @return: An generator yielding the original request and a generator consisting of the packets matching the request
+        @param page_size: The maximum number of rows selected with one query
+        @type page_size: int
+
+        @return: An generator yielding the original request and a generator consisting of (packet, key) tuples matching
+         the request, where key is the packet or its digest, see dispersy_sync_bloom_filter_digest_enable
         """
 
         assert isinstance(requests, list)
         assert all(isinstance(request, (list, tuple)) for request in requests)
         assert all(len(request) == 5 for request in requests)
+        assert isinstance(page_size, int) and page_size > 0, page_size
+
+        use_digest = self.dispersy_sync_bloom_filter_digest_enable
+        columns = u"id, global_time, packet, digest" if use_digest else u"id, global_time, packet"
+
+        # every page continues after the last row of the previous page, narrowing the global_time
+        # range such that the sync_meta_message_undone_global_time_index seeks directly to it.  the
+        # sync table does not have a unique (meta_message, global_time) hence the id breaks ties
+        ascending = u"SELECT " + columns + u" FROM sync WHERE meta_message = ? AND undone = 0 AND global_time BETWEEN ? AND ? AND (global_time > ? OR id > ?) AND (global_time + ?) % ? = 0 ORDER BY global_time ASC, id ASC LIMIT ?"
+        descending = u"SELECT " + columns + u" FROM sync WHERE meta_message = ? AND undone = 0 AND global_time BETWEEN ? AND ? AND (global_time < ? OR id < ?) AND (global_time + ?) % ? = 0 ORDER BY global_time DESC, id DESC LIMIT ?"
+        bounds = u"SELECT min(global_time), max(global_time) FROM sync WHERE meta_message = ? AND undone = 0 AND global_time BETWEEN ? AND ?"
+
+        def get_pages(meta, time_low, time_high, offset, modulo, order):
+            # when time_low > time_high the BETWEEN clause will not match any rows
+            if order == u"ASC":
+                last_global_time, last_id = time_low, -1
+                while True:
+                    rows = self._dispersy._database.execute_read(ascending, (meta.database_id, last_global_time, time_high, last_global_time, last_id, offset, modulo, page_size))
+                    if rows:
+                        yield rows
+                        last_id, last_global_time = rows[-1][:2]
+                    if len(rows) < page_size:
+                        break
 
-        def get_sub_select(meta):
+            else:
+                assert order == u"DESC", order
+                last_global_time, last_id = time_high, 2 ** 63 - 1
+                while True:
+                    rows = self._dispersy._database.execute_read(descending, (meta.database_id, time_low, last_global_time, last_global_time, last_id, offset, modulo, page_size))
+                    if rows:
+                        yield rows
+                        last_id, last_global_time = rows[-1][:2]
+                    if len(rows) < page_size:
+                        break
+
+        def get_rows(meta, time_low, time_high, offset, modulo):
             direction = meta.distribution.synchronization_direction
-            if direction == u"ASC":
-                return u"""
- SELECT * FROM
-  (SELECT sync.packet FROM sync    -- """ + meta.name + """
-   WHERE sync.meta_message = ? AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0
-   ORDER BY sync.global_time ASC)"""
-
-            if direction == u"DESC":
-                return u"""
- SELECT * FROM
-  (SELECT sync.packet FROM sync    -- """ + meta.name + """
-   WHERE sync.meta_message = ? AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0
-   ORDER BY sync.global_time DESC)"""
-
-            if direction == u"RANDOM":
-                return u"""
- SELECT * FROM
-  (SELECT sync.packet FROM sync    -- """ + meta.name + """
-   WHERE sync.meta_message = ? AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0
-   ORDER BY RANDOM())"""
-
-            raise RuntimeError("Unknown synchronization_direction [%d]" % direction)
+            if direction in (u"ASC", u"DESC"):
+                for rows in get_pages(meta, time_low, time_high, offset, modulo, direction):
+                    for row in rows:
+                        yield row
+
+            elif direction == u"RANDOM":
+                # instead of ORDER BY RANDOM(), which sorts the entire range, we start at a random
+                # global time between the first and last available message, wrap around, and
+                # shuffle each page
+                low, high = self._dispersy._database.execute_read(bounds, (meta.database_id, time_low, time_high))[0]
+                if low is not None:
+                    pivot = randint(low, high)
+                    for pages in (get_pages(meta, pivot, time_high, offset, modulo, u"ASC"),
+                                  get_pages(meta, time_low, pivot - 1, offset, modulo, u"ASC")):
+                        for rows in pages:
+                            shuffle(rows)
+                            for row in rows:
+                                yield row
+
+            else:
+                raise RuntimeError("Unknown synchronization_direction [%s]" % direction)
+
+        def get_packets(time_low, time_high, offset, modulo):
+            for meta in meta_messages:
+                if include_inactive:
+                    _time_low = time_low
+                else:
+                    _time_low = min(max(time_low, self.global_time - meta.distribution.pruning.inactive_threshold + 1), 2 ** 63 - 1) if isinstance(meta.distribution.pruning, GlobalTimePruning) else time_low
+
+                if use_digest:
+                    for _, _, packet, digest in get_rows(meta, _time_low, time_high, offset, modulo):
+                        yield str(packet), str(digest)
+                else:
+                    for _, _, packet in get_rows(meta, _time_low, time_high, offset, modulo):
+                        packet = str(packet)
+                        yield packet, packet
 
         # obtain all available messages for this community
         meta_messages = sorted([meta
@@ -2778,22 +3433,9 @@ class Community(object):
                                 if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32],
                                key=lambda meta: meta.distribution.priority,
                                reverse=True)
-        # build multi-part SQL statement from meta_messages
-        sql = "".join((u"SELECT * FROM (", " UNION ALL ".join(get_sub_select(meta) for meta in meta_messages), ")"))
-        logger.debug(sql)
 
         for message, time_low, time_high, offset, modulo in requests:
-            sql_arguments = []
-            for meta in meta_messages:
-                if include_inactive:
-                    _time_low = time_low
-                else:
-                    _time_low = min(max(time_low, self.global_time - meta.distribution.pruning.inactive_threshold + 1), 2 ** 63 - 1) if isinstance(meta.distribution.pruning, GlobalTimePruning) else time_low
-
-                sql_arguments.extend((meta.database_id, _time_low, time_high, offset, modulo))
-            logger.debug("%s", sql_arguments)
-
-            yield message, ((str(packet),) for packet, in self._dispersy._database.execute(sql, sql_arguments))
+            yield message, get_packets(time_low, time_high, offset, modulo)
 
     def check_puncture_request(self, messages):
         for message in messages:
@@ -3504,6 +4146,13 @@ class Community(object):
                         elif __debug__:
                             logger.debug("no change for message %s at time %d", message.name, message.distribution.global_time)
 
+                if meta.distribution.priority > 32 and (undo or redo):
+                    self._sync_responses.clear()
+                    for message, key in zip(undo, self._get_sync_bloom_filter_keys(message.packet for message in undo)):
+                        self._sync_bloom_filters.remove(message.distribution.global_time, key)
+                    for message, key in zip(redo, self._get_sync_bloom_filter_keys(message.packet for message in redo)):
+                        self._sync_bloom_filters.store(message.distribution.global_time, key)
+
                 if undo:
                     executemany(u"UPDATE sync SET undone = 1 WHERE id = ?", ((message.packet_id,) for message in undo))
                     meta.undo_callback([(message.authentication.member, message.distribution.global_time, message) for message in undo])
@@ -6,34 +6,45 @@ This module provides basic database functionalty and simple version control.
 @contact: dispersy@frayja.com
 """
 
+from Queue import Queue
 from abc import ABCMeta, abstractmethod
 from sqlite3 import Connection
 import logging
 import sys
 import thread
+from time import time
 
-from .decorator import attach_runtime_statistics
+from .decorator import attach_runtime_statistics, _runtime_statistics
 from .logger import get_logger
 logger = get_logger(__name__)
 
 
-if "--explain-query-plan" in getattr(sys, "argv", []):
-    _explain_query_plan_logger = get_logger("explain-query-plan")
-    _explain_query_plan = set()
+_explain_query_plan_logger = get_logger("explain-query-plan")
+_explain_query_plan = set()
 
-    def attach_explain_query_plan(func):
-        def attach_explain_query_plan_helper(self, statements, bindings=()):
-            if not statements in _explain_query_plan:
-                _explain_query_plan.add(statements)
 
-                _explain_query_plan_logger.info("Explain query plan for <<<%s>>>", statements)
-                for line in self._cursor.execute(u"EXPLAIN QUERY PLAN %s" % statements, bindings):
-                    _explain_query_plan_logger.info(line)
-                _explain_query_plan_logger.info("--")
+def explain_query_plan(func):
+    """
+    Log the query plan of every statement given to FUNC the first time it is executed.
+
+    Attached to Database._execute and Database._executemany when started with
+    --explain-query-plan, see attach_explain_query_plan.
+    """
+    def attach_explain_query_plan_helper(self, statements, bindings=(), *args, **kargs):
+        if not statements in _explain_query_plan:
+            _explain_query_plan.add(statements)
+
+            _explain_query_plan_logger.info("Explain query plan for <<<%s>>>", statements)
+            for line in self._cursor.execute(u"EXPLAIN QUERY PLAN %s" % statements, bindings):
+                _explain_query_plan_logger.info(line)
+            _explain_query_plan_logger.info("--")
 
-            return func(self, statements, bindings)
-        attach_explain_query_plan_helper.__name__ = func.__name__
-        return attach_explain_query_plan_helper
+        return func(self, statements, bindings, *args, **kargs)
+    attach_explain_query_plan_helper.__name__ = func.__name__
+    return attach_explain_query_plan_helper
+
+if "--explain-query-plan" in getattr(sys, "argv", []):
+    attach_explain_query_plan = explain_query_plan
 
 else:
     def attach_explain_query_plan(func):
@@ -56,20 +67,99 @@ class IgnoreCommits(Exception):
         super(IgnoreCommits, self).__init__("Ignore all commits made within __enter__ and __exit__")
 
 
+class ReadOnlyConnectionPool(object):
+
+    """
+    A fixed number of read-only connections to one database file that can be used from any thread.
+
+    Each connection is used by at most one thread at a time, a thread that finds all connections in
+    use blocks until one is returned.  The database must use WAL without EXCLUSIVE locking, in which
+    case readers never block, nor are blocked by, the writing connection.  Note that readers only
+    see committed changes.
+    """
+
+    def __init__(self, file_path, size, cached_statements=100):
+        assert isinstance(file_path, unicode), type(file_path)
+        assert file_path != u":memory:", "every :memory: connection opens a different database"
+        assert isinstance(size, int), type(size)
+        assert size > 0, size
+        self._file_path = file_path
+        self._size = size
+        self._connections = Queue()
+        for _ in xrange(size):
+            connection = Connection(file_path, check_same_thread=False, cached_statements=cached_statements)
+            connection.execute(u"PRAGMA query_only = ON")
+            self._connections.put(connection)
+
+    @property
+    def size(self):
+        return self._size
+
+    def execute(self, statement, bindings=()):
+        """
+        Execute one read-only SQL statement and return all resulting rows.
+
+        The rows are fetched before the connection is returned to the pool, hence a list is returned
+        instead of a cursor.
+
+        @rtype: [tuple]
+        """
+        assert isinstance(statement, unicode), "The SQL statement must be given in unicode"
+        assert isinstance(bindings, (tuple, list, dict, set)), "The bindings must be a tuple, list, dictionary, or set"
+        connection = self._connections.get()
+        try:
+            logger.log(logging.NOTSET, "%s <-- %s [%s read-only]", statement, bindings, self._file_path)
+            return connection.execute(statement, bindings).fetchall()
+        finally:
+            self._connections.put(connection)
+
+    def close(self):
+        """
+        Close all connections, waiting for those that are in use.
+        """
+        logger.debug("close %d read-only connections [%s]", self._size, self._file_path)
+        for _ in xrange(self._size):
+            self._connections.get().close()
+
+
 class Database(object):
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, cached_statements=100, read_connections=0):
         """
         Initialize a new Database instance.
 
         @param file_path: the path to the database file.
         @type file_path: unicode
+
+        @param cached_statements: the number of compiled statements that the connection keeps.  This
+         should exceed the number of queries registered with register_query(...).
+        @type cached_statements: int
+
+        @param read_connections: the number of read-only connections that other threads can use
+         through execute_read(...).  When zero, or for a :memory: database, no pool is opened and
+         the database uses EXCLUSIVE locking.
+        @type read_connections: int
         """
         assert isinstance(file_path, unicode)
+        assert isinstance(cached_statements, int), type(cached_statements)
+        assert cached_statements > 0, cached_statements
+        assert isinstance(read_connections, int), type(read_connections)
+        assert read_connections >= 0, read_connections
         logger.debug("loading database [%s]", file_path)
         self._file_path = file_path
+        self._cached_statements = cached_statements
+        self._read_connections = 0 if file_path == u":memory:" else read_connections
+
+        # _READ_POOL is set during open(...) when _READ_CONNECTIONS > 0
+        self._read_pool = None
+        # the thread that opened the database, only this thread may use the writing connection
+        self._thread_ident = 0
+
+        # _queries contains name:(statement, execute_entry, executemany_entry) pairs, where the
+        # entries are the runtime statistics keys of the query, see register_query(...)
+        self._queries = {}
 
         # _CONNECTION, _CURSOR, AND _DATABASE_VERSION are set during open(...)
         self._connection = None
@@ -83,6 +173,15 @@ class Database(object):
         # when _pending_commits > 0.  A commit is required when _pending_commits > 1.
         self._pending_commits = 0
 
+        # commit threshold.  statements are executed immediately, only their commit is delayed.
+        # rows registered with Database.add_uncommitted_rows(...) make a commit due once
+        # _commit_max_rows rows changed or, see Database.commit_timeout, once _commit_max_delay
+        # seconds passed since the previous commit
+        self._uncommitted_rows = 0
+        self._commit_max_rows = 1000
+        self._commit_max_delay = 60.0
+        self._last_commit = time()
+
         if __debug__:
             self._debug_thread_ident = 0
 
@@ -91,12 +190,18 @@ class Database(object):
         assert self._connection is None, "Database.open() has already been called"
         if __debug__:
             self._debug_thread_ident = thread.get_ident()
+        self._thread_ident = thread.get_ident()
         logger.debug("open database [%s]", self._file_path)
         self._connect()
         if initial_statements:
             self._initial_statements()
         if prepare_visioning:
             self._prepare_version()
+        if self._read_connections:
+            # readers can only see what has been committed
+            self._connection.commit()
+            logger.debug("open %d read-only connections [%s]", self._read_connections, self._file_path)
+            self._read_pool = ReadOnlyConnectionPool(self._file_path, self._read_connections, self._cached_statements)
         return True
 
     def close(self, commit=True):
@@ -104,6 +209,9 @@ class Database(object):
         assert self._connection is not None, "Database.close() has been called or Database.open() has not been called"
         if commit:
             self.commit(exiting=True)
+        if self._read_pool:
+            self._read_pool.close()
+            self._read_pool = None
         logger.debug("close database [%s]", self._file_path)
         self._cursor.close()
         self._cursor = None
@@ -112,7 +220,7 @@ class Database(object):
         return True
 
     def _connect(self):
-        self._connection = Connection(self._file_path)
+        self._connection = Connection(self._file_path, cached_statements=self._cached_statements)
         self._cursor = self._connection.cursor()
 
     def _initial_statements(self):
@@ -149,9 +257,13 @@ class Database(object):
         # PRAGMA journal_mode = DELETE | TRUNCATE | PERSIST | MEMORY | WAL | OFF
         # http://www.sqlite.org/pragma.html#pragma_page_size
         #
+        # EXCLUSIVE locking makes WAL keep its index in heap memory, which rules out the read-only
+        # connections
+        #
         if not (journal_mode == u"WAL" or self._file_path == u":memory:"):
             logger.debug("PRAGMA journal_mode = WAL (previously: %s) [%s]", journal_mode, self._file_path)
-            self._cursor.execute(u"PRAGMA locking_mode = EXCLUSIVE")
+            if not self._read_connections:
+                self._cursor.execute(u"PRAGMA locking_mode = EXCLUSIVE")
             self._cursor.execute(u"PRAGMA journal_mode = WAL")
 
         else:
@@ -203,6 +315,101 @@ class Database(object):
         """
         return self._file_path
 
+    @property
+    def read_pool(self):
+        """
+        The ReadOnlyConnectionPool, or None when no read-only connections are used.
+        """
+        return self._read_pool
+
+    def register_query(self, name, statement):
+        """
+        Register STATEMENT as NAME, after which it can be executed using execute_query(...) and
+        executemany_query(...).
+
+        The runtime statistics keys of the query are resolved here, once, rather than formatted on
+        every call.  Note that sqlite3 has no explicit prepared statements, the statement is only
+        compiled once for as long as it stays in the statement cache of the connection.
+
+        @param name: the name of the query, also used in its runtime statistics key.
+        @type name: unicode
+
+        @param statement: the SQL statement.
+        @type statement: unicode
+        """
+        assert isinstance(name, unicode), type(name)
+        assert isinstance(statement, unicode), type(statement)
+        assert self._queries.get(name, (statement,))[0] == statement, "query %s is already registered" % name
+        self._queries[name] = (statement,
+                               u"%s.execute_query %s [%s]" % (self.__class__.__name__, name, self._file_path),
+                               u"%s.executemany_query %s [%s]" % (self.__class__.__name__, name, self._file_path))
+
+    def get_query(self, name):
+        """
+        Returns the SQL statement registered as NAME.
+        """
+        return self._queries[name][0]
+
+    @property
+    def uncommitted_rows(self):
+        """
+        The number of rows registered with add_uncommitted_rows(...) since the previous commit.
+        """
+        return self._uncommitted_rows
+
+    @property
+    def commit_timeout(self):
+        """
+        The number of seconds until the pending changes must be committed, or 0.0 when they are
+        overdue.
+        """
+        return max(0.0, self._last_commit + self._commit_max_delay - time())
+
+    def set_commit_threshold(self, max_rows, max_delay):
+        """
+        Set the commit threshold for the rows registered with add_uncommitted_rows(...).
+
+        @param max_rows: commit as soon as this many rows changed.
+        @type max_rows: int
+
+        @param max_delay: commit at most this many seconds after the previous commit, this may be
+         less than a second.
+        @type max_delay: float
+        """
+        assert isinstance(max_rows, int), type(max_rows)
+        assert max_rows > 0, max_rows
+        assert isinstance(max_delay, float), type(max_delay)
+        assert max_delay > 0.0, max_delay
+        self._commit_max_rows = max_rows
+        self._commit_max_delay = max_delay
+
+    def add_uncommitted_rows(self, rows):
+        """
+        Register ROWS inserted, updated, or deleted rows whose commit may be delayed.
+
+        This is a commit threshold, not a write buffer: the statements have already been executed
+        on the connection and are visible to it, only the commit is delayed.  The caller commits
+        once commit_due becomes True, i.e. max_rows rows changed or max_delay seconds passed since
+        the previous commit.  Calling commit() directly remains the durability barrier that must be
+        used before data is given to others.
+
+        @param rows: the number of changed rows.
+        @type rows: int
+
+        @return: True when a group commit is due.
+        """
+        assert isinstance(rows, (int, long)), type(rows)
+        assert rows >= 0, rows
+        self._uncommitted_rows += rows
+        return self.commit_due
+
+    @property
+    def commit_due(self):
+        """
+        True when the changes registered with add_uncommitted_rows(...) must be committed.
+        """
+        return self._uncommitted_rows >= self._commit_max_rows or not self.commit_timeout
+
     def __enter__(self):
         """
         Enters a no-commit state.  The commit will be performed by __exit__.
@@ -246,7 +453,6 @@ class Database(object):
             # returning False to let Python reraise the exception.
             return False
 
-    @attach_explain_query_plan
     @attach_runtime_statistics("{0.__class__.__name__}.{function_name} {1} [{0.file_path}]")
     def execute(self, statement, bindings=(), get_lastrowid=False):
         """
@@ -272,6 +478,33 @@ class Database(object):
         @returns: unknown
         @raise sqlite.Error: unknown
         """
+        return self._execute(statement, bindings, get_lastrowid)
+
+    def execute_query(self, name, bindings=(), get_lastrowid=False):
+        """
+        Execute the SQL statement registered as NAME, see register_query(...).
+
+        Runtime statistics are kept per NAME instead of per statement.
+
+        @param name: the name of the registered query.
+        @type name: unicode
+
+        @param bindings: the values that must be set to the placeholders in the statement.
+        @type bindings: list, tuple, dict, or set
+
+        @returns: unknown
+        @raise sqlite.Error: unknown
+        """
+        assert name in self._queries, name
+        statement, entry, _ = self._queries[name]
+        start = time()
+        try:
+            return self._execute(statement, bindings, get_lastrowid)
+        finally:
+            _runtime_statistics[entry].increment(time() - start)
+
+    @attach_explain_query_plan
+    def _execute(self, statement, bindings, get_lastrowid):
         if __debug__:
             assert self._cursor is not None, "Database.close() has been called or Database.open() has not been called"
             assert self._connection is not None, "Database.close() has been called or Database.open() has not been called"
@@ -294,6 +527,32 @@ class Database(object):
             result = self._cursor.lastrowid
         return result
 
+    @attach_runtime_statistics("{0.__class__.__name__}.{function_name} {1} [{0.file_path}]")
+    def execute_read(self, statement, bindings=()):
+        """
+        Execute one read-only SQL statement from any thread and return all resulting rows.
+
+        On the thread that opened the database the statement is executed on the writing connection,
+        hence uncommitted changes are visible.  On other threads it is executed on one of the
+        read-only connections, which only see committed changes.
+
+        @param statement: the SQL statement that is to be executed.
+        @type statement: unicode
+
+        @param bindings: the values that must be set to the placeholders in statement.
+        @type bindings: list, tuple, dict, or set
+
+        @rtype: [tuple]
+        @raise RuntimeError: when called from another thread while there are no read-only
+         connections.
+        """
+        if thread.get_ident() == self._thread_ident:
+            return self._execute(statement, bindings, False).fetchall()
+
+        if self._read_pool is None:
+            raise RuntimeError("Database.execute_read from another thread requires read-only connections [%s]" % self._file_path)
+        return self._read_pool.execute(statement, bindings)
+
     @attach_runtime_statistics("{0.__class__.__name__}.{function_name} {1} [{0.file_path}]")
     def executescript(self, statements):
         assert self._cursor is not None, "Database.close() has been called or Database.open() has not been called"
@@ -305,9 +564,8 @@ class Database(object):
         logger.log(logging.NOTSET, "%s [%s]", statements, self._file_path)
         return self._cursor.executescript(statements)
 
-    @attach_explain_query_plan
     @attach_runtime_statistics("{0.__class__.__name__}.{function_name} {1} [{0.file_path}]")
-    def executemany(self, statement, sequenceofbindings):
+    def executemany(self, statement, sequenceofbindings, get_lastrowid=False):
         """
         Execute one SQL statement several times.
 
@@ -331,9 +589,44 @@ class Database(object):
 
         @type sequenceofbindings: list, tuple, set or generator
 
+        @param get_lastrowid: when True the rowid of the last inserted row is returned.  The rows
+                              inserted by one executemany are numbered consecutively, hence this
+                              gives the rowids of all rows.
+        @type get_lastrowid: bool
+
+        @returns: unknown
+        @raise sqlite.Error: unknown
+        """
+        return self._executemany(statement, sequenceofbindings, get_lastrowid)
+
+    def executemany_query(self, name, sequenceofbindings, get_lastrowid=False):
+        """
+        Execute the SQL statement registered as NAME several times, see register_query(...).
+
+        Runtime statistics are kept per NAME instead of per statement.
+
+        @param name: the name of the registered query.
+        @type name: unicode
+
+        @param sequenceofbindings: a list, tuple, set, or generator of bindings.
+        @type sequenceofbindings: list, tuple, set or generator
+
+        @param get_lastrowid: when True the rowid of the last inserted row is returned.
+        @type get_lastrowid: bool
+
         @returns: unknown
         @raise sqlite.Error: unknown
         """
+        assert name in self._queries, name
+        statement, _, entry = self._queries[name]
+        start = time()
+        try:
+            return self._executemany(statement, sequenceofbindings, get_lastrowid)
+        finally:
+            _runtime_statistics[entry].increment(time() - start)
+
+    @attach_explain_query_plan
+    def _executemany(self, statement, sequenceofbindings, get_lastrowid):
         assert self._cursor is not None, "Database.close() has been called or Database.open() has not been called"
         assert self._connection is not None, "Database.close() has been called or Database.open() has not been called"
         assert self._debug_thread_ident != 0, "please call database.open() first"
@@ -363,7 +656,11 @@ class Database(object):
                 sequenceofbindings = iter(sequenceofbindings)
 
         logger.log(logging.NOTSET, "%s [%s]", statement, self._file_path)
-        return self._cursor.executemany(statement, sequenceofbindings)
+        result = self._cursor.executemany(statement, sequenceofbindings)
+        if get_lastrowid:
+            # the cursor only sets lastrowid after execute(...)
+            result, = self._cursor.execute(u"SELECT last_insert_rowid()").next()
+        return result
 
     @attach_runtime_statistics("{0.__class__.__name__}.{function_name} [{0.file_path}]")
     def commit(self, exiting=False):
@@ -380,6 +677,8 @@ class Database(object):
 
         else:
             logger.debug("commit [%s]", self._file_path)
+            self._uncommitted_rows = 0
+            self._last_commit = time()
             for callback in self._commit_callbacks:
                 try:
                     callback(exiting=exiting)
@@ -41,6 +41,8 @@ import os
 import sys
 from collections import defaultdict, Iterable
 from itertools import groupby, count
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pprint import pformat
 from socket import inet_aton, error as socket_error
 from struct import unpack_from
@@ -65,6 +67,7 @@ from .logger import get_logger, deprecated
 from .member import DummyMember, Member
 from .message import (Message, DropMessage, DelayMessageBySequence,
                       DropPacket, DelayPacket)
+from .periodic import PeriodicDispatcher
 from .statistics import DispersyStatistics
 
 
@@ -83,7 +86,7 @@ class Dispersy(object):
     outgoing data for, possibly, multiple communities.
     """
 
-    def __init__(self, callback, endpoint, working_directory, database_filename=u"dispersy.db", crypto=ECCrypto()):
+    def __init__(self, callback, endpoint, working_directory, database_filename=u"dispersy.db", crypto=ECCrypto(), database_read_connections=0, bloom_filter_processes=0):
         """
         Initialise a Dispersy instance.
 
@@ -98,12 +101,22 @@ class Dispersy(object):
 
         @param database_filename: The database filename or u":memory:"
         @type database_filename: unicode
+
+        @param database_read_connections: The number of read-only database connections that other
+         threads can use, see Database.execute_read.
+        @type database_read_connections: int
+
+        @param bloom_filter_processes: The number of worker processes that evaluate the sync bloom
+         filters of batched introduction requests, see Dispersy.bloom_filter_pool.
+        @type bloom_filter_processes: int
         """
         assert isinstance(callback, Callback), type(callback)
         assert isinstance(endpoint, Endpoint), type(endpoint)
         assert isinstance(working_directory, unicode), type(working_directory)
         assert isinstance(database_filename, unicode), type(database_filename)
         assert isinstance(crypto, DispersyCrypto), type(crypto)
+        assert isinstance(bloom_filter_processes, int), type(bloom_filter_processes)
+        assert bloom_filter_processes >= 0, bloom_filter_processes
         super(Dispersy, self).__init__()
 
         # the thread we will be using
@@ -112,6 +125,9 @@ class Dispersy(object):
         # communication endpoint
         self._endpoint = endpoint
 
+        # periodic jobs shared by all communities, e.g. the candidate walker
+        self._periodic = PeriodicDispatcher(callback)
+
         # where we store all data
         self._working_directory = os.path.abspath(working_directory)
 
@@ -130,7 +146,7 @@ class Dispersy(object):
             if not os.path.isdir(database_directory):
                 os.makedirs(database_directory)
             database_filename = os.path.join(database_directory, database_filename)
-        self._database = DispersyDatabase(database_filename)
+        self._database = DispersyDatabase(database_filename, read_connections=database_read_connections)
 
         self._crypto = crypto
 
@@ -167,6 +183,15 @@ class Dispersy(object):
         # statistics...
         self._statistics = DispersyStatistics(self)
 
+        # process pool evaluating the sync bloom filters of batched introduction requests, created
+        # in start, see bloom_filter_pool
+        self._bloom_filter_processes = bloom_filter_processes
+        self._bloom_filter_pool = None
+
+        # thread pool verifying the signatures of batched messages, created on first use, see
+        # get_verify_pool
+        self._verify_pool = None
+
         # memory profiler
         if "--memory-dump" in sys.argv:
             def memory_dump():
@@ -181,6 +206,39 @@ class Dispersy(object):
 
             self._callback.register(memory_dump)
 
+    @property
+    def bloom_filter_pool(self):
+        """
+        The process pool that evaluates the sync bloom filters of batched introduction requests, or
+        None when Dispersy was created without bloom_filter_processes or is not running.
+
+        The workers are forked, hence the pool is created in Dispersy.start before the callback
+        thread is started.  It is shared by all communities that use digests as bloom filter keys,
+        see Community.dispersy_sync_bloom_filter_digest_enable, and terminated when Dispersy stops.
+
+        @rtype: multiprocessing.Pool or None
+        """
+        return self._bloom_filter_pool
+
+    def get_verify_pool(self, threads):
+        """
+        Returns the thread pool that verifies the signatures of batched incoming messages.
+
+        The pool is created with THREADS workers on first use and shared by all communities, see
+        Community.dispersy_verify_threads.  It is terminated when Dispersy stops.
+
+        @param threads: The number of worker threads, only used when the pool is created.
+        @type threads: int
+
+        @rtype: multiprocessing.pool.ThreadPool
+        """
+        assert isinstance(threads, int), type(threads)
+        assert threads > 0, threads
+        if self._verify_pool is None:
+            logger.debug("starting verify pool with %d threads", threads)
+            self._verify_pool = ThreadPool(threads)
+        return self._verify_pool
+
     @staticmethod
     def _get_interface_addresses():
         """
@@ -427,6 +485,14 @@ class Dispersy(object):
     def callback(self):
         return self._callback
 
+    @property
+    def periodic(self):
+        """
+        The PeriodicDispatcher that runs the periodic jobs of all communities.
+        @rtype: PeriodicDispatcher
+        """
+        return self._periodic
+
     @property
     def database(self):
         """
@@ -1058,10 +1124,15 @@ class Dispersy(object):
         until the bloom filter is synced with the database again.
         """
         community = message.community
+        # most messages are new, this is answered from memory
+        if not community.sync_keys.may_contain(message.authentication.member.database_id, message.distribution.global_time):
+            logger.debug("this message is not a duplicate")
+            return False
+
         # fetch the duplicate binary packet from the database
         try:
-            have_packet, undone = self._database.execute(u"SELECT packet, undone FROM sync WHERE community = ? AND member = ? AND global_time = ?",
-                                                        (community.database_id, message.authentication.member.database_id, message.distribution.global_time)).next()
+            have_packet, undone = self._database.execute_query(u"sync-duplicate",
+                                                              (community.database_id, message.authentication.member.database_id, message.distribution.global_time)).next()
         except StopIteration:
             logger.debug("this message is not a duplicate")
             return False
@@ -1099,8 +1170,9 @@ class Dispersy(object):
 
                     if have_packet < message.packet:
                         # replace our current message with the other one
-                        self._database.execute(u"UPDATE sync SET packet = ? WHERE community = ? AND member = ? AND global_time = ?",
-                                               (buffer(message.packet), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
+                        self._database.execute(u"UPDATE sync SET packet = ?, digest = ? WHERE community = ? AND member = ? AND global_time = ?",
+                                               (buffer(message.packet), buffer(sha1(message.packet).digest()), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
+                        community.update_sync_packet(message.meta, message.distribution.global_time, have_packet, message.packet, bool(undone))
 
                         # notify that global times have changed
                         # community.update_sync_range(message.meta, [message.distribution.global_time])
@@ -1378,10 +1450,10 @@ class Dispersy(object):
                         # database for all message.meta messages that were signed by
                         # message.authentication.members where the order of signing is not taken
                         # into account.
-                        times[members] = dict((global_time, (packet_id, str(packet)))
-                                              for global_time, packet_id, packet
+                        times[members] = dict((global_time, (packet_id, str(packet), undone))
+                                              for global_time, packet_id, packet, undone
                                               in self._database.execute(u"""
-SELECT sync.global_time, sync.id, sync.packet
+SELECT sync.global_time, sync.id, sync.packet, sync.undone
 FROM sync
 JOIN double_signed_sync ON double_signed_sync.sync = sync.id
 WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed_sync.member2 = ?
@@ -1392,7 +1464,7 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
                     tim = times[members]
 
                     if message.distribution.global_time in tim:
-                        packet_id, have_packet = tim[message.distribution.global_time]
+                        packet_id, have_packet, undone = tim[message.distribution.global_time]
 
                         if message.packet == have_packet:
                             # exact binary duplicate, do NOT process the message
@@ -1414,8 +1486,10 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
 
                                 if have_packet < message.packet:
                                     # replace our current message with the other one
-                                    self._database.execute(u"UPDATE sync SET member = ?, packet = ? WHERE id = ?",
-                                                           (message.authentication.member.database_id, buffer(message.packet), packet_id))
+                                    self._database.execute(u"UPDATE sync SET member = ?, packet = ?, digest = ? WHERE id = ?",
+                                                           (message.authentication.member.database_id, buffer(message.packet), buffer(sha1(message.packet).digest()), packet_id))
+                                    message.community.sync_keys.store(message.authentication.member.database_id, message.distribution.global_time)
+                                    message.community.update_sync_packet(message.meta, message.distribution.global_time, have_packet, message.packet, bool(undone))
 
                                     return DropMessage(message, "replaced existing packet with other packet with the same payload")
 
@@ -1698,6 +1772,7 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         meta = messages[0].meta
         logger.debug("attempting to store %d %s messages", len(messages), meta.name)
         is_double_member_authentication = isinstance(meta.authentication, DoubleMemberAuthentication)
+        is_sequence_enabled = isinstance(meta.distribution, FullSyncDistribution) and meta.distribution.enable_sequence_number
         highest_global_time = 0
         highest_sequence_number = defaultdict(int)
 
@@ -1712,34 +1787,49 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
 
             logger.debug("%s %d@%d", message.name, message.authentication.member.database_id, message.distribution.global_time)
 
-            # add packet to database
-            message.packet_id = self._database.execute(
-                u"INSERT INTO sync (community, member, global_time, meta_message, packet, sequence) "
-                u"VALUES (?, ?, ?, ?, ?, ?)",
-               (message.community.database_id,
-                message.authentication.member.database_id,
-                message.distribution.global_time,
-                message.database_id,
-                buffer(message.packet),
-                (message.distribution.sequence_number if
-                 isinstance(meta.distribution, FullSyncDistribution)
-                 and message.distribution.enable_sequence_number else None)
-                ), get_lastrowid=True)
-
-            # ensure that we can reference this packet
-            logger.debug("stored message %s in database at row %d", message.name, message.packet_id)
-
-            if is_double_member_authentication:
-                member1 = message.authentication.members[0].database_id
-                member2 = message.authentication.members[1].database_id
-                self._database.execute(u"INSERT INTO double_signed_sync (sync, member1, member2) VALUES (?, ?, ?)",
-                                       (message.packet_id, member1, member2) if member1 < member2 else (message.packet_id, member2, member1))
-
             # update global time
             highest_global_time = max(highest_global_time, message.distribution.global_time)
-            if isinstance(meta.distribution, FullSyncDistribution) and message.distribution.enable_sequence_number:
+            if is_sequence_enabled:
                 highest_sequence_number[message.authentication.member.database_id] = max(highest_sequence_number[message.authentication.member.database_id], message.distribution.sequence_number)
 
+        # add packets to database
+        self._database.executemany_query(
+            u"sync-insert",
+            [(message.community.database_id,
+              message.authentication.member.database_id,
+              message.distribution.global_time,
+              message.database_id,
+              buffer(message.packet),
+              message.distribution.sequence_number if is_sequence_enabled else None,
+              buffer(sha1(message.packet).digest()))
+             for message in messages])
+
+        # read the ids of the inserted packets back, sqlite does not guarantee that the rows inserted
+        # by one executemany get consecutive ids.  global_time is unique per community and member
+        global_times = defaultdict(list)
+        for message in messages:
+            global_times[message.authentication.member.database_id].append(message.distribution.global_time)
+        packet_ids = {}
+        for member_database_id, member_global_times in global_times.iteritems():
+            # stay well below the default limit of 999 host parameters per statement
+            for index in xrange(0, len(member_global_times), 500):
+                chunk = member_global_times[index:index + 500]
+                for packet_id, global_time in self._database.execute(u"SELECT id, global_time FROM sync WHERE community = ? AND member = ? AND global_time IN (" + ", ".join("?" for _ in chunk) + ")",
+                                                                     [meta.community.database_id, member_database_id] + chunk):
+                    packet_ids[(member_database_id, global_time)] = packet_id
+        assert len(packet_ids) == len(messages), [len(packet_ids), len(messages)]
+
+        # ensure that we can reference these packets, and that they are known to be duplicates
+        for message in messages:
+            message.packet_id = packet_ids[(message.authentication.member.database_id, message.distribution.global_time)]
+            meta.community.sync_keys.store(message.authentication.member.database_id, message.distribution.global_time)
+            logger.debug("stored message %s in database at row %d", message.name, message.packet_id)
+
+        if is_double_member_authentication:
+            order = lambda packet_id, member1, member2: (packet_id, member1, member2) if member1 < member2 else (packet_id, member2, member1)
+            self._database.executemany_query(u"double-signed-sync-insert",
+                                             [order(message.packet_id, message.authentication.members[0].database_id, message.authentication.members[1].database_id)
+                                              for message in messages])
 
         if __debug__ and highest_sequence_number:
             # when sequence numbers are enabled, we must have exactly
@@ -1773,14 +1863,15 @@ ORDER BY sync.global_time, sync.packet""", (meta.database_id, member1, member2))
                             items.update(all_items[:len(all_items) - meta.distribution.history_size])
 
                 else:
+                    # the history_size newest packets of a member are kept, i.e. every packet older
+                    # than the history_size-th newest one is removed.  global_time is unique per
+                    # member
+                    trim = []
                     for member_database_id in set(message.authentication.member.database_id for message in messages):
-                        all_items = list(self._database.execute(u"""
-SELECT id, global_time
-FROM sync
-WHERE meta_message = ? AND member = ?
-ORDER BY global_time""", (meta.database_id, member_database_id)))
-                        if len(all_items) > meta.distribution.history_size:
-                            items.update(all_items[:len(all_items) - meta.distribution.history_size])
+                        for cutoff, in self._database.execute_query(u"sync-last-cutoff", (meta.database_id, member_database_id, meta.distribution.history_size - 1)):
+                            trim.append((meta.database_id, member_database_id, cutoff))
+                    if trim:
+                        self._database.executemany_query(u"sync-last-trim", trim)
 
             if items:
                 self._database.executemany(u"DELETE FROM sync WHERE id = ?", [(syncid,) for syncid, _ in items])
@@ -1797,6 +1888,9 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
                         history_size, = self._database.execute(u"SELECT COUNT(*) FROM sync WHERE meta_message = ? AND member = ?", (message.database_id, message.authentication.member.database_id)).next()
                         assert history_size <= message.distribution.history_size, [history_size, message.distribution.history_size, message.authentication.member.database_id]
 
+        # the rows are committed by a later group commit, see store_update_forward
+        self._database.add_uncommitted_rows(len(messages))
+
         # update the global time
         meta.community.update_global_time(highest_global_time)
 
@@ -1902,7 +1996,8 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
 
         # 07/10/11 Boudewijn: we will only commit if it the message was create by our self.
         # Otherwise we can safely skip the commit overhead, since, if a crash occurs, we will be
-        # able to obtain the data eventually
+        # able to obtain the data eventually.  Other messages are committed together once enough
+        # rows changed or enough time passed, see Database.add_uncommitted_rows
         if store:
             my_messages = sum(message.authentication.member == message.community.my_member for message in messages)
             if my_messages:
@@ -1912,6 +2007,10 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
                 self._statistics.created_count += my_messages
                 self._statistics.dict_inc(self._statistics.created, messages[0].meta.name, my_messages)
 
+            elif self._database.commit_due:
+                logger.debug("group commit of %d rows", self._database.uncommitted_rows)
+                self._database.commit()
+
         if forward:
             return self._forward(messages)
 
@@ -2085,7 +2184,7 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
             assert isinstance(bindings, tuple)
             limit = 1000
             for offset in (i * limit for i in count()):
-                rows = list(self._database.execute(sql, bindings + (limit, offset)))
+                rows = self._database.execute_read(sql, bindings + (limit, offset))
                 if rows:
                     for row in rows:
                         yield row
@@ -2293,11 +2392,15 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
             # 12/07/2012 Arno: apswtrace detects 7 s commits with yield 5 min, so reduce
             # 09/10/2013 Boudewijn: the yield statement should not be inside the try/except (an
             # exception is raised when the _flush_database generator is closed)
-            yield 60.0
+            # the commit timeout can be less than a second, the lower bound only prevents a busy
+            # loop while commits fail
+            yield max(0.05, self._database.commit_timeout)
 
             try:
-                # flush changes to disk every 1 minutes
-                self._database.commit()
+                # flush changes to disk once the commit delay (default 1 minute) expires or enough
+                # rows changed.  other commits postpone this
+                if self._database.commit_due:
+                    self._database.commit()
 
             except Exception as exception:
                 # OperationalError: database is locked
@@ -2352,6 +2455,11 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
         logger.info("starting the Dispersy core...")
         results = []
 
+        # fork the bloom filter workers while this process has as few threads as possible
+        if self._bloom_filter_processes and self._bloom_filter_pool is None:
+            logger.debug("starting bloom filter pool with %d processes", self._bloom_filter_processes)
+            self._bloom_filter_pool = Pool(self._bloom_filter_processes)
+
         results.append((u"callback", self._callback.start()))
         assert all(isinstance(result, bool) for _, result in results), [type(result) for _, result in results]
         self._callback.call(start, priority=512)
@@ -2424,6 +2532,16 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
             # stop the database
             results[u"database"] = self._database.close()
 
+            # stop the bloom filter pool
+            if self._bloom_filter_pool:
+                self._bloom_filter_pool.terminate()
+                self._bloom_filter_pool = None
+
+            # stop the verify pool
+            if self._verify_pool:
+                self._verify_pool.terminate()
+                self._verify_pool = None
+
         if self._callback.is_running:
             # output statistics before we stop
             if logger.isEnabledFor(logging.DEBUG):
@@ -6,6 +6,7 @@ This module provides an interface to the Dispersy database.
 @contact: dispersy@frayja.com
 """
 
+from hashlib import sha1
 from itertools import groupby
 
 from .database import Database
@@ -13,7 +14,7 @@ from .distribution import FullSyncDistribution
 from .logger import get_logger
 logger = get_logger(__name__)
 
-LATEST_VERSION = 21
+LATEST_VERSION = 23
 
 schema = u"""
 CREATE TABLE member(
@@ -60,9 +61,11 @@ CREATE TABLE sync(
  undone INTEGER DEFAULT 0,
  packet BLOB,
  sequence INTEGER,
+ digest BLOB,                                           -- sha1 of packet, used as bloom filter key
  UNIQUE(community, member, global_time));
 CREATE INDEX sync_meta_message_undone_global_time_index ON sync(meta_message, undone, global_time);
 CREATE INDEX sync_meta_message_member ON sync(meta_message, member);
+CREATE INDEX sync_community_undone_global_time_index ON sync(community, undone, global_time, meta_message, digest);
 
 CREATE TABLE option(key TEXT PRIMARY KEY, value BLOB);
 INSERT INTO option(key, value) VALUES('database_version', '""" + str(LATEST_VERSION) + """');
@@ -73,6 +76,36 @@ class DispersyDatabase(Database):
     if __debug__:
         __doc__ = schema
 
+    def __init__(self, file_path, cached_statements=100, read_connections=0):
+        super(DispersyDatabase, self).__init__(file_path, cached_statements, read_connections)
+
+        # queries executed for (almost) every received message or sync request
+        self.register_query(u"sync-insert",
+                            u"INSERT INTO sync (community, member, global_time, meta_message, packet, sequence, digest) "
+                            u"VALUES (?, ?, ?, ?, ?, ?, ?)")
+        self.register_query(u"double-signed-sync-insert",
+                            u"INSERT INTO double_signed_sync (sync, member1, member2) VALUES (?, ?, ?)")
+        self.register_query(u"sync-global-times",
+                            u"SELECT global_time FROM sync WHERE community = ? AND member = ?")
+        self.register_query(u"sync-duplicate",
+                            u"SELECT packet, undone FROM sync WHERE community = ? AND member = ? AND global_time = ?")
+        self.register_query(u"sync-undo",
+                            u"UPDATE sync SET undone = ? WHERE community = ? AND member = ? AND global_time = ?")
+        self.register_query(u"sync-last-cutoff",
+                            u"SELECT global_time FROM sync WHERE meta_message = ? AND member = ? "
+                            u"ORDER BY global_time DESC LIMIT 1 OFFSET ?")
+        self.register_query(u"sync-last-trim",
+                            u"DELETE FROM sync WHERE meta_message = ? AND member = ? AND global_time < ?")
+        self.register_query(u"sync-prune",
+                            u"DELETE FROM sync WHERE meta_message = ? AND global_time <= ?")
+        # the bloom filter key is either the packet or its digest, see
+        # Community.dispersy_sync_bloom_filter_digest_enable
+        for key in (u"packet", u"digest"):
+            self.register_query(u"sync-prune-%s" % key,
+                                u"SELECT global_time, %s FROM sync WHERE meta_message = ? AND undone = 0 AND global_time <= ?" % key)
+            self.register_query(u"sync-undo-%s" % key,
+                                u"SELECT %s, meta_message FROM sync WHERE community = ? AND member = ? AND global_time = ? AND undone = 0" % key)
+
     def check_database(self, database_version):
         assert isinstance(database_version, unicode)
         assert database_version.isdigit()
@@ -478,10 +511,35 @@ UPDATE option SET value = '21' WHERE key = 'database_version';""")
                 logger.debug("upgrade database %d -> %d (done)", database_version, new_db_version)
 
             new_db_version = 22
+            if database_version < new_db_version:
+                # add the 'digest' column to the sync table, the digest of every packet is computed once
+                # when it is stored and can be used as bloom filter key instead of the packet itself
+                logger.debug("upgrade database %d -> %d", database_version, new_db_version)
+                self._connection.create_function("sha1", 1, lambda packet: buffer(sha1(packet).digest()))
+                self.executescript(u"""
+ALTER TABLE sync ADD COLUMN digest BLOB;
+UPDATE sync SET digest = sha1(packet);
+UPDATE option SET value = '22' WHERE key = 'database_version';""")
+                self.commit()
+                logger.debug("upgrade database %d -> %d (done)", database_version, new_db_version)
+
+            new_db_version = 23
+            if database_version < new_db_version:
+                # add an index for the sync bloom filter range selection.  it allows selecting the
+                # syncable messages of one community in global_time order and, since it includes
+                # meta_message and digest, it covers these queries when digests are used
+                logger.debug("upgrade database %d -> %d", database_version, new_db_version)
+                self.executescript(u"""
+CREATE INDEX sync_community_undone_global_time_index ON sync(community, undone, global_time, meta_message, digest);
+UPDATE option SET value = '23' WHERE key = 'database_version';""")
+                self.commit()
+                logger.debug("upgrade database %d -> %d (done)", database_version, new_db_version)
+
+            new_db_version = 24
             if database_version < new_db_version:
                 # there is no version new_db_version yet...
                 # logger.debug("upgrade database %d -> %d", database_version, new_db_version)
-                # self.executescript(u"""UPDATE option SET value = '22' WHERE key = 'database_version';""")
+                # self.executescript(u"""UPDATE option SET value = '24' WHERE key = 'database_version';""")
                 # self.commit()
                 # logger.debug("upgrade database %d -> %d (done)", database_version, new_db_version)
                 pass
@@ -1,4 +1,5 @@
 from abc import ABCMeta, abstractmethod
+from collections import deque
 from itertools import product
 from select import select
 from time import time
@@ -19,6 +20,158 @@ else:
 
 TUNNEL_PREFIX = "ffffffff".decode("HEX")
 
+# the message bytes of dispersy-puncture-request, dispersy-puncture, dispersy-introduction-request,
+# and dispersy-introduction-response
+WALKER_MESSAGE_BYTES = frozenset(chr(value) for value in (250, 249, 246, 245))
+
+# the message bytes of the packets that are handled in the control lane: the walker messages and
+# dispersy-identity
+CONTROL_MESSAGE_BYTES = WALKER_MESSAGE_BYTES | frozenset([chr(248)])
+
+
+def get_message_byte(data):
+    """
+    Returns the message byte of the packet DATA, or an empty string when DATA is too short.
+    """
+    return data[26:27] if data.startswith(TUNNEL_PREFIX) else data[22:23]
+
+
+class InboundQueue(object):
+
+    """
+    Bounded queue of incoming (sock_addr, data) packets waiting to be handled on the callback thread.
+
+    Each queue is a lane, identified by NAME, whose packets are handled by a callback task with
+    PRIORITY.  When more than SIZE packets are queued the POLICY decides which packets are dropped:
+    - u"drop-newest": the packets that came in last are dropped;
+    - u"drop-oldest": the packets that have been queued the longest are dropped;
+    - u"prefer-walker": the oldest packets are dropped, however, puncture and introduction packets
+      are only dropped when no other packets remain.  Walker packets are handled first.
+    """
+
+    POLICIES = (u"drop-newest", u"drop-oldest", u"prefer-walker")
+
+    def __init__(self, size=10000, policy=u"drop-oldest", name=u"bulk", priority=0):
+        assert isinstance(size, int), type(size)
+        assert size > 0, size
+        assert policy in self.POLICIES, policy
+        assert isinstance(name, unicode), type(name)
+        assert isinstance(priority, int), type(priority)
+        self._size = size
+        self._policy = policy
+        self._name = name
+        self._priority = priority
+        self._lock = threading.Lock()
+
+        # _walker contains the queued walker packets when the policy is u"prefer-walker", otherwise
+        # all packets are queued in _other
+        self._walker = deque()
+        self._other = deque()
+
+        # _timestamp is the time at which the oldest queued packet came in
+        self._timestamp = 0.0
+
+        self._count = 0
+        self._dropped = 0
+        self._high_water_mark = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @property
+    def count(self):
+        " Returns the number of packets that were queued, including the dropped packets. "
+        return self._count
+
+    @property
+    def dropped(self):
+        " Returns the number of packets that were dropped because the queue was full. "
+        return self._dropped
+
+    @property
+    def high_water_mark(self):
+        " Returns the largest number of packets that were queued at once. "
+        return self._high_water_mark
+
+    def reset_statistics(self):
+        self._count = 0
+        self._dropped = 0
+        self._high_water_mark = 0
+
+    def get_statistics(self):
+        " Returns a dictionary with the count, dropped, and high_water_mark statistics. "
+        return dict(count=self._count, dropped=self._dropped, high_water_mark=self._high_water_mark)
+
+    def __len__(self):
+        return len(self._walker) + len(self._other)
+
+    def put(self, packets, timestamp):
+        """
+        Queue PACKETS that came in at TIMESTAMP.
+
+        Returns a (was_empty, dropped) tuple, where WAS_EMPTY is True when the queue was empty, i.e.
+        when the consumer must be scheduled, and DROPPED is the number of packets that were dropped.
+        """
+        with self._lock:
+            was_empty = not (self._walker or self._other)
+            if was_empty:
+                self._timestamp = timestamp
+            self._count += len(packets)
+
+            if self._policy == u"prefer-walker":
+                for packet in packets:
+                    if get_message_byte(packet[1]) in WALKER_MESSAGE_BYTES:
+                        self._walker.append(packet)
+                    else:
+                        self._other.append(packet)
+            else:
+                self._other.extend(packets)
+
+            length = len(self._walker) + len(self._other)
+            dropped = max(0, length - self._size)
+            if dropped:
+                self._dropped += dropped
+                if self._policy == u"drop-newest":
+                    for _ in xrange(dropped):
+                        self._other.pop()
+                else:
+                    other = min(dropped, len(self._other))
+                    for _ in xrange(other):
+                        self._other.popleft()
+                    for _ in xrange(dropped - other):
+                        self._walker.popleft()
+                length -= dropped
+
+            if length > self._high_water_mark:
+                self._high_water_mark = length
+
+            return was_empty, dropped
+
+    def take(self):
+        """
+        Returns a (packets, timestamp) tuple with all queued packets and the time at which the oldest
+        of these came in, the queue is empty afterwards.
+        """
+        with self._lock:
+            packets = list(self._walker)
+            packets.extend(self._other)
+            self._walker.clear()
+            self._other.clear()
+            return packets, self._timestamp
+
 
 class Endpoint(object):
     __metaclass__ = ABCMeta
@@ -46,6 +199,12 @@ class Endpoint(object):
     def cur_sendqueue(self):
         return self._cur_sendqueue
 
+    def get_inbound_statistics(self):
+        """
+        Returns a dictionary with the InboundQueue.get_statistics() dictionary of each inbound lane.
+        """
+        return {}
+
     def reset_statistics(self):
         self._total_up = 0
         self._total_down = 0
@@ -114,7 +273,9 @@ class NullEndpoint(Endpoint):
 
 class RawserverEndpoint(Endpoint):
 
-    def __init__(self, rawserver, port, ip="0.0.0.0"):
+    def __init__(self, rawserver, port, ip="0.0.0.0", inbound_queue=None, control_queue=None):
+        assert inbound_queue is None or isinstance(inbound_queue, InboundQueue), type(inbound_queue)
+        assert control_queue is None or isinstance(control_queue, InboundQueue), type(control_queue)
         super(RawserverEndpoint, self).__init__()
 
         self._rawserver = rawserver
@@ -124,6 +285,11 @@ class RawserverEndpoint(Endpoint):
         self._sendqueue_lock = threading.RLock()
         self._sendqueue = []
 
+        # incoming packets wait in _inbound, or in _control for control packets, until the callback
+        # thread handles them
+        self._inbound = InboundQueue() if inbound_queue is None else inbound_queue
+        self._control = InboundQueue(1000, u"drop-oldest", u"control", 32) if control_queue is None else control_queue
+
         # _SOCKET is set during open(...)
         self._socket = None
 
@@ -149,6 +315,15 @@ class RawserverEndpoint(Endpoint):
         assert self._dispersy, "Should not be called before open(...)"
         return self._socket.getsockname()
 
+    def get_inbound_statistics(self):
+        return {self._control.name: self._control.get_statistics(),
+                self._inbound.name: self._inbound.get_statistics()}
+
+    def reset_statistics(self):
+        super(RawserverEndpoint, self).reset_statistics()
+        self._control.reset_statistics()
+        self._inbound.reset_statistics()
+
     def data_came_in(self, packets, cache=True):
         assert self._dispersy, "Should not be called before open(...)"
         assert isinstance(packets, (list, tuple)), type(packets)
@@ -162,7 +337,29 @@ class RawserverEndpoint(Endpoint):
                 for sock_addr, data in packets:
                     self.log_packet(sock_addr, data, outbound=False)
 
-            self._dispersy.callback.register(self.dispersythread_data_came_in, (packets, time(), cache))
+            if cache:
+                timestamp = time()
+                control = []
+                bulk = []
+                for packet in packets:
+                    (control if get_message_byte(packet[1]) in CONTROL_MESSAGE_BYTES else bulk).append(packet)
+
+                for queue, lane_packets in ((self._control, control), (self._inbound, bulk)):
+                    if lane_packets:
+                        was_empty, dropped = queue.put(lane_packets, timestamp)
+                        if dropped:
+                            logger.warning("%s inbound queue is full, dropped %d packets", queue.name, dropped)
+                            self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"inbound-queue-full-%s" % queue.name, dropped)
+                        if was_empty:
+                            self._dispersy.callback.register(self._process_inbound, (queue,), priority=queue.priority)
+
+            else:
+                self._dispersy.callback.register(self.dispersythread_data_came_in, (packets, time(), cache))
+
+    def _process_inbound(self, queue):
+        packets, timestamp = queue.take()
+        if packets:
+            self.dispersythread_data_came_in(packets, timestamp)
 
     def dispersythread_data_came_in(self, packets, timestamp, cache=True):
         assert self._dispersy, "Should not be called before open(...)"
@@ -255,9 +452,13 @@ class RawserverEndpoint(Endpoint):
 
 class StandaloneEndpoint(RawserverEndpoint):
 
-    def __init__(self, port, ip="0.0.0.0"):
+    def __init__(self, port, ip="0.0.0.0", inbound_queue=None, control_queue=None):
+        assert inbound_queue is None or isinstance(inbound_queue, InboundQueue), type(inbound_queue)
+        assert control_queue is None or isinstance(control_queue, InboundQueue), type(control_queue)
         # do NOT call RawserverEndpoint.__init__!
         Endpoint.__init__(self)
+        self._inbound = InboundQueue() if inbound_queue is None else inbound_queue
+        self._control = InboundQueue(1000, u"drop-oldest", u"control", 32) if control_queue is None else control_queue
 
         self._port = port
         self._ip = ip
@@ -273,7 +474,15 @@ class StandaloneEndpoint(RawserverEndpoint):
     def open(self, dispersy):
         # do NOT call RawserverEndpoint.open!
         Endpoint.open(self, dispersy)
+        self._bind()
 
+        self._running = True
+        self._thread = threading.Thread(name="StandaloneEndpoint", target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def _bind(self):
         while True:
             try:
                 self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -289,12 +498,6 @@ class StandaloneEndpoint(RawserverEndpoint):
                 continue
             break
 
-        self._running = True
-        self._thread = threading.Thread(name="StandaloneEndpoint", target=self._loop)
-        self._thread.daemon = True
-        self._thread.start()
-        return True
-
     def close(self, timeout=10.0):
         self._running = False
         result = True
@@ -357,6 +560,75 @@ class StandaloneEndpoint(RawserverEndpoint):
                         logger.debug('%d came in, %d bytes in total', len(packets), sum(len(packet) for _, packet in packets))
                         self.data_came_in(packets)
 
+
+class AsyncioEndpoint(StandaloneEndpoint):
+
+    """
+    AsyncioEndpoint reads and writes its socket on the event loop of an AsyncioCallback.
+
+    Incoming packets are given to Dispersy directly on the callback thread, rather than being read
+    on a separate endpoint thread and registered with the callback.  Each time the socket becomes
+    readable all pending packets are read and processed as one batch.
+    """
+
+    def __init__(self, port, ip="0.0.0.0"):
+        super(AsyncioEndpoint, self).__init__(port, ip)
+        # _EVENT_LOOP is set during open(...)
+        self._event_loop = None
+
+    def open(self, dispersy):
+        # do NOT call StandaloneEndpoint.open or RawserverEndpoint.open!
+        Endpoint.open(self, dispersy)
+        assert dispersy.callback.is_current_thread, "Must be called from the callback thread"
+        assert hasattr(dispersy.callback, "event_loop"), "Requires an AsyncioCallback"
+        self._bind()
+
+        self._event_loop = dispersy.callback.event_loop
+        self._add_task = lambda task, delay = 0.0, id = "": self._event_loop.call_later(delay, task)
+        self._event_loop.add_reader(self._socket.fileno(), self._read)
+        self._running = True
+        return True
+
+    def close(self, timeout=10.0):
+        assert self._dispersy.callback.is_current_thread, "Must be called from the callback thread"
+        self._running = False
+        result = True
+
+        self._event_loop.remove_reader(self._socket.fileno())
+        try:
+            self._socket.close()
+        except socket.error as exception:
+            logger.exception("%s", exception)
+            result = False
+
+        # do NOT call StandaloneEndpoint.close or RawserverEndpoint.close!
+        return Endpoint.close(self, timeout) and result
+
+    def _read(self):
+        recvfrom = self._socket.recvfrom
+        packets = []
+        try:
+            while True:
+                (data, sock_addr) = recvfrom(65535)
+                if data:
+                    packets.append((sock_addr, data))
+                else:
+                    break
+
+        except socket.error as e:
+            if e[0] != SOCKET_BLOCK_ERRORCODE:
+                self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"socket-error-'%s'" % str(e))
+
+        if packets:
+            logger.debug('%d came in, %d bytes in total', len(packets), sum(len(packet) for _, packet in packets))
+            self._total_down += sum(len(data) for _, data in packets)
+            if logger.isEnabledFor(logging.DEBUG):
+                for sock_addr, data in packets:
+                    self.log_packet(sock_addr, data, outbound=False)
+
+            self.dispersythread_data_came_in(packets, time())
+
+
 class ManualEnpoint(StandaloneEndpoint):
 
     def __init__(self, *args, **kwargs):
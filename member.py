@@ -263,3 +263,16 @@ class Member(DummyMember):
         Returns a human readable string representing the member.
         """
         return "<%s %d %s>" % (self.__class__.__name__, self._database_id, self._mid.encode("HEX"))
+
+
+def verify_packet_task(task):
+    """
+    Returns True when the signature at the end of PACKET was made by MEMBER, for a (MEMBER, PACKET)
+    TASK tuple.
+
+    This is a module level function, hence it can be given to a multiprocessing.pool.ThreadPool.
+    @rtype: bool
+    """
+    member, packet = task
+    first_signature_offset = len(packet) - member.signature_length
+    return bool(member.verify(packet, packet[first_signature_offset:], length=first_signature_offset))
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from time import time
+
+from .logger import get_logger
+logger = get_logger(__name__)
+
+
+class PeriodicDispatcher(object):
+
+    """
+    Runs periodic jobs for many owners, typically communities, using a single callback task per job.
+
+    A job is identified by its name and interval.  Every interval seconds the functions attached to
+    the job are called one after the other, in the order in which they were attached.  Owners that
+    use a different interval for the same job name share a task with the other owners using that
+    interval.
+
+    Each owner can be given a phase, an offset within the interval, to spread the calls of many
+    owners over the interval instead of making them all at the same moment.
+
+    When a function raises an exception it is detached and the exception is given to the Callback
+    exception handlers, as happens when a task of its own fails.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+
+        # _jobs contains a (name, interval):OrderedDict(owner:[deadline, func]) dictionary and
+        # _deadlines a (name, interval):deadline dictionary with the next time that the task of
+        # each job runs.  both are only used on the callback thread
+        self._jobs = {}
+        self._deadlines = {}
+
+    def attach(self, name, interval, owner, func, phase=0.0):
+        """
+        Call FUNC every INTERVAL seconds, together with all other functions attached to the NAME job
+        with the same INTERVAL.
+
+        An OWNER can attach one function to each job.  The first call is made PHASE seconds after
+        the next run of the job, or after INTERVAL + PHASE seconds when the job is not running yet.
+        """
+        assert self._callback.is_current_thread, "Must be called from the callback thread"
+        assert isinstance(name, unicode), type(name)
+        assert isinstance(interval, float), type(interval)
+        assert interval > 0.0, interval
+        assert callable(func), type(func)
+        assert isinstance(phase, float), type(phase)
+        assert 0.0 <= phase < interval, phase
+        key = (name, interval)
+        funcs = self._jobs.get(key)
+        if funcs is None:
+            funcs = self._jobs[key] = OrderedDict()
+            deadline = self._deadlines[key] = time() + interval + phase
+            self._callback.register(self._run, (key, funcs), delay=interval + phase, id_=u"periodic-%s-%.2f" % key)
+        else:
+            # the job task never sleeps past this deadline, it is at or after its next run
+            deadline = self._deadlines[key] + phase
+        funcs[owner] = [deadline, func]
+
+    def detach(self, owner, name=None):
+        """
+        Stop calling the functions of OWNER, either for the NAME job or for all jobs when NAME is
+        None.
+        """
+        assert self._callback.is_current_thread, "Must be called from the callback thread"
+        assert name is None or isinstance(name, unicode), type(name)
+        for (job_name, _), funcs in self._jobs.iteritems():
+            if name is None or job_name == name:
+                funcs.pop(owner, None)
+
+    def get_owners(self, name):
+        """
+        Returns the owners attached to the NAME job, regardless of their interval.
+        """
+        return [owner for (job_name, _), funcs in self._jobs.iteritems() if job_name == name for owner in funcs]
+
+    def _run(self, key, funcs):
+        interval = key[1]
+        while funcs:
+            now = time()
+            for owner, entry in funcs.items():
+                # a previous function may have detached OWNER
+                if entry[0] <= now and funcs.get(owner) is entry:
+                    entry[0] += interval
+                    if entry[0] <= now:
+                        # running late, skip the missed calls instead of making them in a burst
+                        entry[0] = now + interval
+                    try:
+                        entry[1]()
+                    except Exception as exception:
+                        # as with a task of its own, a failing function is no longer called and the
+                        # Callback exception handlers decide whether this is fatal
+                        logger.exception("periodic %s failed for %s", key[0], owner)
+                        funcs.pop(owner, None)
+                        self._callback.handle_exception(exception)
+
+            if funcs:
+                deadline = self._deadlines[key] = min(entry[0] for entry in funcs.itervalues())
+                yield max(0.0, deadline - time())
+
+        # no functions are attached, a new task is registered once a function is attached again
+        logger.debug("periodic %s every %.2fs stopped", key[0], interval)
+        del self._jobs[key]
+        del self._deadlines[key]
@@ -89,6 +89,10 @@ class DispersyStatistics(Statistics):
         # size of the sendqueue
         self.cur_sendqueue = 0
 
+        # dictionary with the count, dropped, and high_water_mark statistics of each inbound lane,
+        # see InboundQueue.get_statistics
+        self.inbound = None
+
         # nr of candidates introduced/stumbled upon
         self.total_candidates_discovered = 0
 
@@ -115,6 +119,10 @@ class DispersyStatistics(Statistics):
         # represents a key from the attach_runtime_statistics decorator
         self.runtime = None
 
+        # dictionary with the queue depths of the callback and a list with one dictionary per task,
+        # see Callback.get_statistics
+        self.callback = None
+
         self.update()
 
         self.enable_debug_statistics(__debug__)
@@ -172,6 +180,7 @@ class DispersyStatistics(Statistics):
         self.total_up = self._dispersy.endpoint.total_up
         self.total_send = self._dispersy.endpoint.total_send
         self.cur_sendqueue = self._dispersy.endpoint.cur_sendqueue
+        self.inbound = self._dispersy.endpoint.get_inbound_statistics()
 
         self.communities = [community.statistics for community in self._dispersy.get_communities()]
         for community in self.communities:
@@ -181,6 +190,8 @@ class DispersyStatistics(Statistics):
         # represents a key from the attach_runtime_statistics decorator
         self.runtime = [statistic.get_dict(entry=entry) for entry, statistic in _runtime_statistics.iteritems()]
 
+        self.callback = self._dispersy.callback.get_statistics()
+
     def reset(self):
         self.success_count = 0
         self.drop_count = 0
@@ -196,6 +207,9 @@ class DispersyStatistics(Statistics):
         self.total_up = self._dispersy.endpoint.total_up
         self.total_send = self._dispersy.endpoint.total_send
         self.cur_sendqueue = self._dispersy.endpoint.cur_sendqueue
+        self.inbound = self._dispersy.endpoint.get_inbound_statistics()
+        self._dispersy.callback.reset_statistics()
+        self.callback = self._dispersy.callback.get_statistics()
         self.start = self.timestamp = time()
 
         self.walk_attempt = 0
@@ -256,6 +270,6 @@ class CommunityStatistics(Statistics):
                            for candidate
                            in self._community.candidates.itervalues() if candidate.get_category(now) in [u'walk', u'stumble', u'intro']]
         if database:
-            self.database = dict(self._community.dispersy.database.execute(u"SELECT meta_message.name, COUNT(sync.id) FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? GROUP BY sync.meta_message", (self._community.database_id,)))
+            self.database = dict(self._community.dispersy.database.execute_read(u"SELECT meta_message.name, COUNT(sync.id) FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? GROUP BY sync.meta_message", (self._community.database_id,)))
         else:
             self.database = dict()
@@ -41,14 +41,14 @@ class DispersyTestFunc(TestCase):
         for dispersy in self.dispersy_objects:
             dispersy.stop()
 
-    def create_nodes(self, amount=1, store_identity=True, tunnel=False, communityclass=DebugCommunity):
+    def create_nodes(self, amount=1, store_identity=True, tunnel=False, communityclass=DebugCommunity, bloom_filter_processes=0):
         nodes = []
         for _ in range(amount):
             DispersyTestFunc._thread_counter += 1
             callback = Callback("Test-%d" % (self._thread_counter,))
             callback.attach_exception_handler(self.on_callback_exception)
 
-            dispersy = Dispersy(callback, ManualEnpoint(0), u".", u":memory:")
+            dispersy = Dispersy(callback, ManualEnpoint(0), u".", u":memory:", bloom_filter_processes=bloom_filter_processes)
             dispersy.start()
 
             self.dispersy_objects.append(dispersy)
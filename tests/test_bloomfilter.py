@@ -1,7 +1,7 @@
 from time import time
 from unittest import TestCase
 
-from ..bloomfilter import BloomFilter
+from ..bloomfilter import BloomFilter, CountingBloomFilter, not_filter_indexes_task
 from ..decorator import attach_profiler
 from ..logger import get_logger
 logger = get_logger(__name__)
@@ -120,3 +120,95 @@ class TestBloomFilter(TestCase):
             self.assertTrue(all(str(i) in bloom for i in xrange(n_capacity)))
             false_positives = sum(str(i) in bloom for i in xrange(n_capacity, n_capacity + 10000))
             self.assertAlmostEqual(1.0 * false_positives / 10000, f_error_rate, delta=0.05)
+
+    def test_not_filter_indexes(self):
+        """
+        Testing BloomFilter.not_filter_indexes() against BloomFilter.not_filter()
+        """
+        # the m_size values select the H and L struct formats
+        for m_size in (128 * 8, (1 << 15) + 8):
+            bloom = BloomFilter(m_size, 0.01, "p")
+            bloom.add_keys(str(i) for i in xrange(100))
+            keys = [str(i) for i in xrange(50, 1050)]
+
+            expected = [keys.index(key) for key, in bloom.not_filter((key,) for key in keys)]
+            self.assertEqual(bloom.not_filter_indexes(keys), expected)
+            self.assertEqual(bloom._not_filter_indexes_python(bloom._get_digests(keys)), expected)
+            self.assertTrue(all(index >= 50 for index in expected))
+            self.assertEqual(bloom.not_filter_indexes([]), [])
+
+    def test_not_filter_indexes_task(self):
+        """
+        Testing not_filter_indexes_task((bytes, functions, prefix, keys))
+        """
+        bloom = BloomFilter(128 * 8, 0.01, "p")
+        bloom.add_keys(str(i) for i in xrange(100))
+        keys = [str(i) for i in xrange(50, 150)]
+        self.assertEqual(not_filter_indexes_task((bloom.bytes, bloom.functions, bloom.prefix, keys)), bloom.not_filter_indexes(keys))
+
+    def test_bytes_layout(self):
+        """
+        Testing that bit POS is stored in byte POS / 8, least significant bit first.
+        """
+        bloom = BloomFilter(16, 0.25)
+        self.assertEqual(bloom.bytes, "\x00\x00")
+
+        # the bit positions are derived from the hash, hence we set them through the bytes constructor
+        bloom = BloomFilter("\x01\x80", bloom.functions)
+        self.assertEqual(bloom.bits_checked, 2)
+        self.assertEqual(bloom.bytes, "\x01\x80")
+
+        bloom.clear()
+        self.assertEqual(bloom.bits_checked, 0)
+        self.assertEqual(bloom.bytes, "\x00\x00")
+
+    def test_counting_remove(self):
+        """
+        Testing CountingBloomFilter.remove_keys()
+        """
+        bloom = CountingBloomFilter(128 * 8, 0.01, "p")
+        plain = BloomFilter(128 * 8, 0.01, "p")
+        bloom.add_keys(str(i) for i in xrange(100))
+        plain.add_keys(str(i) for i in xrange(50))
+
+        bloom.remove_keys(str(i) for i in xrange(50, 100))
+        self.assertTrue(all(str(i) in bloom for i in xrange(50)))
+        self.assertEqual(bloom.bytes, plain.bytes)
+
+        # the received filter is an ordinary bloom filter
+        received = BloomFilter(bloom.bytes, bloom.functions, bloom.prefix)
+        self.assertTrue(all(str(i) in received for i in xrange(50)))
+
+        bloom.remove_keys(str(i) for i in xrange(50))
+        self.assertEqual(bloom.bits_checked, 0)
+
+    def test_counting_remove_absent(self):
+        """
+        Testing CountingBloomFilter.remove_keys() with a key that was not added
+        """
+        bloom = CountingBloomFilter(128 * 8, 0.01, "p")
+        bloom.add_keys(str(i) for i in xrange(10))
+        bytes_ = bloom.bytes
+        counters = bloom._counters[:]
+
+        absent = next(str(i) for i in xrange(10, 1000) if not str(i) in bloom)
+        self.assertRaises(ValueError, bloom.remove, absent)
+        self.assertEqual(bloom.bytes, bytes_)
+        self.assertEqual(bloom._counters, counters)
+        self.assertTrue(all(str(i) in bloom for i in xrange(10)))
+
+        # the keys before the absent key are removed
+        self.assertRaises(ValueError, bloom.remove_keys, ["0", absent, "1"])
+        self.assertNotIn("0", bloom)
+        self.assertTrue(all(str(i) in bloom for i in xrange(1, 10)))
+
+    def test_counting_load_constructor(self):
+        """
+        Testing CountingBloomFilter(str:bytes, int:k_functions, str:prefix="")
+        """
+        bloom = BloomFilter(128 * 8, 0.01, "p")
+        bloom.add("a")
+        counting = CountingBloomFilter(bloom.bytes, bloom.functions, bloom.prefix)
+        self.assertIn("a", counting)
+        counting.remove("a")
+        self.assertEqual(counting.bits_checked, 0)
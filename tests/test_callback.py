@@ -1,7 +1,13 @@
 from time import time, sleep
 from threading import Thread
+from unittest import TestCase, skipIf
+import socket
 
 from .dispersytestclass import DispersyTestFunc, call_on_mm_thread
+from .. import asynciocallback
+from ..asynciocallback import AsyncioCallback
+from ..callback import Callback, TimingWheelTimers
+from ..endpoint import AsyncioEndpoint
 
 
 class TestCallback(DispersyTestFunc):
@@ -172,3 +178,378 @@ class TestCallback(DispersyTestFunc):
         thread.start()
         thread.join(2.0)
         self.assertFalse(thread.is_alive())
+
+    @call_on_mm_thread
+    def test_unregister(self):
+        """
+        Unregistered tasks must not be called and the heaps are compacted once most of their entries
+        are unregistered.
+        """
+        def register_delay_func():
+            container[0] += 1
+
+        container = [0]
+        callback = self._dispersy.callback
+
+        ids = [callback.register(register_delay_func, delay=1.0) for _ in xrange(1000)]
+        for id_ in ids[10:]:
+            callback.unregister(id_)
+        self.assertLess(len(callback._requests), 1000)
+
+        # unregistered ids may be registered again
+        callback.persistent_register(ids[-1], register_delay_func, delay=1.0)
+
+        yield 1.5
+        self.assertEqual(container[0], 11)
+
+    @call_on_mm_thread
+    def test_statistics(self):
+        """
+        Every call must be counted in the duration and lag histograms of its function and the
+        statistics must be available from Dispersy.statistics.
+        """
+        def statistics_func():
+            sleep(0.02)
+
+        callback = self._dispersy.callback
+        for _ in xrange(10):
+            callback.register(statistics_func)
+        callback.register(sleep, (0.2,), priority=128)
+        yield 0.5
+
+        self._dispersy.statistics.update()
+        statistics = self._dispersy.statistics.callback
+        self.assertGreaterEqual(statistics["max_expired"], 11)
+        tasks = dict((task["entry"], task) for task in statistics["tasks"])
+        self.assertEqual(tasks["statistics_func"]["count"], 10)
+        # each call takes between 10 and 100 ms and waits at least 100 ms for the sleep
+        self.assertEqual(tasks["statistics_func"]["duration_histogram"], [0, 0, 10, 0, 0, 0])
+        self.assertEqual(tasks["statistics_func"]["lag_histogram"], [0, 0, 0, 10, 0, 0])
+        self.assertEqual(tasks["sleep"]["count"], 1)
+
+
+class TestCallbackCall(TestCase):
+
+    def setUp(self):
+        self.callback = Callback("Test-Call")
+        self.callback.start()
+
+    def tearDown(self):
+        self.assertTrue(self.callback.stop())
+
+    def test_waiters(self):
+        """
+        Callback.call must reuse its waiters, but not after a timeout.
+        """
+        def raise_func():
+            raise ValueError("raise_func")
+
+        callback = self.callback
+        for index in xrange(10):
+            self.assertEqual(callback.call(lambda: index), index)
+        self.assertRaises(ValueError, callback.call, raise_func)
+        self.assertEqual(callback.call(lambda: None, default="default"), None)
+        self.assertEqual(len(callback._waiters), 1)
+
+        self.assertEqual(callback.call(sleep, (0.5,), timeout=0.1, default="timeout"), "timeout")
+        self.assertEqual(len(callback._waiters), 0)
+
+    def test_direct(self):
+        """
+        A direct call from the callback thread must be made before other expired calls.
+        """
+        def generator_func():
+            container.append("generator_func")
+            yield 0.0
+            container.append("generator_func")
+
+        def direct_func():
+            callback.register(container.append, ("register",), priority=128)
+            container.append(callback.call(lambda: "direct", direct=True))
+            container.append(callback.call(generator_func, direct=True))
+
+        container = []
+        callback = self.callback
+        callback.call(direct_func)
+        self.assertEqual(container, ["direct", "register", "generator_func", "generator_func", None])
+
+    def test_call_many(self):
+        """
+        Callback.call_many must return the results of all calls in order, or raise.
+        """
+        def raise_func():
+            raise ValueError("raise_func")
+
+        callback = self.callback
+        self.assertEqual(callback.call_many([(lambda x: x, (1,), None),
+                                             (lambda x, y: x + y, (1,), dict(y=2)),
+                                             (lambda: callback.is_current_thread, (), None)]), [1, 3, True])
+        self.assertRaises(ValueError, callback.call_many, [(raise_func, (), None)])
+
+    def test_handle_exception(self):
+        """
+        Callback.handle_exception must give the exception to the exception handlers, also when
+        called from another thread, and must stop the thread when a handler considers it fatal.
+        """
+        def handler(exception, fatal):
+            exceptions.append((exception, fatal))
+            return isinstance(exception, KeyError)
+
+        exceptions = []
+        callback = self.callback
+        callback.attach_exception_handler(handler)
+
+        value_error = ValueError("value_error")
+        callback.handle_exception(value_error)
+        self.assertTrue(callback.is_running)
+
+        key_error = KeyError("key_error")
+        callback.handle_exception(key_error)
+        self.assertTrue(callback.join(1.0))
+        self.assertIs(callback.exception, key_error)
+        self.assertEqual(exceptions, [(value_error, False), (key_error, False)])
+
+
+class TestTimingWheelTimers(TestCase):
+
+    def test_expire(self):
+        """
+        Entries must expire in deadline order, also when they are due in a later revolution.
+        """
+        now = time()
+        timers = TimingWheelTimers(0.1, 8)
+        entries = [[now + delay, 0, u"id-%f" % delay, None, None] for delay in (5.0, 0.35, 0.05, 0.3, 0.0, 1.55)]
+        for entry in entries:
+            timers.push(entry)
+        self.assertEqual(len(timers), 6)
+        self.assertEqual(timers.next_deadline(), now)
+
+        self.assertEqual(timers.pop_expired(now + 0.31), sorted(entries)[:3])
+        self.assertEqual(timers.next_deadline(), now + 0.35)
+        self.assertEqual(timers.pop_expired(now + 1.0), sorted(entries)[3:4])
+        self.assertEqual(timers.next_deadline(), now + 1.55)
+        self.assertEqual(timers.pop_expired(now + 2.0), sorted(entries)[4:5])
+        self.assertEqual(timers.pop_expired(now + 10.0), sorted(entries)[5:])
+        self.assertEqual(len(timers), 0)
+        self.assertIsNone(timers.next_deadline())
+
+    def test_next_deadline_wraparound(self):
+        """
+        next_deadline must return the earliest deadline after the cursor wrapped around the wheel,
+        also when a bucket contains entries of several revolutions.
+        """
+        now = time()
+        timers = TimingWheelTimers(0.1, 8)
+        # pass two revolutions without any entries
+        self.assertEqual(timers.pop_expired(now + 2.0), [])
+        self.assertIsNone(timers.next_deadline())
+
+        # 3.05 and 2.25 share a bucket, 3.05 is one revolution later
+        entries = [[now + delay, 0, u"id-%f" % delay, None, None] for delay in (3.05, 2.25, 2.6)]
+        for entry in entries:
+            timers.push(entry)
+        self.assertEqual(timers.next_deadline(), now + 2.25)
+
+        self.assertEqual(timers.pop_expired(now + 2.3), [entries[1]])
+        self.assertEqual(timers.next_deadline(), now + 2.6)
+        self.assertEqual(timers.pop_expired(now + 2.9), [entries[2]])
+        self.assertEqual(timers.next_deadline(), now + 3.05)
+
+        # an earlier entry pushed after the later revolution
+        entry = [now + 2.95, 0, u"id-early", None, None]
+        timers.push(entry)
+        self.assertEqual(timers.next_deadline(), now + 2.95)
+        self.assertEqual(timers.pop_expired(now + 3.1), [entry, entries[0]])
+        self.assertIsNone(timers.next_deadline())
+        self.assertEqual(timers._ticks, [])
+
+    def test_callback(self):
+        """
+        A Callback using TimingWheelTimers must call delayed tasks and handle expired tasks by
+        priority.
+        """
+        def func(priority):
+            container.append(priority)
+
+        container = []
+        callback = Callback("Test-Wheel", timers=TimingWheelTimers)
+        callback.start()
+        try:
+            for priority in (-10, 10, 0):
+                callback.register(func, (priority,), delay=0.2, priority=priority)
+            callback.unregister(callback.register(func, (99,), delay=0.2))
+            sleep(0.5)
+            # a low priority call is handled after all expired tasks
+            callback.call(lambda: None, priority=-128)
+            self.assertEqual(container, [10, 0, -10])
+        finally:
+            callback.stop()
+
+
+class TestCallbackDrain(TestCase):
+
+    def test_drain(self):
+        """
+        A Callback draining several expired tasks at once must handle them by priority and must not
+        handle tasks that are unregistered by a task in the same drain.
+        """
+        def func(priority):
+            container.append(priority)
+
+        def unregister_func():
+            container.append("unregister")
+            callback.unregister(id_)
+
+        container = []
+        callback = Callback("Test-Drain", drain_size=100)
+        callback.start()
+        try:
+            # block the thread to ensure that all tasks below have expired at the next drain
+            callback.register(sleep, (0.2,))
+            for priority in xrange(10):
+                callback.register(func, (priority,), priority=priority)
+            callback.register(unregister_func, priority=20)
+            id_ = callback.register(func, (-1,), priority=-1)
+
+            sleep(0.5)
+            callback.call(lambda: None, priority=-128)
+            self.assertEqual(container, ["unregister"] + range(9, -1, -1))
+        finally:
+            callback.stop()
+
+    def test_drain_unregister(self):
+        """
+        Unregistering tasks that are taken by the current drain must keep the tombstone count equal
+        to the unregistered entries in the heaps, also when the heaps are compacted during the drain
+        and when the drain returns the unregistered tasks to the heap.
+        """
+        def func():
+            container.append("func")
+
+        def unregister_func():
+            container.append("unregister")
+            for id_ in ids:
+                callback.unregister(id_)
+
+        def get_tombstones():
+            entries = list(callback._expired) + list(callback._requests._heap)
+            return callback._tombstones, sum(1 for entry in entries if entry[3] is None)
+
+        container = []
+        callback = Callback("Test-Drain", drain_size=200, drain_duration=0.05)
+        callback.start()
+        try:
+            # block the thread to ensure that all tasks below are taken by the same drain
+            callback.register(sleep, (0.2,))
+            callback.register(unregister_func, priority=20)
+            # exceeds the drain duration, hence the unregistered tasks are returned to the heap
+            callback.register(sleep, (0.1,), priority=10)
+            ids = [callback.register(func) for _ in xrange(100)]
+
+            sleep(0.5)
+            self.assertEqual(callback.call(get_tombstones, priority=-128), (0, 0))
+            self.assertEqual(container, ["unregister"])
+        finally:
+            callback.stop()
+
+
+@skipIf(asynciocallback.asyncio is None, "requires asyncio or trollius")
+class TestAsyncioCallback(TestCase):
+
+    def setUp(self):
+        self.callback = AsyncioCallback("Test-Asyncio")
+        self.callback.start()
+
+    def tearDown(self):
+        self.assertTrue(self.callback.stop())
+
+    def test_register(self):
+        """
+        Registered tasks and generators must be called by priority, also when registered from
+        another thread while the event loop is waiting for a delayed task.
+        """
+        def generator_func(priority):
+            for _ in xrange(3):
+                container.append(priority)
+                yield 0.01
+
+        def func(priority):
+            container.append(priority)
+
+        container = []
+        callback = self.callback
+        callback.register(func, (-1,), delay=60.0)
+        callback.unregister(callback.register(func, (99,), delay=0.1))
+        callback.register(sleep, (0.1,), priority=128)
+        callback.register(generator_func, (10,), priority=10)
+        callback.register(func, (20,), priority=20)
+        callback.register(func, (0,), delay=0.2)
+
+        sleep(0.5)
+        self.assertEqual(callback.call(lambda: len(container), priority=-128), 5)
+        self.assertEqual(container, [20, 10, 10, 10, 0])
+
+    def test_call(self):
+        """
+        Callback.call must return results and raise exceptions, both from another thread and from
+        the callback thread itself.
+        """
+        def raise_func():
+            raise ValueError("raise_func")
+
+        def nested_call():
+            return self.callback.call(lambda: self.callback.is_current_thread)
+
+        self.assertEqual(self.callback.call(lambda: 42), 42)
+        self.assertRaises(ValueError, self.callback.call, raise_func)
+        self.assertTrue(self.callback.call(nested_call))
+
+    def test_stop(self):
+        """
+        Stopping from another thread must not wait for the deadline of a pending task.
+        """
+        callback = self.callback
+        callback.register(lambda: None, delay=300.0)
+        # let the event loop schedule its next _tick at the 300 second deadline
+        callback.call(lambda: None)
+        sleep(0.1)
+
+        begin = time()
+        self.assertTrue(callback.stop(timeout=5.0))
+        self.assertLess(time() - begin, 1.0)
+
+    def test_endpoint(self):
+        """
+        AsyncioEndpoint must give incoming packets to Dispersy on the callback thread.
+        """
+        class Statistics(object):
+            endpoint_recv = {}
+
+            def dict_inc(self, *args):
+                pass
+
+        class Dispersy(object):
+            callback = self.callback
+            statistics = Statistics()
+
+            def on_incoming_packets(self, packets, cache, timestamp):
+                container.extend((data, self.callback.is_current_thread) for _, data in packets)
+
+        container = []
+        endpoint = AsyncioEndpoint(0, "127.0.0.1")
+        self.assertTrue(self.callback.call(endpoint.open, (Dispersy(),)))
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for data in ("a" * 30, "b" * 30):
+                sock.sendto(data, endpoint.get_address())
+            sock.close()
+
+            for _ in xrange(100):
+                if len(container) == 2:
+                    break
+                sleep(0.01)
+            self.assertEqual(container, [("a" * 30, True), ("b" * 30, True)])
+            self.assertEqual(endpoint.total_down, 60)
+
+        finally:
+            self.assertTrue(self.callback.call(endpoint.close))
@@ -0,0 +1,163 @@
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+import os
+
+from ..database import Database
+from ..decorator import _runtime_statistics
+
+
+class TestingDatabase(Database):
+
+    def check_database(self, database_version):
+        self.execute(u"CREATE TABLE IF NOT EXISTS option(key TEXT PRIMARY KEY, value BLOB)")
+        self.execute(u"CREATE TABLE IF NOT EXISTS item(id INTEGER PRIMARY KEY AUTOINCREMENT, value INTEGER)")
+        return 1
+
+
+class TestDatabase(TestCase):
+
+    def setUp(self):
+        self.database = TestingDatabase(u":memory:")
+        self.database.open()
+        self.commits = []
+        self.database.attach_commit_callback(lambda exiting: self.commits.append(exiting))
+
+    def tearDown(self):
+        self.database.close()
+
+    def test_commit_threshold_rows(self):
+        """
+        Rows registered with add_uncommitted_rows must make a commit due once max_rows rows changed,
+        and a commit must reset the count.
+        """
+        database = self.database
+        database.set_commit_threshold(10, 60.0)
+
+        database.executemany(u"INSERT INTO item (value) VALUES (?)", [(value,) for value in xrange(6)])
+        self.assertFalse(database.add_uncommitted_rows(6))
+        self.assertEqual(database.uncommitted_rows, 6)
+        self.assertEqual(self.commits, [])
+
+        database.executemany(u"INSERT INTO item (value) VALUES (?)", [(value,) for value in xrange(4)])
+        self.assertTrue(database.add_uncommitted_rows(4))
+        self.assertTrue(database.commit_due)
+
+        database.commit()
+        self.assertEqual(self.commits, [False])
+        self.assertEqual(database.uncommitted_rows, 0)
+        self.assertFalse(database.commit_due)
+
+    def test_commit_threshold_delay(self):
+        """
+        Rows registered with add_uncommitted_rows must make a commit due once max_delay seconds
+        passed since the previous commit.
+        """
+        database = self.database
+        database.set_commit_threshold(1000, 0.2)
+        database.commit()
+
+        self.assertFalse(database.add_uncommitted_rows(1))
+        self.assertGreater(database.commit_timeout, 0.0)
+        sleep(0.3)
+        self.assertEqual(database.commit_timeout, 0.0)
+        self.assertTrue(database.commit_due)
+
+    def test_commit_threshold_deferred_commit(self):
+        """
+        A commit deferred by a 'with database:' block must not reset the pending rows until the
+        block exits.
+        """
+        database = self.database
+        database.set_commit_threshold(2, 60.0)
+        with database:
+            self.assertTrue(database.add_uncommitted_rows(2))
+            database.commit()
+            self.assertEqual(database.uncommitted_rows, 2)
+        self.assertEqual(database.uncommitted_rows, 0)
+        self.assertEqual(self.commits, [False])
+
+    def test_named_query(self):
+        """
+        A registered query must execute its statement and keep its runtime statistics by name.
+        """
+        database = self.database
+        database.register_query(u"item-insert", u"INSERT INTO item (value) VALUES (?)")
+        database.register_query(u"item-select", u"SELECT value FROM item WHERE id = ?")
+
+        rowid = database.executemany_query(u"item-insert", [(value,) for value in (40, 41, 42)], get_lastrowid=True)
+        self.assertEqual(database.execute_query(u"item-select", (rowid,)).fetchall(), [(42,)])
+        self.assertEqual(database.get_query(u"item-select"), u"SELECT value FROM item WHERE id = ?")
+
+        entries = [entry for entry in _runtime_statistics if u"item-select" in entry]
+        self.assertEqual(entries, [u"TestingDatabase.execute_query item-select [:memory:]"])
+        self.assertEqual(_runtime_statistics[u"TestingDatabase.executemany_query item-insert [:memory:]"].count, 1)
+
+
+class TestReadOnlyConnectionPool(TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.database = TestingDatabase(os.path.join(unicode(self.directory), u"test.db"), read_connections=2)
+        self.database.open()
+
+    def tearDown(self):
+        self.database.close()
+        rmtree(self.directory)
+
+    def test_execute_read(self):
+        """
+        Other threads must read committed rows through the read-only connections while the opening
+        thread also sees its uncommitted rows.
+        """
+        def read():
+            try:
+                results.append(database.execute_read(u"SELECT value FROM item ORDER BY id"))
+            except Exception as exception:
+                results.append(exception)
+
+        def read_on_thread():
+            thread = Thread(target=read)
+            thread.start()
+            thread.join()
+            return results.pop()
+
+        results = []
+        database = self.database
+        self.assertEqual(database.read_pool.size, 2)
+
+        database.execute(u"INSERT INTO item (value) VALUES (42)")
+        database.commit()
+        database.execute(u"INSERT INTO item (value) VALUES (43)")
+
+        self.assertEqual(read_on_thread(), [(42,)])
+        self.assertEqual(database.execute_read(u"SELECT value FROM item ORDER BY id"), [(42,), (43,)])
+
+        database.commit()
+        self.assertEqual(read_on_thread(), [(42,), (43,)])
+
+        # the read-only connections may not write
+        result = []
+        thread = Thread(target=lambda: result.append(self.assertRaises(Exception, database.read_pool.execute, u"INSERT INTO item (value) VALUES (44)")))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(result), 1)
+        self.assertEqual(database.execute_read(u"SELECT COUNT(*) FROM item"), [(2,)])
+
+    def test_execute_read_without_pool(self):
+        """
+        Reading from another thread must fail when there are no read-only connections.
+        """
+        database = TestingDatabase(u":memory:", read_connections=2)
+        database.open()
+        try:
+            self.assertIsNone(database.read_pool)
+            results = []
+            thread = Thread(target=lambda: results.append(self.assertRaises(RuntimeError, database.execute_read, u"SELECT 1")))
+            thread.start()
+            thread.join()
+            self.assertEqual(len(results), 1)
+        finally:
+            database.close()
@@ -0,0 +1,64 @@
+from time import sleep
+from unittest import TestCase
+
+from .dispersytestclass import DispersyTestFunc
+from ..endpoint import InboundQueue, TUNNEL_PREFIX
+
+
+class TestInboundQueue(TestCase):
+
+    def packets(self, *message_bytes):
+        # a packet with a dispersy header, ending with the message byte, and a counter as payload
+        return [(("127.0.0.1", 1), "\x00" * 22 + chr(byte) + str(index)) for index, byte in enumerate(message_bytes)]
+
+    def test_drop_oldest(self):
+        queue = InboundQueue(3, u"drop-oldest")
+        packets = self.packets(1, 2, 3, 4, 5)
+        self.assertEqual(queue.put(packets[:2], 1.0), (True, 0))
+        self.assertEqual(queue.put(packets[2:], 2.0), (False, 2))
+        self.assertEqual(queue.take(), (packets[2:], 1.0))
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queue.high_water_mark, 3)
+        self.assertEqual(len(queue), 0)
+
+    def test_drop_newest(self):
+        queue = InboundQueue(3, u"drop-newest")
+        packets = self.packets(1, 2, 3, 4, 5)
+        queue.put(packets[:2], 1.0)
+        queue.put(packets[2:], 2.0)
+        self.assertEqual(queue.take(), (packets[:3], 1.0))
+        self.assertEqual(queue.put(packets, 3.0), (True, 2))
+        self.assertEqual(queue.dropped, 4)
+
+    def test_prefer_walker(self):
+        """
+        Walker packets, also when tunnelled, must be handled first and dropped last.
+        """
+        queue = InboundQueue(3, u"prefer-walker")
+        packets = self.packets(1, 246, 2, 245, 3)
+        packets.append((("127.0.0.1", 1), TUNNEL_PREFIX + "\x00" * 22 + chr(250)))
+        self.assertEqual(queue.put(packets, 1.0), (True, 3))
+        self.assertEqual(queue.take(), ([packets[1], packets[3], packets[5]], 1.0))
+
+        self.assertEqual(queue.put(packets[:4], 2.0), (True, 1))
+        self.assertEqual(queue.put(self.packets(246, 245), 3.0), (False, 2))
+        self.assertEqual([data[22] for _, data in queue.take()[0]], [chr(245), chr(246), chr(245)])
+
+
+class TestInboundLanes(DispersyTestFunc):
+
+    def test_lanes(self):
+        """
+        Identity packets must be queued in the control lane and other packets in the bulk lane.
+        """
+        other, = self.create_nodes()
+        self._dispersy.endpoint.reset_statistics()
+        self._mm.give_messages([other.create_identity(2), other.create_full_sync_text("bulk", 10)], other, cache=True)
+        sleep(0.1)
+
+        self._mm.call(self._dispersy.statistics.update)
+        self.assertEqual(self._dispersy.statistics.inbound,
+                         {u"control": dict(count=1, dropped=0, high_water_mark=1),
+                          u"bulk": dict(count=1, dropped=0, high_water_mark=1)})
+        self.assertEqual(other.fetch_messages([u"full-sync-text"]), [])
+        self.assertEqual(len(self._mm.fetch_messages([u"full-sync-text"])), 1)
@@ -1,3 +1,5 @@
+from hashlib import sha1
+
 from .debugcommunity.community import DebugCommunity
 from .debugcommunity.node import DebugNode
 from .dispersytestclass import DispersyTestFunc
@@ -29,6 +31,49 @@ class TestIdenticalPayload(DispersyTestFunc):
         other.assert_not_stored(messages[0])
         other.assert_is_stored(messages[1])
 
+    def test_replace_identical_payload_digest(self):
+        """
+        NODE creates two messages with the same community/member/global-time.  When the "highest"
+        one replaces the "lowest" one at OTHER, the stored digest and the managed bloom filter must
+        follow the replacement.
+        """
+        class DigestCommunity(DebugCommunity):
+            @property
+            def dispersy_sync_bloom_filter_digest_enable(self):
+                return True
+
+            @property
+            def dispersy_sync_bloom_filter_counting_enable(self):
+                return True
+
+        def claim():
+            return community._dispersy_claim_sync_bloom_filter_largest(None)
+
+        def get_digest():
+            digest, = community.dispersy.database.execute(u"SELECT digest FROM sync WHERE community = ? AND global_time = ?",
+                                                          (community.database_id, 42)).next()
+            return str(digest)
+
+        node, other = self.create_nodes(2, communityclass=DigestCommunity)
+        other.send_identity(node)
+        community = other._community
+
+        messages = [node.create_full_sync_text("Identical payload message", 42) for _ in xrange(2)]
+        messages.sort(key=lambda x: x.packet)
+        low, high = [sha1(message.packet).digest() for message in messages]
+
+        other.give_message(messages[0], node)
+        time_low, time_high, _, _, bloom_filter = other.call(claim)
+        self.assertTrue(time_low <= 42 <= time_high)
+        self.assertIn(low, bloom_filter)
+
+        other.give_message(messages[1], node)
+        other.assert_is_stored(messages[1])
+        self.assertEqual(other.call(get_digest), high)
+        self.assertEqual(other.call(community._sync_bloom_filters.get, 42), (time_low, time_high, bloom_filter))
+        self.assertIn(high, bloom_filter)
+        self.assertNotIn(low, bloom_filter)
+
     def test_drop_identical(self):
         """
         NODE creates one message, sends it to OTHER twice
@@ -0,0 +1,144 @@
+from time import sleep, time
+from unittest import TestCase
+
+from .debugcommunity.community import DebugCommunity
+from .dispersytestclass import DispersyTestFunc, call_on_mm_thread
+from ..callback import Callback
+from ..periodic import PeriodicDispatcher
+
+
+class TestPeriodicDispatcher(TestCase):
+
+    def setUp(self):
+        self.callback = Callback("Test-Periodic")
+        self.callback.start()
+        self.periodic = PeriodicDispatcher(self.callback)
+
+    def tearDown(self):
+        self.assertTrue(self.callback.stop())
+
+    def test_shared_task(self):
+        """
+        Owners attached to the same job and interval must share one task and are called in the
+        order in which they were attached.
+        """
+        def func(owner):
+            container.append(owner)
+            if owner == "detach":
+                periodic.detach("other")
+
+        container = []
+        periodic = self.periodic
+        callback = self.callback
+        for owner in ("first", "detach", "other"):
+            callback.call(periodic.attach, (u"job", 0.1, owner, lambda owner=owner: func(owner)))
+        callback.call(periodic.attach, (u"job", 0.5, "slow", lambda: func("slow")))
+        self.assertEqual(len(callback._requests), 2)
+        self.assertEqual(sorted(callback.call(periodic.get_owners, (u"job",))), ["detach", "first", "other", "slow"])
+
+        sleep(0.25)
+        callback.call(periodic.detach, ("first",))
+        callback.call(periodic.detach, ("detach",))
+        self.assertEqual(container[:2], ["first", "detach"])
+        self.assertEqual(container.count("first"), container.count("detach"))
+        self.assertNotIn("other", container)
+
+        # the job stops once all owners are detached
+        sleep(0.3)
+        self.assertEqual(callback.call(periodic.get_owners, (u"job",)), ["slow"])
+        self.assertEqual(len(callback._requests), 1)
+
+    def test_phase(self):
+        """
+        Owners attached with a phase must be called that many seconds after the other owners of the
+        job, and every interval after that.
+        """
+        container = []
+        periodic = self.periodic
+        callback = self.callback
+        callback.call(periodic.attach, (u"job", 0.4, "first", lambda: container.append(("first", time()))))
+        callback.call(periodic.attach, (u"job", 0.4, "phased", lambda: container.append(("phased", time())), 0.2))
+        self.assertEqual(len(callback._requests), 1)
+
+        sleep(1.1)
+        callback.call(periodic.detach, ("first",))
+        callback.call(periodic.detach, ("phased",))
+        self.assertEqual([owner for owner, _ in container], ["first", "phased", "first", "phased"])
+        times = [timestamp for _, timestamp in container]
+        for previous, current in zip(times, times[1:]):
+            self.assertAlmostEqual(current - previous, 0.2, delta=0.05)
+
+    def test_exception(self):
+        """
+        A failing function must be detached and its exception given to the Callback exception
+        handlers, while the other owners continue.
+        """
+        def fail():
+            container.append("fail")
+            raise ValueError("fail")
+
+        def handler(exception, fatal):
+            exceptions.append((type(exception), fatal))
+
+        container = []
+        exceptions = []
+        periodic = self.periodic
+        callback = self.callback
+        callback.attach_exception_handler(handler)
+        try:
+            callback.call(periodic.attach, (u"job", 0.1, "fail", fail))
+            callback.call(periodic.attach, (u"job", 0.1, "other", lambda: container.append("other")))
+
+            sleep(0.35)
+            self.assertEqual(container.count("fail"), 1)
+            self.assertGreater(container.count("other"), 1)
+            self.assertEqual(exceptions, [(ValueError, False)])
+            self.assertEqual(callback.call(periodic.get_owners, (u"job",)), ["other"])
+
+        finally:
+            callback.detach_exception_handler(handler)
+
+
+class TestCommunityPeriodic(DispersyTestFunc):
+
+    @call_on_mm_thread
+    def test_intervals(self):
+        """
+        Communities must attach their periodic jobs to the shared dispatcher, may opt out, and
+        must detach when unloaded.
+        """
+        class NoCleanCommunity(DebugCommunity):
+
+            @property
+            def dispersy_clean_delayed_interval(self):
+                return None
+
+        periodic = self._dispersy.periodic
+        self.assertEqual(periodic.get_owners(u"clean-delayed"), [self._community])
+
+        community = NoCleanCommunity.create_community(self._dispersy, self._mm._my_member)
+        self.assertEqual(periodic.get_owners(u"clean-delayed"), [self._community])
+
+        self._community.unload_community()
+        self.assertEqual(periodic.get_owners(u"clean-delayed"), [])
+        community.unload_community()
+
+    def test_periodically_clean_delayed(self):
+        """
+        A community that overrides the _periodically_clean_delayed generator must have it called
+        instead of being attached to the clean-delayed job.
+        """
+        class LegacyCommunity(DebugCommunity):
+
+            def _periodically_clean_delayed(self):
+                while True:
+                    container.append(self)
+                    yield 5.0
+
+        container = []
+        callback = self._dispersy.callback
+        community = callback.call(lambda: LegacyCommunity.create_community(self._dispersy, self._mm._my_member))
+        sleep(0.1)
+        self.assertEqual(container, [community])
+        self.assertEqual(callback.call(self._dispersy.periodic.get_owners, (u"clean-delayed",)), [self._community])
+        callback.call(community.unload_community)
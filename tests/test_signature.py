@@ -1,6 +1,7 @@
 from time import sleep
 from unittest.case import skip
 
+from .debugcommunity.community import DebugCommunity
 from .debugcommunity.node import DebugNode
 from .dispersytestclass import DispersyTestFunc
 from ..logger import get_logger
@@ -51,6 +52,31 @@ class TestSignature(DispersyTestFunc):
 
         self.assertEqual(other.fetch_messages([u"full-sync-text", ]), [])
 
+    def test_verify_threads(self):
+        """
+        NODE sends a batch of messages to OTHER, who verifies the signatures on a thread pool.
+        OTHER should store the valid messages and drop the one containing an invalid signature.
+        """
+        class VerifyCommunity(DebugCommunity):
+            @property
+            def dispersy_verify_threads(self):
+                return 2
+
+        node, other = self.create_nodes(2, communityclass=VerifyCommunity)
+        other.send_identity(node)
+
+        messages = [node.create_full_sync_text("Message %d" % i, i + 10) for i in xrange(10)]
+        packets = [node.encode_message(message) for message in messages]
+
+        # replace the valid signature of the fifth message with an invalid one
+        packets[4] = packets[4][:-node.my_member.signature_length] + 'I' * node.my_member.signature_length
+
+        # give the batch to OTHER
+        other.give_packets(packets, node)
+
+        global_times = sorted(message.distribution.global_time for message in other.fetch_messages([u"full-sync-text", ]))
+        self.assertEqual(global_times, [i + 10 for i in xrange(10) if i != 4])
+
 class TestDoubleSign(DispersyTestFunc):
 
     def test_no_response_from_node(self):
@@ -1,6 +1,14 @@
+from hashlib import sha1
+from itertools import islice
+import logging
+from unittest import TestCase
 from unittest.case import skip
 
+from .debugcommunity.community import DebugCommunity
 from .dispersytestclass import DispersyTestFunc
+from ..bloomfilter import BloomFilter, CountingBloomFilter
+from ..community import SyncBloomFilterManager, SyncKeyIndex, SyncResponseCache
+from ..database import Database, explain_query_plan, _explain_query_plan
 from ..logger import get_logger
 
 logger = get_logger(__name__)
@@ -224,6 +232,34 @@ class TestSync(DispersyTestFunc):
         for _, message in messages_so_far:
             node.assert_is_stored(message)
 
+    def test_last_9_store_batch(self):
+        """
+        Storing a batch of messages from several members must assign the packet ids of the stored
+        rows and keep only the last nine messages of each member.
+        """
+        node, other, another = self.create_nodes(3)
+        other.send_identity(node)
+        another.send_identity(node)
+
+        messages = [creator.create_last_9_test(str(global_time), global_time)
+                    for global_time in [25, 21, 32, 20, 28, 30, 27, 22, 31, 23, 24, 26]
+                    for creator in (other, another)]
+        node.give_messages(messages, other)
+
+        for index in (0, 1):
+            created = sorted(messages[index::2], key=lambda message: message.distribution.global_time)
+            node.assert_not_stored(messages=created[:3])
+            node.assert_is_stored(messages=created[3:])
+
+        # the messages stored by their creator must reference their own rows
+        created = messages[0::2]
+        other.store(created)
+        packets = other.call(lambda: dict(other._dispersy.database.execute(u"SELECT id, packet FROM sync WHERE meta_message = ?",
+                                                                            (created[0].database_id,))))
+        kept = sorted(created, key=lambda message: message.distribution.global_time)[3:]
+        self.assertEqual(dict((packet_id, str(packet)) for packet_id, packet in packets.iteritems()),
+                         dict((message.packet_id, message.packet) for message in kept))
+
     def test_last_1_doublemember(self):
         """
         Normally the LastSyncDistribution policy stores the last N messages for each member that
@@ -349,3 +385,294 @@ class TestSync(DispersyTestFunc):
         create_double_signed_message(nodeC, nodeA, "Allow=True (2CA)", old_global_time)
 
         check_database_contents()
+
+    def test_digest_bloom_filter(self):
+        """
+        NODE uses the packet digests as bloom filter keys, only the packets whose digest is not in
+        the bloom filter may be sent back.
+        """
+        class DigestCommunity(DebugCommunity):
+            @property
+            def dispersy_sync_bloom_filter_digest_enable(self):
+                return True
+
+        node, other = self.create_nodes(2, communityclass=DigestCommunity)
+        other.send_identity(node)
+
+        messages = [other.create_full_sync_text("Message %d" % i, i + 10) for i in xrange(30)]
+        other.store(messages)
+
+        # NODE already has the even messages
+        known = [message for message in messages if message.distribution.global_time % 2 == 0]
+        global_times = [message.distribution.global_time for message in messages if message.distribution.global_time % 2 == 1]
+
+        sync = (1, 0, 1, 0, [sha1(message.packet).digest() for message in known])
+        other.give_message(node.create_introduction_request(other.my_candidate, node.lan_address, node.wan_address, False, u"unknown", sync, 42), node)
+
+        responses = node.receive_messages(names=[u"full-sync-text"])
+        response_times = [message.distribution.global_time for _, message in responses]
+
+        self.assertEqual(sorted(global_times), sorted(response_times))
+
+    def test_bloom_filter_processes(self):
+        """
+        NODE sends two introduction requests in one batch, the bloom filters are evaluated by worker
+        processes and only the packets missing from each bloom filter may be sent back.
+        """
+        class DigestCommunity(DebugCommunity):
+            @property
+            def dispersy_sync_bloom_filter_digest_enable(self):
+                return True
+
+        node, other = self.create_nodes(2, communityclass=DigestCommunity, bloom_filter_processes=2)
+        other.send_identity(node)
+        self.assertIsNotNone(other._dispersy.bloom_filter_pool)
+
+        messages = [other.create_full_sync_text("Message %d" % i, i + 10) for i in xrange(30)]
+        other.store(messages)
+
+        even = [message for message in messages if message.distribution.global_time % 2 == 0]
+        odd = [message for message in messages if message.distribution.global_time % 2 == 1]
+        requests = [node.create_introduction_request(other.my_candidate, node.lan_address, node.wan_address, False, u"unknown", (1, 0, 1, 0, [sha1(message.packet).digest() for message in known]), 42 + index)
+                    for index, known in enumerate((even, odd))]
+        other.give_messages(requests, node)
+
+        responses = node.receive_messages(names=[u"full-sync-text"], return_after=len(messages))
+        response_times = [message.distribution.global_time for _, message in responses]
+        self.assertEqual(sorted(response_times), sorted(message.distribution.global_time for message in messages))
+
+    def test_paged_packets_for_bloomfilters(self):
+        """
+        Reading the packets in small pages must return every packet exactly once, in global time
+        order, also when several members created a message at the same global time.
+        """
+        node, other = self.create_nodes(2)
+        other.send_identity(node)
+
+        messages = [other.create_full_sync_text("Message %d" % i, i + 10) for i in xrange(10)]
+        other.store(messages)
+
+        # NODE creates messages with the same global times
+        node_messages = [node.create_full_sync_text("Message %d" % i, i + 10) for i in xrange(10)]
+        other.give_messages(node_messages, node)
+        messages += node_messages
+
+        def get_packets(page_size):
+            _, packets = other._community._get_packets_for_bloomfilters([[None, 1, 100, 0, 1]], page_size=page_size).next()
+            return [packet for packet, _ in packets]
+
+        global_times = dict((message.packet, message.distribution.global_time) for message in messages)
+        for page_size in (1, 3, 128):
+            # ignore other syncable messages, such as dispersy-identity
+            packets = [packet for packet in other.call(get_packets, page_size) if packet in global_times]
+            self.assertEqual(sorted(packets), sorted(global_times.iterkeys()))
+            self.assertEqual([global_times[packet] for packet in packets], sorted(global_times.itervalues()))
+
+    def test_range_selection_index(self):
+        """
+        Claiming a sync bloom filter must select its range through
+        sync_community_undone_global_time_index, i.e. without sorting the selected rows, and
+        responding to it must page through sync_meta_message_undone_global_time_index.  The query
+        plans are captured with the explain query plan hook of the database.
+        """
+        class PlanHandler(logging.Handler):
+            def emit(self, record):
+                # NODE executes statements on its own thread
+                if record.thread != other._dispersy.callback.ident:
+                    return
+                if isinstance(record.msg, tuple):
+                    plans[statements[-1]].append(unicode(record.msg[-1]))
+                elif record.args:
+                    statements.append(record.args[0])
+                    plans[record.args[0]] = []
+
+        def claim_and_respond():
+            # a cached bloom filter would be reused without selecting its range
+            community._sync_bloom_filters.clear()
+            time_low, time_high, modulo, offset, _ = community._dispersy_claim_sync_bloom_filter_largest(None)
+            _, packets = community._get_packets_for_bloomfilters([[None, time_low, time_high, offset, modulo]], include_inactive=False).next()
+            return list(packets)
+
+        node, other, messages = self._create_nodes_messages()
+        community = other._community
+        statements = []
+        plans = {}
+
+        handler = PlanHandler()
+        plan_logger = logging.getLogger("explain-query-plan")
+        level = plan_logger.level
+        plan_logger.addHandler(handler)
+        plan_logger.setLevel(logging.INFO)
+        execute = Database._execute
+        Database._execute = explain_query_plan(execute.im_func)
+        _explain_query_plan.clear()
+        try:
+            self.assertGreaterEqual(len(other.call(claim_and_respond)), len(messages))
+
+        finally:
+            Database._execute = execute
+            plan_logger.removeHandler(handler)
+            plan_logger.setLevel(level)
+
+        claims = [u" ".join(plans[statement]) for statement in statements if u"WHERE community = ? AND undone = 0" in statement]
+        self.assertTrue(claims)
+        for plan in claims:
+            self.assertIn(u"sync_community_undone_global_time_index", plan)
+            self.assertNotIn(u"TEMP B-TREE", plan)
+
+        pages = [u" ".join(plans[statement]) for statement in statements if u"WHERE meta_message = ? AND undone = 0 AND global_time BETWEEN" in statement]
+        self.assertTrue(pages)
+        for plan in pages:
+            self.assertIn(u"sync_meta_message_undone_global_time_index", plan)
+
+
+class TestSyncBloomFilterManager(TestCase):
+
+    def test_store_and_invalidate(self):
+        manager = SyncBloomFilterManager(2, 10)
+        bloom = BloomFilter(128 * 8, 0.01)
+        manager.add(1, 10, bloom, 0)
+        self.assertEqual(manager.get(5), (1, 10, bloom))
+        self.assertIsNone(manager.get(11))
+
+        # stored keys are added to the filter covering their global time
+        manager.store(5, "in-range")
+        manager.store(11, "out-of-range")
+        self.assertIn("in-range", bloom)
+        self.assertNotIn("out-of-range", bloom)
+
+        # an undo or pruning event discards the filter
+        manager.invalidate(10, 20)
+        self.assertIsNone(manager.get(5))
+
+    def test_capacity_and_eviction(self):
+        manager = SyncBloomFilterManager(2, 10)
+        manager.add(1, 10, BloomFilter(128 * 8, 0.01), 10)
+        manager.store(5, "one too many")
+        self.assertIsNone(manager.get(5))
+
+        # overlapping and older ranges are discarded
+        manager.add(1, 10, BloomFilter(128 * 8, 0.01), 0)
+        manager.add(5, 15, BloomFilter(128 * 8, 0.01), 0)
+        self.assertEqual(manager.get(5)[:2], (5, 15))
+        manager.add(16, 20, BloomFilter(128 * 8, 0.01), 0)
+        manager.add(21, 30, BloomFilter(128 * 8, 0.01), 0)
+        self.assertEqual(len(manager), 2)
+        self.assertIsNone(manager.get(5))
+
+    def test_remove(self):
+        manager = SyncBloomFilterManager(2, 10)
+        counting = CountingBloomFilter(128 * 8, 0.01)
+        manager.add(1, 10, counting, 0)
+        manager.add(11, 20, BloomFilter(128 * 8, 0.01), 0)
+        manager.store(5, "undone")
+        manager.store(15, "pruned")
+
+        # a counting bloom filter absorbs the removal, any other filter is discarded
+        manager.remove(5, "undone")
+        manager.remove(15, "pruned")
+        self.assertEqual(manager.get(5), (1, 10, counting))
+        self.assertNotIn("undone", counting)
+        self.assertIsNone(manager.get(15))
+
+
+class TestSyncResponseCache(TestCase):
+
+    def test_replay(self):
+        cache = SyncResponseCache(2, 60.0, 1024)
+        source = iter([("a", "a"), ("b", "b"), ("c", "c")])
+
+        # only the consumed tuples are cached, the remainder comes from the source
+        self.assertEqual(list(islice(cache.get((1, 10, 0, 1), source), 2)), [("a", "a"), ("b", "b")])
+        self.assertEqual(list(cache.get((1, 10, 0, 1), iter([]))), [("a", "a"), ("b", "b"), ("c", "c")])
+        self.assertEqual(list(cache.get((1, 10, 0, 1), iter([]))), [("a", "a"), ("b", "b"), ("c", "c")])
+
+        # a store, undo, or pruning event discards all ranges
+        cache.clear()
+        self.assertEqual(list(cache.get((1, 10, 0, 1), iter([("d", "d")]))), [("d", "d")])
+
+    def test_lifetime_and_eviction(self):
+        cache = SyncResponseCache(2, 0.0, 1024)
+        list(cache.get((1, 10, 0, 1), iter([("a", "a")])))
+        self.assertEqual(list(cache.get((1, 10, 0, 1), iter([("b", "b")]))), [("b", "b")])
+
+        cache = SyncResponseCache(2, 60.0, 1024)
+        for time_low in xrange(3):
+            list(cache.get((time_low, 10, 0, 1), iter([("a", "a")])))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(list(cache.get((0, 10, 0, 1), iter([("b", "b")]))), [("b", "b")])
+
+        # zero disables the cache
+        cache = SyncResponseCache(0, 60.0, 1024)
+        source = iter([("a", "a")])
+        self.assertIs(cache.get((1, 10, 0, 1), source), source)
+        self.assertEqual(len(cache), 0)
+
+    def test_generation(self):
+        cache = SyncResponseCache(2, 60.0, 1024)
+        list(cache.get((1, 10, 0, 1), iter([("a", "a")]), 5))
+        self.assertEqual(list(cache.get((1, 10, 0, 1), iter([("b", "b")]), 5)), [("a", "a")])
+
+        # a different generation replaces the entry
+        self.assertEqual(list(cache.get((1, 10, 0, 1), iter([("b", "b")]), 6)), [("b", "b")])
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(list(cache.get((1, 10, 0, 1), iter([]), 6)), [("b", "b")])
+
+    def test_max_bytes(self):
+        cache = SyncResponseCache(2, 60.0, 5)
+        source = iter([("aa", "aa"), ("bb", "bb"), ("cc", "cc"), ("dd", "dd")])
+
+        # only the first five bytes are cached, the remainder is passed through
+        first = cache.get((1, 10, 0, 1), source)
+        second = cache.get((1, 10, 0, 1), iter([]))
+        self.assertEqual(list(islice(first, 3)), [("aa", "aa"), ("bb", "bb"), ("cc", "cc")])
+        # an iterator that is behind skips the tuples that were not cached
+        self.assertEqual(list(second), [("aa", "aa"), ("bb", "bb"), ("dd", "dd")])
+
+        # an overflowing entry is not reused
+        self.assertEqual(list(cache.get((1, 10, 0, 1), iter([("ee", "ee")]))), [("ee", "ee")])
+
+
+class TestSyncKeyIndex(TestCase):
+
+    def test_lazy_select(self):
+        selected = []
+
+        def select(member_database_id):
+            selected.append(member_database_id)
+            return {1: [10, 11], 2: [20]}.get(member_database_id, [])
+
+        index = SyncKeyIndex(2, select)
+
+        # a member is selected once, when it is first looked up
+        self.assertTrue(index.may_contain(1, 10))
+        self.assertFalse(index.may_contain(1, 12))
+        self.assertEqual(selected, [1])
+
+        # stored packets are added to members in the index, other members are selected later
+        index.store(1, 12)
+        index.store(2, 21)
+        self.assertTrue(index.may_contain(1, 12))
+        self.assertFalse(index.may_contain(2, 21))
+        self.assertEqual(selected, [1, 2])
+
+    def test_eviction(self):
+        selected = []
+
+        def select(member_database_id):
+            selected.append(member_database_id)
+            return [member_database_id]
+
+        index = SyncKeyIndex(2, select)
+        for member_database_id in (1, 2, 1, 3):
+            self.assertTrue(index.may_contain(member_database_id, member_database_id))
+
+        # member 2 was least recently used
+        self.assertEqual(len(index), 2)
+        self.assertTrue(index.may_contain(2, 2))
+        self.assertEqual(selected, [1, 2, 3, 2])
+
+        # zero disables the index, every key may be present
+        index = SyncKeyIndex(0, select)
+        self.assertTrue(index.may_contain(4, 5))
+        self.assertEqual(len(index), 0)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Measure the throughput of the BloomFilter hot paths used while synchronizing.
+
+Every benchmark uses a reproducible workload of packet-sized keys derived from --seed.  The size
+classes are chosen such that each selects a different struct format (H, L, or Q) and, combined with
+the error rate, a different hash function.  The Q size class requires a 256 MB filter and is only
+included with --huge.
+
+Each result is written as one JSON object per line, allowing regressions to be tracked between
+releases, for example:
+
+  python -m dispersy.tool.benchmarkbloomfilter --output bloomfilter-benchmark.json
+"""
+
+import argparse
+import json
+import sys
+from random import Random
+from struct import pack
+from time import time
+
+# From: http://docs.python.org/2/tutorial/modules.html#intra-package-references
+# Note that both explicit and implicit relative imports are based on the name of the current
+# module. Since the name of the main module is always "__main__", modules intended for use as the
+# main module of a Python application should always use absolute imports.
+from dispersy import bloomfilter
+from dispersy.bloomfilter import BloomFilter
+
+# (m_size, f_error_rate) tuples
+SIZE_CLASSES = [(512 * 8, 0.01),         # H, md5
+                (512 * 8, 0.0001),       # H, sha256
+                ((1 << 15) + 8, 0.1),    # L, md5
+                ((1 << 15) + 8, 0.01)]   # L, sha256
+HUGE_SIZE_CLASSES = [(1 << 31, 0.1)]     # Q, sha256
+
+KEY_COUNTS = [1000, 10000, 100000]
+HIT_RATIOS = [0.0, 0.5, 1.0]
+
+
+def create_keys(seed, count, offset=0):
+    """
+    Returns COUNT unique packet-sized keys, the same SEED and OFFSET always result in the same keys.
+    """
+    rng = Random(seed)
+    pool = "".join(chr(rng.randrange(256)) for _ in xrange(64 * 1024))
+    keys = []
+    for index in xrange(offset, offset + count):
+        start = rng.randrange(len(pool) - 1500)
+        keys.append(pack(">Q", index) + pool[start:start + rng.randrange(100, 1500)])
+    return keys
+
+
+def measure(repeat, func):
+    """
+    Returns the fastest of REPEAT calls to FUNC in seconds.
+    """
+    best = None
+    for _ in xrange(repeat):
+        start = time()
+        func()
+        duration = time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def describe(bloom):
+    fmt = bloom._fmt_unpack.__self__.format.lstrip(">").rstrip("x")
+    return dict(m_size=bloom.size, k_functions=bloom.functions, fmt=fmt[0], hash=bloom._salt.name.lower(),
+                numpy=bloomfilter.numpy is not None)
+
+
+def benchmark(opt, size_classes, output):
+    def emit(benchmark, bloom, seconds, operations, **kargs):
+        result = describe(bloom)
+        result.update(benchmark=benchmark, seconds=seconds, operations=operations,
+                      operations_per_second=operations / seconds if seconds else None, seed=opt.seed, **kargs)
+        output.write(json.dumps(result, sort_keys=True))
+        output.write("\n")
+        output.flush()
+
+    key_counts = [count for count in KEY_COUNTS if count <= opt.max_keys]
+    all_keys = create_keys(opt.seed, max(key_counts))
+    miss_keys = create_keys(opt.seed + 1, max(key_counts), offset=len(all_keys))
+
+    for m_size, f_error_rate in size_classes:
+        bloom = BloomFilter(m_size, f_error_rate, prefix="b")
+
+        # construction from bytes
+        bytes_, functions, prefix = bloom.bytes, bloom.functions, bloom.prefix
+        emit("from-bytes", bloom, measure(opt.repeat, lambda: BloomFilter(bytes_, functions, prefix)), 1)
+
+        for count in key_counts:
+            keys = all_keys[:count]
+
+            # add_keys, including clearing the filter
+            def add_keys():
+                bloom.clear()
+                bloom.add_keys(keys)
+            emit("add-keys", bloom, measure(opt.repeat, add_keys), count, keys=count)
+
+            # bits_checked on the filled filter
+            emit("bits-checked", bloom, measure(opt.repeat, lambda: bloom.bits_checked), 1, keys=count)
+
+            # not_filter and not_filter_indexes with a mix of hits and misses
+            for hit_ratio in HIT_RATIOS:
+                hits = int(count * hit_ratio)
+                mixed = keys[:hits] + miss_keys[:count - hits]
+                tuples = [(key,) for key in mixed]
+                emit("not-filter", bloom, measure(opt.repeat, lambda: sum(1 for _ in bloom.not_filter(tuples))), count,
+                     keys=count, hit_ratio=hit_ratio)
+                emit("not-filter-indexes", bloom, measure(opt.repeat, lambda: bloom.not_filter_indexes(mixed)), count,
+                     keys=count, hit_ratio=hit_ratio)
+
+        emit("get-capacity", bloom, measure(opt.repeat, lambda: bloom.get_capacity(f_error_rate)), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=42, help="seed used to generate the keys")
+    parser.add_argument("--repeat", type=int, default=3, help="report the fastest of REPEAT runs")
+    parser.add_argument("--max-keys", type=int, default=max(KEY_COUNTS), help="skip workloads with more keys")
+    parser.add_argument("--huge", action="store_true", help="include the 256 MB size class (Q struct format)")
+    parser.add_argument("--output", help="write the results to OUTPUT instead of stdout")
+    opt = parser.parse_args()
+
+    size_classes = SIZE_CLASSES + (HUGE_SIZE_CLASSES if opt.huge else [])
+    if opt.output:
+        with open(opt.output, "w") as output:
+            benchmark(opt, size_classes, output)
+    else:
+        benchmark(opt, size_classes, sys.stdout)
+
+if __name__ == "__main__":
+    main()
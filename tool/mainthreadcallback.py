@@ -11,9 +11,9 @@ class MainThreadCallback(Callback):
     """
     MainThreadCallback must be used when Dispersy must run on the main process thread.
     """
-    def __init__(self, name="Generic-Callback"):
+    def __init__(self, name="Generic-Callback", **kargs):
         assert isinstance(name, str), type(name)
-        super(MainThreadCallback, self).__init__(name)
+        super(MainThreadCallback, self).__init__(name, **kargs)
 
         # we will be running on this thread
         self._thread_ident = get_ident()